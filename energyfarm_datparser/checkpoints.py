@@ -0,0 +1,163 @@
+'''
+checkpoints.py
+
+Where the energy farm extractor keeps how far it got in each file, so the next update of the
+file only processes the rows added since.
+
+A checkpoint is a dictionary with the same content as the file metadata the extractor used to
+write: "last processed time", "last processed offset", "last processed checksum" and
+"datapoints_created". The stores here all have the same two methods:
+
+get(fileId) -- the checkpoint of the file, or None if there is none
+set(fileId, checkpoint) -- replace the checkpoint of the file
+
+energyfarm_follow.py keeps its checkpoints in the same SQLite database, by the path of each file.
+Both post the rows of a station to the same stream, so the database also keeps the time of the
+last row posted for each station, under station_key(station). Each skips the rows up to that
+time, holding the StationLock of the station while it posts.
+'''
+
+import fcntl
+import json
+import sqlite3
+import threading
+
+import requests
+
+import pyclowder.files
+
+
+class SQLiteCheckpointStore(object):
+	'''
+	Keep the checkpoints in a local SQLite database, so resuming a file takes no HTTP calls.
+	The connection is shared by the worker threads, behind a lock.
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._connection = sqlite3.connect(path, check_same_thread=False)
+		with self._lock:
+			self._connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (file_id TEXT PRIMARY KEY, content TEXT NOT NULL)')
+			self._connection.commit()
+
+	def get(self, fileId):
+		with self._lock:
+			row = self._connection.execute('SELECT content FROM checkpoints WHERE file_id = ?', (fileId,)).fetchone()
+		return json.loads(row[0]) if row else None
+
+	def set(self, fileId, checkpoint):
+		content = json.dumps(checkpoint)
+		with self._lock:
+			self._connection.execute('INSERT OR REPLACE INTO checkpoints (file_id, content) VALUES (?, ?)', (fileId, content))
+			self._connection.commit()
+
+	def close(self):
+		with self._lock:
+			self._connection.close()
+
+
+# Key of the checkpoint of a station, {"last posted time": ISO time string of the last row posted}.
+def station_key(station):
+	return 'station ' + station
+
+
+class StationLock(object):
+	'''
+	Lock on posting the rows of a station, shared by every process and thread using the same SQLite
+	database. It is a lock on a file next to the database, so it is released if the process dies.
+	'''
+
+	def __init__(self, path, station):
+		self.path = '%s.%s.lock' % (path, station)
+		self._file = None
+
+	def __enter__(self):
+		self._file = open(self.path, 'a')
+		fcntl.flock(self._file, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		fcntl.flock(self._file, fcntl.LOCK_UN)
+		self._file.close()
+		self._file = None
+
+
+class ClowderCheckpointStore(object):
+	'''
+	Keep the checkpoints in the metadata of the files on Clowder, the way the extractor always did.
+	Each lookup downloads the metadata of the file and each update deletes the old entry and uploads a new one.
+	'''
+
+	def __init__(self, connector, host, key, extractor_id):
+		self.connector = connector
+		self.host = host
+		self.key = key
+		# Full id of the extractor, host + "/api/extractors/" + name, as the agent of the metadata.
+		self.extractor_id = extractor_id
+
+	def get(self, fileId):
+		checkpoint = None
+		for md in pyclowder.files.download_metadata(self.connector, self.host, self.key, fileId):
+			if 'content' in md and 'last processed time' in md['content']:
+				checkpoint = md['content']
+		return checkpoint
+
+	def set(self, fileId, checkpoint):
+		for md in pyclowder.files.download_metadata(self.connector, self.host, self.key, fileId):
+			if 'content' in md and 'last processed time' in md['content']:
+				delete_metadata(self.connector, self.host, self.key, fileId, md['agent']['name'].split("/")[-1])
+
+		pyclowder.files.upload_metadata(self.connector, self.host, self.key, fileId, {
+			"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld"],
+			"dataset_id": fileId,
+			"content": checkpoint,
+			"agent": {
+				"@type": "extractor",
+				"extractor_id": self.extractor_id
+			}
+		})
+
+
+class MirroredCheckpointStore(object):
+	'''
+	Read the checkpoints from a primary store and write them to both the primary store and a mirror.
+	Checkpoints missing from the primary store, e.g. after the local database is lost, are read from the mirror.
+	With writeMirror False the mirror is only read from, as a fallback for the checkpoints saved there before.
+	'''
+
+	def __init__(self, primary, mirror, writeMirror = True):
+		self.primary = primary
+		self.mirror = mirror
+		self.writeMirror = writeMirror
+
+	def get(self, fileId):
+		checkpoint = self.primary.get(fileId)
+		if checkpoint == None:
+			checkpoint = self.mirror.get(fileId)
+			if checkpoint != None:
+				self.primary.set(fileId, checkpoint)
+		return checkpoint
+
+	def set(self, fileId, checkpoint):
+		self.primary.set(fileId, checkpoint)
+		if self.writeMirror:
+			self.mirror.set(fileId, checkpoint)
+
+
+def delete_metadata(connector, host, key, fileid, extractor=None):
+	"""Delete file JSON-LD metadata from Clowder.
+	Keyword arguments:
+	connector -- connector information, used to get missing parameters and send status updates
+	host -- the clowder host, including http and port, should end with a /
+	key -- the secret key to login to clowder
+	fileid -- the file to fetch metadata of
+	extractor -- extractor name to filter results (if only one extractor's metadata is desired)
+	"""
+	filterstring = "" if extractor is None else "&extractor=%s" % extractor
+	url = '%sapi/files/%s/metadata.jsonld?key=%s%s' % (host, fileid, key, filterstring)
+	# fetch data
+	result = requests.delete(url, stream=True,
+						  verify=connector.ssl_verify if connector else True)
+	result.raise_for_status()
+	return result.json()
@@ -0,0 +1,212 @@
+'''
+This is the unit test module for checkpoints.py.
+It uses a temporary SQLite database, an in-memory mirror and a stub Clowder HTTP server
+on localhost, so no Clowder instance is needed.
+
+To run the unit test, simply use:
+python checkpoints_unittest.py
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from checkpoints import SQLiteCheckpointStore, ClowderCheckpointStore, MirroredCheckpointStore, StationLock, station_key
+
+
+class MemoryCheckpointStore(object):
+	'''
+	Keeps the checkpoints in a dictionary and counts the calls, in place of the Clowder store.
+	'''
+
+	def __init__(self, checkpoints=None):
+		self.checkpoints = dict(checkpoints or {})
+		self.gets = 0
+		self.sets = 0
+
+	def get(self, fileId):
+		self.gets += 1
+		return self.checkpoints.get(fileId)
+
+	def set(self, fileId, checkpoint):
+		self.sets += 1
+		self.checkpoints[fileId] = checkpoint
+
+
+class StubClowderHandler(BaseHTTPRequestHandler):
+	'''
+	Answers the file metadata requests from the metadata on the server and records every request.
+	'''
+
+	def do_GET(self):
+		self.server.requests.append(('GET', self.path.split('?')[0]))
+		fileId = self.path.split('/')[3]
+		self.reply(200, self.server.metadata.get(fileId, []))
+
+	def do_POST(self):
+		self.server.requests.append(('POST', self.path.split('?')[0]))
+		self.reply(200, {})
+
+	def do_DELETE(self):
+		self.server.requests.append(('DELETE', self.path.split('?')[0]))
+		self.reply(200, {})
+
+	def reply(self, status, content):
+		data = json.dumps(content)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class FakeConnector(object):
+	ssl_verify = True
+
+	def get(self, url, **kwargs):
+		return requests.get(url, **kwargs)
+
+
+class checkpointsUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.workdir, 'checkpoints.sqlite')
+		self.checkpoint = {
+			'last processed time': '2017-04-01T01:15:00-07:00',
+			'last processed offset': 692,
+			'last processed checksum': 967820318,
+			'datapoints_created': 6
+		}
+
+	def test_sqliteStoreRoundTrip(self):
+		'''
+		A checkpoint should be read back as it was written, replaced by the next one,
+		and still be there when the database is opened again
+		'''
+		store = SQLiteCheckpointStore(self.path)
+		self.assertEqual(store.get('file-1'), None)
+
+		store.set('file-1', {'last processed time': 0})
+		store.set('file-1', self.checkpoint)
+		self.assertEqual(store.get('file-1'), self.checkpoint)
+		self.assertEqual(store.get('file-2'), None)
+		store.close()
+
+		store = SQLiteCheckpointStore(self.path)
+		self.assertEqual(store.get('file-1'), self.checkpoint)
+		store.close()
+
+	def test_mirroredStoreWritesBoth(self):
+		'''
+		Checkpoints should be written to both stores and read from the primary one only
+		'''
+		primary = SQLiteCheckpointStore(self.path)
+		mirror = MemoryCheckpointStore()
+		store = MirroredCheckpointStore(primary, mirror)
+
+		store.set('file-1', self.checkpoint)
+		self.assertEqual(mirror.checkpoints['file-1'], self.checkpoint)
+		self.assertEqual(store.get('file-1'), self.checkpoint)
+		self.assertEqual(mirror.gets, 0)
+		primary.close()
+
+	def test_mirroredStoreFallsBackToMirror(self):
+		'''
+		A checkpoint missing from the primary store should be read from the mirror and kept locally
+		'''
+		primary = SQLiteCheckpointStore(self.path)
+		mirror = MemoryCheckpointStore({'file-1': self.checkpoint})
+		store = MirroredCheckpointStore(primary, mirror)
+
+		self.assertEqual(store.get('file-1'), self.checkpoint)
+		self.assertEqual(primary.get('file-1'), self.checkpoint)
+		self.assertEqual(store.get('file-2'), None)
+		self.assertEqual(mirror.sets, 0)
+		primary.close()
+
+	def test_localMissFallsBackToClowder(self):
+		'''
+		By default, a checkpoint missing from the SQLite database should be read from the file metadata
+		on Clowder and kept locally, and checkpoints should not be written back to Clowder
+		'''
+		server = HTTPServer(('127.0.0.1', 0), StubClowderHandler)
+		server.requests = []
+		server.metadata = {'file-1': [
+			{'agent': {'name': 'http://clowder/api/extractors/other'}, 'content': {'notes': 'not a checkpoint'}},
+			{'agent': {'name': 'http://clowder/api/extractors/terra.energyfarm'}, 'content': self.checkpoint}
+		]}
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		host = 'http://127.0.0.1:%s/' % server.server_address[1]
+
+		try:
+			primary = SQLiteCheckpointStore(self.path)
+			store = MirroredCheckpointStore(primary, ClowderCheckpointStore(FakeConnector(), host, 'secret',
+												host + 'api/extractors/terra.energyfarm'), writeMirror=False)
+			self.assertEqual(store.get('file-1'), self.checkpoint)
+			self.assertEqual(primary.get('file-1'), self.checkpoint)
+			self.assertEqual(store.get('file-2'), None)
+
+			# The file is found locally from now on, and updates stay local.
+			store.get('file-1')
+			store.set('file-1', dict(self.checkpoint, datapoints_created=7))
+			self.assertEqual(primary.get('file-1')['datapoints_created'], 7)
+			self.assertEqual(server.requests, [('GET', '/api/files/file-1/metadata.jsonld'),
+											   ('GET', '/api/files/file-2/metadata.jsonld')])
+			primary.close()
+		finally:
+			server.shutdown()
+			server.server_close()
+
+	def test_stationLockIsExclusive(self):
+		'''
+		The lock of a station should be held by one holder at a time, whichever store it comes from,
+		and not block the other stations
+		'''
+		events = []
+		def hold(station, name):
+			with StationLock(self.path, station):
+				events.append(name + ' in')
+				time.sleep(0.2)
+				events.append(name + ' out')
+
+		with StationLock(self.path, 'CEN'):
+			cen = threading.Thread(target=hold, args=('CEN', 'CEN'))
+			se = threading.Thread(target=hold, args=('SE', 'SE'))
+			cen.start()
+			se.start()
+			se.join()
+			time.sleep(0.1)
+			events.append('main out')
+		cen.join()
+		self.assertEqual(events, ['SE in', 'SE out', 'main out', 'CEN in', 'CEN out'])
+
+	def test_stationCheckpointsBesideFiles(self):
+		'''
+		Station checkpoints should be kept in the same database without clashing with the file ones
+		'''
+		store = SQLiteCheckpointStore(self.path)
+		store.set('CEN', self.checkpoint)
+		store.set(station_key('CEN'), {'last posted time': '2017-04-01T01:15:00-07:00'})
+		self.assertEqual(store.get('CEN'), self.checkpoint)
+		self.assertEqual(store.get(station_key('CEN')), {'last posted time': '2017-04-01T01:15:00-07:00'})
+		store.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir)
+
+
+if __name__ == "__main__":
+	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(checkpointsUnitTest))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+'''
+energyfarm_follow.py
+
+Follow the energy farm logger files while the logger is still writing them and post the new
+rows to Geostreams as soon as they are complete, instead of waiting for the file to be uploaded.
+
+The files are polled: only the bytes appended since the last poll are parsed, and a last line
+that is still being written is left for the next poll. Where each file was read up to is kept in
+the checkpoint database of the extractor, by the path of the file, so a restart carries on from there.
+
+The extractor posts the rows of the uploaded files to the same streams. Give both the same
+checkpoint database and each station's rows are only posted once, by whichever gets to them
+first, see checkpoints.py. With different databases the two must not run for the same station.
+
+To follow the files, use:
+python energyfarm_follow.py <.dat files> --host <clowder host> --key <secret key> [--interval SECONDS] [--checkpoints FILE]
+'''
+
+import argparse
+import logging
+import os
+import time
+
+import dateutil.tz
+
+from parser import *
+from checkpoints import SQLiteCheckpointStore, StationLock
+from terra_energyfarm_datparser import get_station_code, get_station_stream_id, post_station_records
+
+# The same offset the extractor renders the times of the uploaded files in.
+UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+
+# Key of the checkpoint of a followed file, the extractor's checkpoints are keyed by Clowder file ID.
+def follower_key(filepath):
+	return os.path.abspath(filepath)
+
+# Make a follower carrying on from the checkpoint of the file, if there is one.
+def load_follower(checkpoints, filepath, utc_offset):
+	checkpoint = checkpoints.get(follower_key(filepath)) or {}
+	resume = None
+	if 'last processed offset' in checkpoint and 'last processed checksum' in checkpoint:
+		resume = {
+			'offset': checkpoint['last processed offset'],
+			'checksum': checkpoint['last processed checksum']
+		}
+	return FileFollower(filepath, checkpoint.get('last processed time', 0), resume, utc_offset)
+
+# Save where the file was read up to, in the same format as the checkpoints of the extractor.
+def save_follower(checkpoints, follower, posted):
+	checkpoint = checkpoints.get(follower_key(follower.filepath)) or {}
+	content = {
+		"last processed time": follower.last_processed_time,
+		"datapoints_created": checkpoint.get('datapoints_created', 0) + posted
+	}
+	if follower.resume != None:
+		content["last processed offset"] = follower.resume['offset']
+		content["last processed checksum"] = follower.resume['checksum']
+	checkpoints.set(follower_key(follower.filepath), content)
+
+def follow(filepaths, host, key, checkpointsPath, interval = 5, batch_size = 500, utc_offset = UTC_OFFSET):
+	logger = logging.getLogger(__name__)
+	checkpoints = SQLiteCheckpointStore(checkpointsPath)
+	followers = [load_follower(checkpoints, filepath, utc_offset) for filepath in filepaths]
+
+	# Sensor and stream IDs are cached, so looking them up on every poll is cheap.
+	while True:
+		for follower in followers:
+			filename = os.path.basename(follower.filepath)
+			station = get_station_code(filename)
+			# The extractor doesn't post the rows of the station while they are posted here.
+			with StationLock(checkpoints.path, station):
+				try:
+					records = follower.poll()
+				except ValueError as e:
+					# The header or the first row of a new file is not complete yet.
+					logger.debug("Skipping %s until the next poll: %s" % (follower.filepath, e))
+					continue
+				if not records:
+					continue
+
+				stream_id = get_station_stream_id(None, host, key, filename)
+				posted = post_station_records(None, host, key, checkpoints, station, stream_id, records, utc_offset, batch_size)
+				# Only saved once the datapoints are posted, so a crash repeats rows rather than losing them.
+				save_follower(checkpoints, follower, posted)
+			logger.info("Posted %d datapoints from %s" % (posted, follower.filepath))
+		time.sleep(interval)
+
+
+if __name__ == "__main__":
+	argParser = argparse.ArgumentParser(description='Post the new rows of growing energy farm logger files to Geostreams.')
+	argParser.add_argument('files', nargs='+', help='the .dat files to follow')
+	argParser.add_argument('--host', required=True, help='the clowder host, including http and port, should end with a /')
+	argParser.add_argument('--key', required=True, help='the secret key to login to clowder')
+	argParser.add_argument('--interval', type=float, default=5, help='seconds between two polls (default is 5)')
+	argParser.add_argument('--batchSize', dest='batch_size', type=int, default=500,
+						   help='number of datapoints posted to geostreams per request')
+	argParser.add_argument('--checkpoints', default='/home/extractor/data/checkpoints.sqlite',
+						   help='the SQLite database where the position in each file is kept, '
+						   'the one of the extractor so the rows posted by either are not posted again')
+	args = argParser.parse_args()
+
+	logging.basicConfig(level=logging.INFO)
+	follow(args.files, args.host, args.key, args.checkpoints, args.interval, args.batch_size)
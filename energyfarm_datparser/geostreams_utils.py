@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+'''
+geostreams_utils.py
+
+Helpers shared by the extractors for posting to the Clowder Geostreams API.
+Each extractor directory keeps its own copy of this module, so keep the copies in sync:
+geostreams_utils_unittest.py in weather_datparser fails when a definition differs between them.
+The envlog2netcdf copy leaves out DatapointUploader, that extractor posts its datapoints one by one.
+'''
+
+import json
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+import pyclowder.geostreams
+
+
+class DatapointUploader(object):
+    '''
+    Buffer datapoints and post them to Geostreams in batches instead of one request each.
+
+    Each batch is posted to the bulk datapoints endpoint, POST api/geostreams/datapoints/bulk, as a
+    JSON list of datapoints. Each datapoint is the same object pyclowder.geostreams.create_datapoint
+    posts to api/geostreams/datapoints, the unit test checks they stay the same. Clowder instances
+    without that endpoint answer 404 (or 405/501), the datapoints of a batch are then posted one by
+    one, with several requests in flight at once over persistent connections.
+    '''
+
+    def __init__(self, connector, host, key, batch_size=500, connections=4):
+        '''
+        Keyword arguments:
+        connector -- connector information, used to get missing parameters and send status updates
+        host -- the clowder host, including http and port, should end with a /
+        key -- the secret key to login to clowder
+        batch_size -- number of datapoints to buffer before posting them
+        connections -- number of requests in flight when falling back to single datapoints
+        '''
+        self.connector = connector
+        self.host = host
+        self.key = key
+        self.batch_size = max(int(batch_size), 1)
+        self.connections = max(int(connections), 1)
+        # Unknown until the first batch is posted.
+        self.bulk_supported = None
+        self.count = 0
+        self._buffer = []
+        self._session = requests.Session()
+        self._local = threading.local()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Post what's left only if the upload wasn't interrupted by an error.
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+    def add(self, streamid, geom, starttime, endtime, properties={}):
+        '''
+        Queue a datapoint, takes the same arguments as pyclowder.geostreams.create_datapoint.
+        '''
+        self._buffer.append({
+            "start_time": starttime,
+            "end_time": endtime,
+            "type": "Point",
+            "geometry": geom,
+            "properties": properties,
+            "stream_id": str(streamid)
+        })
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Post all the queued datapoints.
+        '''
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+
+        if self.bulk_supported is not False:
+            if self._post_bulk(batch):
+                self.bulk_supported = True
+                self.count += len(batch)
+                return
+            logging.getLogger(__name__).info("bulk datapoints endpoint not available; posting datapoints one by one")
+            self.bulk_supported = False
+
+        self._post_each(batch)
+        self.count += len(batch)
+
+    def close(self):
+        '''
+        Post the remaining datapoints and release the connections.
+        '''
+        try:
+            self.flush()
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._session.close()
+
+    def _verify(self):
+        return self.connector.ssl_verify if self.connector else True
+
+    def _post_bulk(self, batch):
+        '''
+        Post the batch to the bulk endpoint, returns False if the endpoint does not exist.
+        '''
+        url = '%sapi/geostreams/datapoints/bulk?key=%s' % (self.host, self.key)
+        result = self._session.post(url, headers={'Content-type': 'application/json'},
+                                    data=json.dumps(batch), verify=self._verify())
+        if result.status_code in (404, 405, 501):
+            return False
+        result.raise_for_status()
+        return True
+
+    def _thread_session(self):
+        # requests sessions should not be shared between threads, each one keeps its own.
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _post_one(self, datapoint):
+        url = '%sapi/geostreams/datapoints?key=%s' % (self.host, self.key)
+        result = self._thread_session().post(url, headers={'Content-type': 'application/json'},
+                                             data=json.dumps(datapoint), verify=self._verify())
+        result.raise_for_status()
+        return result.json()['id']
+
+    def _post_each(self, batch):
+        if self.connections == 1:
+            for datapoint in batch:
+                self._post_one(datapoint)
+            return
+        if self._pool is None:
+            self._pool = ThreadPool(self.connections)
+        # map() waits for the whole batch and raises the first error, if any.
+        self._pool.map(self._post_one, batch)
+
+
+class GeostreamsCache(object):
+    '''
+    Thread-safe cache of sensor and stream name -> id lookups, with entries expiring after ttl seconds
+    of the clock, a function returning the time in seconds.
+    '''
+
+    def __init__(self, ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, host, name):
+        '''
+        Return the cached id, or None if it is unknown or expired.
+        '''
+        with self._lock:
+            entry = self._entries.get((kind, host, name))
+            if entry is None:
+                return None
+            if self.clock() - entry[1] > self.ttl:
+                del self._entries[(kind, host, name)]
+                return None
+            return entry[0]
+
+    def set(self, kind, host, name, id):
+        with self._lock:
+            self._entries[(kind, host, name)] = (id, self.clock())
+
+    def invalidate(self, kind=None, host=None, name=None):
+        '''
+        Drop the matching entries, arguments left as None match anything.
+        '''
+        with self._lock:
+            for entry_key in list(self._entries):
+                if (kind is None or entry_key[0] == kind) and (host is None or entry_key[1] == host) \
+                        and (name is None or entry_key[2] == name):
+                    del self._entries[entry_key]
+
+
+# Shared by every message handled by this worker process.
+GEOSTREAMS_CACHE = GeostreamsCache()
+
+
+def get_sensor_id(connector, host, key, sensorname, geom, type, region):
+    '''Get the id of a sensor by name, creating the sensor if it does not exist.
+
+    Lookups are cached for the whole process, see GEOSTREAMS_CACHE.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    sensorname -- name of the sensor
+    geom, type, region -- passed on to pyclowder.geostreams.create_sensor if the sensor is created
+    '''
+    sensor_id = GEOSTREAMS_CACHE.get('sensor', host, sensorname)
+    if sensor_id is not None:
+        return sensor_id
+
+    sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, key, sensorname)
+    if not sensor_data:
+        sensor_id = pyclowder.geostreams.create_sensor(connector, host, key, sensorname, geom, type, region)
+        # Streams cached for an older sensor of the same name are gone with it.
+        GEOSTREAMS_CACHE.invalidate('stream', host)
+    else:
+        sensor_id = sensor_data['id']
+
+    GEOSTREAMS_CACHE.set('sensor', host, sensorname, sensor_id)
+    return sensor_id
+
+
+def get_stream_id(connector, host, key, streamname, sensorid, geom, properties={}):
+    '''Get the id of a stream by name, creating the stream if it does not exist.
+
+    Lookups are cached for the whole process, see GEOSTREAMS_CACHE.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    streamname -- name of the stream
+    sensorid, geom, properties -- passed on to pyclowder.geostreams.create_stream if the stream is created
+    '''
+    stream_id = GEOSTREAMS_CACHE.get('stream', host, streamname)
+    if stream_id is not None:
+        return stream_id
+
+    stream_data = pyclowder.geostreams.get_stream_by_name(connector, host, key, streamname)
+    if not stream_data:
+        GEOSTREAMS_CACHE.invalidate('stream', host, streamname)
+        stream_id = pyclowder.geostreams.create_stream(connector, host, key, streamname, sensorid, geom, properties)
+    else:
+        stream_id = stream_data['id']
+
+    GEOSTREAMS_CACHE.set('stream', host, streamname, stream_id)
+    return stream_id
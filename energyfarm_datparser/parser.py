@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 import math
+import calendar
 import datetime
 import dateutil.parser
 import dateutil.tz
 import csv
 import json
+import mmap
+import os
+import zlib
 
 DEBUG = True
 
@@ -27,15 +31,59 @@ def ISOTimeString2TimeStamp(timeStr):
 	isoStartTime = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, ISO_8601_UTC_MEAN)
 	return int((time - isoStartTime).total_seconds())
 
-def tempUnit2K(value, unit):
+# ISO time strings already rendered, by timezone and then by timestamp.
+# Consecutive records and packages share their boundaries, so the same timestamps come up again and again.
+# Each entry keeps its timezone alive so that the id used as the key can't be reused by another object.
+ISO_TIME_STRINGS = {}
+ISO_TIME_STRINGS_LIMIT = 65536
+
+# Render the given timestamp in seconds as an ISO time string in the given timezone.
+def TimeStamp2ISOTimeString(timestamp, tz):
+	entry = ISO_TIME_STRINGS.get(id(tz))
+	if entry == None:
+		entry = ISO_TIME_STRINGS[id(tz)] = (tz, {})
+	strings = entry[1]
+	timeStr = strings.get(timestamp)
+	if timeStr == None:
+		if len(strings) >= ISO_TIME_STRINGS_LIMIT:
+			strings.clear()
+		timeStr = strings[timestamp] = datetime.datetime.fromtimestamp(timestamp, tz).isoformat()
+	return timeStr
+
+# Timestamps in seconds of the dates already seen, a file only spans a few of them.
+TOA5_DATES = {}
+
+# Convert a TOA5 time string, which is always "YYYY-MM-DD HH:MM:SS", to a timestamp in seconds
+# as if it was in UTC. The fields are sliced out of the fixed layout instead of going through strptime.
+def TOA5TimeString2TimeStamp(timeStr):
+	if len(timeStr) != 19 or timeStr[10] != ' ':
+		return calendar.timegm(datetime.datetime.strptime(timeStr, '%Y-%m-%d %H:%M:%S').timetuple())
+	day = TOA5_DATES.get(timeStr[:10])
+	if day == None:
+		day = TOA5_DATES[timeStr[:10]] = calendar.timegm(datetime.date(int(timeStr[0:4]), int(timeStr[5:7]), int(timeStr[8:10])).timetuple())
+	return day + int(timeStr[11:13]) * 3600 + int(timeStr[14:16]) * 60 + int(timeStr[17:19])
+
+# Get the offset of the given timezone from UTC in seconds.
+def utcOffsetSeconds(utc_offset):
+	offset = utc_offset.utcoffset(None)
+	return offset.days * 24 * 60 * 60 + offset.seconds
+
+def identity(value):
+	return value
+
+# Unit converters are resolved once per file header, so only the arithmetic is left for each value.
+def tempUnitConverter(unit):
 	if unit == 'Deg C':
-		return value + 273.15
+		return lambda value: value + 273.15
 	elif unit == 'Deg F':
-		return (value + 459.67) * 5 / 9
+		return lambda value: (value + 459.67) * 5 / 9
 	elif unit == 'Deg K':
-		return value
+		return identity
 	else:
 		raise ValueError('Unsupported unit "%s".' % unit)
+
+def tempUnit2K(value, unit):
+	return tempUnitConverter(unit)(value)
 """
 def relHumidUnit2Percent(value, unit):
 	if unit == '%':
@@ -98,60 +146,179 @@ STATION_GEOMETRY = {
 
 #AirTC_Avg","RH1_Avg","WindSpd_Avg","WindSpd_Max","WindDir_Avg","PAR_APOGE_Avg","RAIN_Tot","PRESSURE_Avg"
 
-# Each mapping function can decide to return one or multiple tuple, so leave the list to them.
+# Each mapping function gets the header details of its column and returns the list of properties
+# computed from it, as (property name, source columns, converter) tuples.
+# The converter is called with the values of the source columns, in that order.
 PROP_MAPPING = {
-	'AirTC_Avg': lambda d: [(
-		'air_temperature',
-		tempUnit2K(float(d['value']), d['meta']['unit'])
-	)],
-	'RH1_Avg': lambda d: [(
-		'relative_humidity',
-		float(d['value'])
-	)],
-	'PAR_APOGE_Avg': lambda d: [(
-		'surface_downwelling_photosynthetic_photon_flux_in_air',
-		float(d['value'])
-	)],
+	'AirTC_Avg': lambda meta: [
+		('air_temperature', ('AirTC_Avg',), tempUnitConverter(meta['unit']))
+	],
+	'RH1_Avg': lambda meta: [
+		('relative_humidity', ('RH1_Avg',), identity)
+	],
+	'PAR_APOGE_Avg': lambda meta: [
+		('surface_downwelling_photosynthetic_photon_flux_in_air', ('PAR_APOGE_Avg',), identity)
+	],
 	# If Wind Direction is present, split into speed east and speed north it if we can find Wind Speed.
-	'WindDir_Avg': lambda d: [
-		('eastward_wind', extractXFactor(float(d['record']['WindDir_Avg']), float(d['value']))),
-		('northward_wind', extractYFactor(float(d['record']['WindDir_Avg']), float(d['value'])))
+	'WindDir_Avg': lambda meta: [
+		('eastward_wind', ('WindDir_Avg', 'WindDir_Avg'), extractXFactor),
+		('northward_wind', ('WindDir_Avg', 'WindDir_Avg'), extractYFactor)
 	],
 	# If Wind Speed is present, process it if we can find Wind Direction.
-	'WindSpd_Avg': lambda d: [(
-		'wind_speed',
-		float(d['value'])
-	)],
-	'RAIN_Tot': lambda d: [(
-		'precipitation_rate',
-		float(d['value'])
-	)],
-	'PRESSURE_Avg': lambda d:[(
-		'air_pressure',
-		float(d['value'])
-	)]	
+	'WindSpd_Avg': lambda meta: [
+		('wind_speed', ('WindSpd_Avg',), identity)
+	],
+	'RAIN_Tot': lambda meta: [
+		('precipitation_rate', ('RAIN_Tot',), identity)
+	],
+	'PRESSURE_Avg': lambda meta: [
+		('air_pressure', ('PRESSURE_Avg',), identity)
+	]
 }
 
 
+# ----------------------------------------------------------------------
+# Compile the header of a file into the conversions to run on each of its rows.
+# Returns the plan as (columns, steps):
+# columns -- indices of the columns to read, in the order their values are passed to transformValues
+# steps -- (property name, positions of the source values, converter) for each property
+def compilePropPlan(propMetaDict, prop_names, mapping = PROP_MAPPING):
+	columns = []
+	steps = []
+	for propName in prop_names:
+		if propName not in mapping:
+			continue
+		for name, sources, converter in mapping[propName](propMetaDict[propName]):
+			positions = []
+			for source in sources:
+				if source not in prop_names:
+					raise ValueError('Column "%s" is needed for "%s".' % (source, name))
+				index = prop_names.index(source)
+				if index not in columns:
+					columns.append(index)
+				positions.append(columns.index(index))
+			steps.append((name, tuple(positions), converter))
+	return columns, steps
+
+# Run the steps of a plan on the values read from its columns.
+def transformValues(steps, values):
+	newProps = {}
+	for name, positions, converter in steps:
+		if len(positions) == 1:
+			newProps[name] = converter(values[positions[0]])
+		else:
+			newProps[name] = converter(*[values[position] for position in positions])
+	return newProps
+
+# Convert one record read as a dictionary, compiling the plan for it on the spot.
+# Use compilePropPlan and transformValues when there are many records with the same header.
 def transformProps(propMetaDict, propValDict):
-	newProps = []
-	for propName in propValDict:
-		if propName in PROP_MAPPING:
-			newProps += PROP_MAPPING[propName]({
-				'meta': propMetaDict[propName],
-				'value': propValDict[propName],
-				'record': propValDict
-			})
-	return dict(newProps)
+	prop_names = propValDict.keys()
+	columns, steps = compilePropPlan(propMetaDict, prop_names)
+	return transformValues(steps, [float(propValDict[prop_names[index]]) for index in columns])
+
+# ----------------------------------------------------------------------
+# One parsed record.
+# Records are kept in memory by the thousands, so the times are stored as timestamps in seconds
+# and the geometry is the one shared by all the records of the station in STATION_GEOMETRY.
+# The GeoJSON feature with ISO time strings is only built by toGeoJSON(), when the record is uploaded.
+# The fields can also be read like dictionary keys, e.g. record['properties'].
+class DATRecord(object):
+	__slots__ = ('start_time', 'end_time', 'properties', 'geometry')
+
+	# @type {string}
+	type = 'Feature'
+
+	# @param {int} start_time  seconds since epoch
+	# @param {int} end_time  seconds since epoch
+	# @param {dict} properties
+	# @param {dict} geometry  Shared by all the records of the station, never modify it.
+	def __init__(self, start_time, end_time, properties, geometry):
+		self.start_time = start_time
+		self.end_time = end_time
+		self.properties = properties
+		self.geometry = geometry
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __repr__(self):
+		return 'DATRecord(%r, %r, %r)' % (self.start_time, self.end_time, self.properties)
+
+	# Build the GeoJSON feature of the record with the times rendered in the given timezone.
+	def toGeoJSON(self, tz):
+		return {
+			'start_time': TimeStamp2ISOTimeString(self.start_time, tz),
+			'end_time': TimeStamp2ISOTimeString(self.end_time, tz),
+			'properties': self.properties,
+			'type': self.type,
+			'geometry': self.geometry
+		}
 
 def parse_file_header_line(linestr):
 	return map(lambda x: json.loads(x), str(linestr).split(','))
 
 # ----------------------------------------------------------------------
-# Parse the CSV file and return a list of dictionaries.
+# Checksum of a row, saved with its offset to make sure the file still has the row there.
+def rowChecksum(line):
+	return zlib.crc32(line) & 0xffffffff
+
+# Find the offset of the first row after the given TOA5 time string.
+# The rows are sorted by time, so this is a binary search over the mapped file which only reads
+# the rows it probes. TOA5 time strings sort like the times they stand for, so they are compared as is.
+# @param {int} dataStart  Offset of the first row.
+def find_row_after(csvfile, dataStart, timeStr):
+	size = os.fstat(csvfile.fileno()).st_size
+	if size <= dataStart:
+		return size
+	mm = mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		# Offset of the first row starting at or after the given offset.
+		def rowStart(offset):
+			if offset <= dataStart:
+				return dataStart
+			newline = mm.find('\n', offset - 1)
+			return size if newline == -1 else newline + 1
+
+		def rowTime(start):
+			end = mm.find('\n', start)
+			line = mm[start:size if end == -1 else end]
+			return line.split(',', 1)[0].strip().strip('"')
+
+		low, high = dataStart, size
+		while low < high:
+			middle = (low + high) // 2
+			start = rowStart(middle)
+			if start >= size or rowTime(start) > timeStr:
+				high = middle
+			else:
+				low = middle + 1
+		return rowStart(low)
+	finally:
+		mm.close()
+
+# ----------------------------------------------------------------------
+# Parse the CSV file and return a list of DATRecords.
+# Each record starts at the time of the previous one, record times are timestamps in seconds.
 def parse_file(filepath, last_processed_time ,utc_offset = ISO_8601_UTC_MEAN):
+	return parse_file_incremental(filepath, last_processed_time, None, utc_offset)[0]
+
+# ----------------------------------------------------------------------
+# Parse the rows of the CSV file after the last processed one.
+# Returns the list of DATRecords and the resume position of the last row parsed, which should be
+# given back with its time for the next update of the file. The position is only trusted if the row
+# at its offset still has the same checksum, otherwise the row after last_processed_time is found
+# with find_row_after. Either way only the new rows are read.
+# @param {string} last_processed_time  ISO time string of the last processed row, 0 if there is none.
+# @param {dict} resume  {'offset': offset of the last processed row, 'checksum': rowChecksum of it}
+# @param {bool} complete_rows_only  Leave out a last line without a line break, which is still being written.
+def parse_file_incremental(filepath, last_processed_time, resume = None, utc_offset = ISO_8601_UTC_MEAN, complete_rows_only = False):
 	results = []
-	with open(filepath) as csvfile:
+	offset = utcOffsetSeconds(utc_offset)
+	with open(filepath, 'rb') as csvfile:
 		# First line is always the header.
 		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
 		header_lines = [
@@ -185,35 +352,46 @@ def parse_file(filepath, last_processed_time ,utc_offset = ISO_8601_UTC_MEAN):
 	
 		# move ahead to the last processed time if the file had been processed earlier
 		if(last_processed_time!=0):
-			timestamp = "0"
-			last_time = dateutil.parser.parse(last_processed_time).strftime('%Y-%m-%d %H:%M:%S')
-			while(timestamp!=last_time):
-				line = csvfile.readline().split(',')
-				timestamp = line[0][1:-1]
-			timestampPrev = last_processed_time
+			dataStart = csvfile.tell()
+			resumed = False
+			if resume != None:
+				csvfile.seek(resume['offset'])
+				resumed = rowChecksum(csvfile.readline()) == resume['checksum']
+			if not resumed:
+				last_time = dateutil.parser.parse(last_processed_time).strftime('%Y-%m-%d %H:%M:%S')
+				csvfile.seek(find_row_after(csvfile, dataStart, last_time))
+			timestampPrev = ISOTimeString2TimeStamp(last_processed_time)
 		else:
 			pos = csvfile.tell()
 			row = json.loads(csvfile.readline().split(',')[0])
 			csvfile.seek(pos)
-			timestampPrev = (datetime.datetime.strptime(row, '%Y-%m-%d %H:%M:%S')-datetime.timedelta(minutes=15)).isoformat()+ utc_offset.tzname(None)
+			timestampPrev = TOA5TimeString2TimeStamp(row) - offset - 15 * 60
 			
-			
-		reader = csv.DictReader(csvfile, fieldnames=prop_names)
- 
-		
-		for row in reader:
-			timestamp = datetime.datetime.strptime(row['TIMESTAMP'], '%Y-%m-%d %H:%M:%S').isoformat() + utc_offset.tzname(None) 		
-
-			newResult = {
-				# @type {string}
-				'start_time': timestampPrev,
-				# @type {string}
-				'end_time': timestamp,
-				'properties': transformProps(props, row),
-				# @type {string}
-				'type': 'Feature',
-				'geometry': STATION_GEOMETRY[station_name]
-			}
+		geometry = STATION_GEOMETRY[station_name]
+		# The header is compiled once, each row only reads the columns it needs.
+		columns, steps = compilePropPlan(props, prop_names)
+		timestampIndex = prop_names.index('TIMESTAMP')
+
+		# Lines are read one at a time to keep track of where the rows start.
+		lastLine = [None, None]
+		def lines():
+			lineStart = csvfile.tell()
+			for line in iter(csvfile.readline, ''):
+				if complete_rows_only and not line.endswith('\n'):
+					return
+				lastLine[0], lastLine[1] = line, lineStart
+				lineStart += len(line)
+				yield line
+
+		lastRow = None
+		for row in csv.reader(lines()):
+			# Skip blank lines like csv.DictReader does.
+			if not row:
+				continue
+			lastRow = tuple(lastLine)
+			timestamp = TOA5TimeString2TimeStamp(row[timestampIndex]) - offset
+
+			newResult = DATRecord(timestampPrev, timestamp, transformValues(steps, [float(row[index]) for index in columns]), geometry)
 			timestampPrev = timestamp
 			# Enable this if the raw data needs to be kept.
 # 			newResult['properties']['_raw'] = {
@@ -222,7 +400,46 @@ def parse_file(filepath, last_processed_time ,utc_offset = ISO_8601_UTC_MEAN):
 # 				'sample_method': prop_sample_method
 # 			}
 			results.append(newResult)
-	return results
+
+	if lastRow != None:
+		resume = {
+			'offset': lastRow[1],
+			'checksum': rowChecksum(lastRow[0])
+		}
+	return results, resume
+
+# ----------------------------------------------------------------------
+# Follow a logger file as rows are appended to it.
+# Each poll only parses the bytes appended since the last one, starting from the resume position
+# of parse_file_incremental, and a partial last line is left for the next poll.
+# If the file is replaced or truncated, the checksum of the last row won't match and the
+# position is found again from the last processed time.
+class FileFollower(object):
+	def __init__(self, filepath, last_processed_time = 0, resume = None, utc_offset = ISO_8601_UTC_MEAN):
+		self.filepath = filepath
+		self.last_processed_time = last_processed_time
+		self.resume = resume
+		self.utc_offset = utc_offset
+		# (inode, size, modification time) of the file when it was last parsed.
+		self.fileState = None
+
+	# Parse the rows appended since the last poll and return them as a list of DATRecords.
+	def poll(self):
+		try:
+			stat = os.stat(self.filepath)
+		except OSError:
+			# The file is being replaced, or not created yet.
+			return []
+		fileState = (stat.st_ino, stat.st_size, stat.st_mtime)
+		if fileState == self.fileState:
+			return []
+
+		records, self.resume = parse_file_incremental(self.filepath, self.last_processed_time, self.resume,
+													   self.utc_offset, complete_rows_only=True)
+		self.fileState = fileState
+		if records:
+			self.last_processed_time = TimeStamp2ISOTimeString(records[-1].end_time, self.utc_offset)
+		return records
 
 if __name__ == "__main__":
 	size = 5 * 60
@@ -231,4 +448,4 @@ if __name__ == "__main__":
 
 	file = './WeatherSE_Avg15.dat'
 	parse = parse_file(file, 0,tz)
-	print json.dumps(parse)
+	print json.dumps([record.toGeoJSON(tz) for record in parse])
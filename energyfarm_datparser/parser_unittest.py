@@ -0,0 +1,154 @@
+'''
+This is the unit test module for parser.py.
+It writes small energy farm logger files in a temporary directory and checks that
+parse_file_incremental only returns the rows after the last processed one, however
+the file changed since.
+
+To run the unit test, simply use:
+python parser_unittest.py
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dateutil.tz
+
+from parser import *
+
+UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+HEADER = [
+	'"TOA5","WeatherSE","CR1000","12345","CR1000.Std.29","CPU:energyfarm.CR1","1","Avg15"\n',
+	'"TIMESTAMP","RECORD","AirTC_Avg","RH1_Avg"\n',
+	'"TS","RN","Deg C","%"\n',
+	'"","","Avg","Avg"\n'
+]
+
+
+# The line of the row of the given index, one row every 15 minutes from midnight.
+def row_line(index):
+	return '"2017-04-01 %02d:%02d:00",%d,%.2f,%.1f\n' % (index / 4, index % 4 * 15, index, 20 + index * 0.25, 40 + index * 0.5)
+
+# The ISO time string of the row of the given index.
+def row_time(index):
+	return TimeStamp2ISOTimeString(TOA5TimeString2TimeStamp('2017-04-01 %02d:%02d:00' % (index / 4, index % 4 * 15))
+								   - utcOffsetSeconds(UTC_OFFSET), UTC_OFFSET)
+
+
+class parserUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+		self.filepath = os.path.join(self.workdir, 'WeatherSE_Avg15.dat')
+		self.write(xrange(8))
+
+	def write(self, rows, tail = ''):
+		with open(self.filepath, 'wb') as datfile:
+			datfile.writelines(HEADER + [row_line(index) for index in rows])
+			datfile.write(tail)
+
+	def append(self, rows, tail = ''):
+		with open(self.filepath, 'ab') as datfile:
+			datfile.writelines([row_line(index) for index in rows])
+			datfile.write(tail)
+
+	def parse(self, last_processed_time, resume = None, complete_rows_only = False):
+		return parse_file_incremental(self.filepath, last_processed_time, resume, UTC_OFFSET, complete_rows_only)
+
+	def assertRows(self, records, rows):
+		'''
+		The records should be the given rows, each starting at the end of the one before it
+		'''
+		self.assertEqual([TimeStamp2ISOTimeString(record.end_time, UTC_OFFSET) for record in records],
+						 [row_time(index) for index in rows])
+		self.assertEqual([record.properties['relative_humidity'] for record in records],
+						 [40 + index * 0.5 for index in rows])
+		for index in xrange(1, len(records)):
+			self.assertEqual(records[index].start_time, records[index - 1].end_time)
+
+	def test_resumeFromOffset(self):
+		'''
+		Rows appended after a parse should be read from the saved offset, starting at the last processed time
+		'''
+		records, resume = self.parse(0)
+		self.assertRows(records, xrange(8))
+		self.assertEqual(resume['offset'], sum(len(line) for line in HEADER) + sum(len(row_line(index)) for index in xrange(7)))
+
+		self.append(xrange(8, 12))
+		records, resume = self.parse(row_time(7), resume)
+		self.assertRows(records, xrange(8, 12))
+		self.assertEqual(TimeStamp2ISOTimeString(records[0].start_time, UTC_OFFSET), row_time(7))
+
+	def test_checksumMismatchFallsBackToTime(self):
+		'''
+		If the row at the saved offset changed, the rows after the last processed time should be found again
+		'''
+		records, resume = self.parse(0)
+		self.write(xrange(4, 12))
+		records, newResume = self.parse(row_time(7), resume)
+		self.assertRows(records, xrange(8, 12))
+		self.assertNotEqual(newResume['offset'], resume['offset'])
+
+		# An offset in the middle of a row can't match either.
+		records, resume = self.parse(row_time(9), {'offset': 5, 'checksum': 0})
+		self.assertRows(records, xrange(10, 12))
+
+	def test_truncatedFile(self):
+		'''
+		A file cut short before the saved offset should not fail, only the rows after the last processed time are new
+		'''
+		records, resume = self.parse(0)
+		self.write(xrange(3))
+		records, newResume = self.parse(row_time(7), resume)
+		self.assertEqual(records, [])
+		self.assertEqual(newResume, resume)
+
+		records, newResume = self.parse(row_time(1), resume)
+		self.assertRows(records, [2])
+
+	def test_partialLastLine(self):
+		'''
+		A last line still being written should be left for the next parse when only complete rows are asked for
+		'''
+		line = row_line(8)
+		self.append([], line[:12])
+		records, resume = self.parse(0, complete_rows_only=True)
+		self.assertRows(records, xrange(8))
+
+		self.append([], line[12:])
+		records, resume = self.parse(row_time(7), resume, complete_rows_only=True)
+		self.assertRows(records, [8])
+
+	def test_timePastTheEnd(self):
+		'''
+		A last processed time after the last row should give no records and keep the resume position
+		'''
+		records, resume = self.parse(row_time(20))
+		self.assertEqual(records, [])
+		self.assertEqual(resume, None)
+
+		with open(self.filepath, 'rb') as csvfile:
+			self.assertEqual(find_row_after(csvfile, sum(len(line) for line in HEADER), '2017-04-02 00:00:00'),
+							 os.path.getsize(self.filepath))
+
+	def test_noNewRows(self):
+		'''
+		Parsing the file again without new rows should give no records and the same resume position
+		'''
+		records, resume = self.parse(0)
+		records, newResume = self.parse(row_time(7), resume)
+		self.assertEqual(records, [])
+		self.assertEqual(newResume, resume)
+
+		# The same without the resume position.
+		records, newResume = self.parse(row_time(7))
+		self.assertEqual(records, [])
+
+	def tearDown(self):
+		shutil.rmtree(self.workdir)
+
+
+if __name__ == "__main__":
+	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(parserUnitTest))
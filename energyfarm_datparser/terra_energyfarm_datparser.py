@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
-import requests
 import logging
+from multiprocessing.pool import ThreadPool
 
 import datetime
 from dateutil.parser import parse
@@ -14,6 +14,8 @@ import pyclowder.datasets
 import pyclowder.geostreams
 
 from parser import *
+from geostreams_utils import DatapointUploader, get_sensor_id, get_stream_id
+from checkpoints import SQLiteCheckpointStore, ClowderCheckpointStore, MirroredCheckpointStore, StationLock, station_key
 
 
 class MetDATFileParser(Extractor):
@@ -23,6 +25,8 @@ class MetDATFileParser(Extractor):
 		# add any additional arguments to parser
 		# self.parser.add_argument('--max', '-m', type=int, nargs='?', default=-1,
 		#                          help='maximum number (default=-1)')
+		self.parser.add_argument('--batchSize', dest="batch_size", type=int, nargs='?',
+								 default=500, help="number of datapoints posted to geostreams per request")
 		self.parser.add_argument('--influxHost', dest="influx_host", type=str, nargs='?',
 								 default="terra-logging.ncsa.illinois.edu", help="InfluxDB URL for logging")
 		self.parser.add_argument('--influxPort', dest="influx_port", type=int, nargs='?',
@@ -33,6 +37,15 @@ class MetDATFileParser(Extractor):
 								 default="", help="InfluxDB password")
 		self.parser.add_argument('--influxDB', dest="influx_db", type=str, nargs='?',
 								 default="extractor_db", help="InfluxDB databast")
+		self.parser.add_argument('--checkpoints', dest="checkpoints", type=str, nargs='?',
+								 default="/home/extractor/data/checkpoints.sqlite",
+								 help="SQLite database where the extractor keeps how far it got in each file " +
+								 "(the Docker image keeps it in the /home/extractor/data volume)")
+		self.parser.add_argument('--mirrorCheckpoints', dest="mirror_checkpoints", action='store_true',
+								 help="also write the checkpoints to the metadata of the files on Clowder " +
+								 "(they are always read from there for the files missing from the SQLite database)")
+		# One connector per station by default, so the CEN, NE and SE files are processed at the same time.
+		self.parser.set_defaults(num=len(STATIONS))
 
 		# parse command line and load default logging configuration
 		self.setup()
@@ -42,21 +55,33 @@ class MetDATFileParser(Extractor):
 		logging.getLogger('__main__').setLevel(logging.DEBUG)
 
 		# assign other arguments
+		self.batch_size = self.args.batch_size
 		self.influx_host = self.args.influx_host
 		self.influx_port = self.args.influx_port
 		self.influx_user = self.args.influx_user
 		self.influx_pass = self.args.influx_pass
 		self.influx_db = self.args.influx_db
+		self.checkpoints = SQLiteCheckpointStore(self.args.checkpoints)
+		self.mirror_checkpoints = self.args.mirror_checkpoints
+		# Sensor and stream lookups run here while the file is parsed.
+		self.pool = ThreadPool(self.args.num)
+
+	def start(self):
+		try:
+			Extractor.start(self)
+		finally:
+			# The connectors are stopped, so no lookup is waiting for the pool any more.
+			self.pool.close()
+			self.pool.join()
 
 	def check_message(self, connector, host, secret_key, resource, parameters):
 		# Weather CEN_Avg15.dat, Weather CEN_DayAvg.dat
 		# WeatherNE_Avg15.dat,   WeatherNE_DayAvg.dat
 		# WeatherSE_Avg15.dat,   WeatherSE_DayAvg.dat
 		#   For now only handle the _Avg15 datasets.
-		target_files = ['CEN', 'NE', 'SE']
 		filename = resource['name']
 
-		for target_part in target_files:
+		for target_part in STATIONS:
 			if filename.startswith('Weather') and filename.endswith("_Avg15.dat") and target_part in filename:
 				return CheckMessage.download
 
@@ -72,90 +97,60 @@ class MetDATFileParser(Extractor):
 	
 		# Get input files
 		logger = logging.getLogger(__name__)
+		filename = resource['name']
+
+		# The lookups may take a few requests, let them run while the file is parsed.
+		stream_lookup = self.pool.apply_async(get_station_stream_id, (connector, host, secret_key, filename))
+
+		# Updates of the same station are processed one at a time, so they don't resume from the same checkpoint.
+		# The lock is shared with energyfarm_follow.py when it uses the same checkpoint database.
+		with StationLock(self.checkpoints.path, get_station_code(filename)):
+			self.process_station_file(connector, host, secret_key, resource, stream_lookup, ISO_8601_UTC_OFFSET)
+
+		endtime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+		self.logToInfluxDB(starttime, endtime, created_count, bytes)
+
+	# Parse the records added to the file since the last update, post them and save the new checkpoint.
+	def process_station_file(self, connector, host, secret_key, resource, stream_lookup, utc_offset):
 		inputfile = resource["local_paths"][0]
 		fileId = resource['id']
-		filename = resource['name']
 
-		sensor_name = 'UIUC Energy Farm - '
-		stream_name = 'Energy Farm Observations '
-
-		if 'CEN' in filename:
-			sensor_name+= 'CEN'
-			stream_name+= 'CEN'
-			main_coords = [-88.199801,40.062051,0]
-		elif 'NE' in filename:
-			sensor_name+= 'NE'
-			stream_name+= 'NE'
-			main_coords = [-88.193298,40.067379,0]
-		elif 'SE' in filename:
-			sensor_name+= 'SE'
-			stream_name+= 'SE'
-			main_coords = [-88.193573,40.056910,0]
-
-		sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, secret_key, sensor_name)
-		if not sensor_data:
-			sensor_id = pyclowder.geostreams.create_sensor(connector, host, secret_key, sensor_name, {
-					"type": "Point",
-					# These are a point off to the right of the field
-					"coordinates": main_coords
-				}, {
-					"id": "Met Station",
-					"title": "Met Station",
-					"sensorType": 4
-				}, "Urbana")
-		else:
-			sensor_id = sensor_data['id']
-
-		# Look for stream.
-		stream_data = pyclowder.geostreams.get_stream_by_name(connector, host, secret_key, stream_name)
-		if not stream_data:
-			stream_id = pyclowder.geostreams.create_stream(connector, host, secret_key, stream_name, sensor_id, {
-					"type": "Point",
-					"coordinates": [0,0,0]
-				})
-		else:
-			stream_id = stream_data['id']
-		
-		# Get metadata to check till what time the file was processed last. Start processing the file after this time
-		allmd = pyclowder.files.download_metadata(connector, host, secret_key, resource['id'])
-		last_processed_time = 0
-		datapoint_count = 0
-		for md in allmd:
-			if 'content' in md and 'last processed time' in md['content']:
-				last_processed_time = md['content']['last processed time']
-				if 'datapoints_created' in md['content']:
-					datapoint_count = md['content']['datapoints_created']
-				else:
-					datapoint_count = 0
-				delete_metadata(connector, host, secret_key, resource['id'], md['agent']['name'].split("/")[-1])
-
-		# Parse file and get all the records in it.
-		records = parse_file(inputfile, last_processed_time, utc_offset=ISO_8601_UTC_OFFSET)
+		# Check till what time the file was processed last. Start processing the file after this time
+		# A file missing from the local database, e.g. on the first run of a new container, carries on
+		# from the checkpoint in its metadata on Clowder, which is only updated with --mirrorCheckpoints.
+		checkpoints = MirroredCheckpointStore(self.checkpoints, ClowderCheckpointStore(connector, host, secret_key,
+												host + "/api/extractors/" + self.extractor_info['name']),
+											  writeMirror=self.mirror_checkpoints)
+		checkpoint = checkpoints.get(fileId) or {}
+		last_processed_time = checkpoint.get('last processed time', 0)
+		datapoint_count = checkpoint.get('datapoints_created', 0)
+		# Where the last processed row is in the file, so the next update can seek straight to it.
+		resume = None
+		if 'last processed offset' in checkpoint and 'last processed checksum' in checkpoint:
+			resume = {
+				'offset': checkpoint['last processed offset'],
+				'checksum': checkpoint['last processed checksum']
+			}
+
+		# Parse file and get the records added since the last update.
+		records, resume = parse_file_incremental(inputfile, last_processed_time, resume, utc_offset=utc_offset)
 		# Add props to each record.
 		for record in records:
-			record['properties']['source_file'] = fileId
-			record['stream_id'] = str(stream_id)
+			record.properties['source_file'] = fileId
 
-		for record in records:
-			pyclowder.geostreams.create_datapoint(connector, host, secret_key, stream_id, record['geometry'],
-												  record['start_time'], record['end_time'], record['properties'])
-
-		metadata = {
-			"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld"],
-			"dataset_id": resource['id'],
-			"content": {
-				"last processed time": records[-1]["end_time"],
-				"datapoints_created": datapoint_count + len(records)
-			},
-			"agent": {
-				"@type": "extractor",
-				"extractor_id": host + "/api/extractors/" + self.extractor_info['name']
-			}
-		}
-		pyclowder.files.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+		posted = post_station_records(connector, host, secret_key, self.checkpoints, get_station_code(resource['name']),
+									  stream_lookup.get(), records, utc_offset, self.batch_size)
 
-		endtime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-		self.logToInfluxDB(starttime, endtime, created_count, bytes)
+		if records:
+			last_processed_time = TimeStamp2ISOTimeString(records[-1].end_time, utc_offset)
+		content = {
+			"last processed time": last_processed_time,
+			"datapoints_created": datapoint_count + posted
+		}
+		if resume != None:
+			content["last processed offset"] = resume['offset']
+			content["last processed checksum"] = resume['checksum']
+		checkpoints.set(fileId, content)
 
 	def logToInfluxDB(self, starttime, endtime, filecount, bytecount):
 		# Time of the format "2017-02-10T16:09:57+00:00"
@@ -180,23 +175,67 @@ class MetDATFileParser(Extractor):
 		}], tags={"extractor": self.extractor_info['name'], "type": "bytes"})
 
 
-def delete_metadata(connector, host, key, fileid, extractor=None):
-    """Delete file JSON-LD metadata from Clowder.
-    Keyword arguments:
-    connector -- connector information, used to get missing parameters and send status updates
-    host -- the clowder host, including http and port, should end with a /
-    key -- the secret key to login to clowder
-    fileid -- the file to fetch metadata of
-    extractor -- extractor name to filter results (if only one extractor's metadata is desired)
-    """
-    filterstring = "" if extractor is None else "&extractor=%s" % extractor
-    url = '%sapi/files/%s/metadata.jsonld?key=%s%s' % (host, fileid, key, filterstring)
-    # fetch data
-    result = requests.delete(url, stream=True,
-                          verify=connector.ssl_verify)
-    result.raise_for_status()
-    return result.json()
-
+# Stations of the energy farm and the coordinates of each.
+STATIONS = ['CEN', 'NE', 'SE']
+STATION_COORDS = {
+	'CEN': [-88.199801,40.062051,0],
+	'NE': [-88.193298,40.067379,0],
+	'SE': [-88.193573,40.056910,0]
+}
+
+# Get the station of the given file, e.g. 'CEN' for "Weather CEN_Avg15.dat".
+def get_station_code(filename):
+	for station in STATIONS:
+		if station in filename:
+			return station
+
+# Get the sensor name, stream name and coordinates of the station of the given file.
+def get_station(filename):
+	station = get_station_code(filename)
+	return 'UIUC Energy Farm - ' + station, 'Energy Farm Observations ' + station, STATION_COORDS[station]
+
+# Get the ID of the stream of the station of the given file, creating the sensor and stream if needed.
+def get_station_stream_id(connector, host, secret_key, filename):
+	sensor_name, stream_name, main_coords = get_station(filename)
+
+	# Sensor and stream IDs are cached for the whole worker process.
+	sensor_id = get_sensor_id(connector, host, secret_key, sensor_name, {
+			"type": "Point",
+			# These are a point off to the right of the field
+			"coordinates": main_coords
+		}, {
+			"id": "Met Station",
+			"title": "Met Station",
+			"sensorType": 4
+		}, "Urbana")
+
+	# Look for stream.
+	return get_stream_id(connector, host, secret_key, stream_name, sensor_id, {
+			"type": "Point",
+			"coordinates": [0,0,0]
+		})
+
+# Post the records newer than the last row posted to the stream of the station, by the extractor
+# or by energyfarm_follow.py, and save the time of the last of them in the station checkpoint.
+# The caller holds the StationLock of the station. Returns the number of records posted.
+def post_station_records(connector, host, secret_key, checkpoints, station, stream_id, records, utc_offset, batch_size):
+	stationCheckpoint = checkpoints.get(station_key(station))
+	if stationCheckpoint != None:
+		lastPosted = ISOTimeString2TimeStamp(stationCheckpoint['last posted time'])
+		records = [record for record in records if record.end_time > lastPosted]
+	if not records:
+		return 0
+
+	with DatapointUploader(connector, host, secret_key, batch_size=batch_size) as uploader:
+		for record in records:
+			# Times are only rendered as ISO strings for the upload.
+			feature = record.toGeoJSON(utc_offset)
+			uploader.add(stream_id, feature['geometry'], feature['start_time'], feature['end_time'], feature['properties'])
+
+	checkpoints.set(station_key(station), {
+		"last posted time": TimeStamp2ISOTimeString(records[-1].end_time, utc_offset)
+	})
+	return len(records)
 
 if __name__ == "__main__":
 	extractor = MetDATFileParser()
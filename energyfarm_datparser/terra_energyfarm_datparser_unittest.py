@@ -0,0 +1,183 @@
+'''
+This is the unit test module for terra_energyfarm_datparser.py.
+It runs the extractor on energy farm logger files written in a temporary directory, with the
+Clowder checkpoints kept in memory and the datapoints collected instead of posted, so no Clowder
+instance is needed. Messages are processed from several threads at once, like the connectors do.
+
+To run the unit test, simply use:
+python terra_energyfarm_datparser_unittest.py
+'''
+
+import multiprocessing.pool
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import terra_energyfarm_datparser
+from parser_unittest import HEADER, row_line
+
+HOST = 'http://clowder.test/'
+
+# Seconds a station waits in post_station_records for another one to post at the same time.
+OVERLAP_TIMEOUT = 1.0
+
+
+class MemoryCheckpointStore(object):
+	'''
+	Keeps the checkpoints in a dictionary, in place of the Clowder store.
+	'''
+
+	def __init__(self, *args):
+		self.checkpoints = {}
+
+	def get(self, fileId):
+		return self.checkpoints.get(fileId)
+
+	def set(self, fileId, checkpoint):
+		self.checkpoints[fileId] = checkpoint
+
+
+class FakeUploader(object):
+	'''
+	Collects the datapoints the extractor adds, in place of the geostreams uploader.
+	'''
+
+	def __init__(self, datapoints):
+		self.datapoints = datapoints
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+	def add(self, stream_id, geom, start_time, end_time, properties):
+		self.datapoints.append((stream_id, end_time))
+
+
+class terraEnergyfarmDatparserUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.workdir = tempfile.mkdtemp()
+
+		# The extractor reads its arguments and extractor_info.json as if it was started from its directory.
+		argv = sys.argv
+		sys.argv = [os.path.abspath(terra_energyfarm_datparser.__file__),
+					'--checkpoints', os.path.join(self.workdir, 'checkpoints.sqlite')]
+		try:
+			self.extractor = terra_energyfarm_datparser.MetDATFileParser()
+		finally:
+			sys.argv = argv
+		self.extractor.logToInfluxDB = lambda *args: None
+
+		self.datapoints = []
+		# Number of post_station_records calls running now, and the most that ran at once.
+		self.condition = threading.Condition()
+		self.posting = 0
+		self.mostPosting = 0
+
+		self.patched = [
+			(terra_energyfarm_datparser, 'ClowderCheckpointStore', MemoryCheckpointStore),
+			(terra_energyfarm_datparser, 'get_station_stream_id', lambda connector, host, key, filename:
+				'stream-' + terra_energyfarm_datparser.get_station_code(filename)),
+			(terra_energyfarm_datparser, 'DatapointUploader', lambda *args, **kwargs: FakeUploader(self.datapoints)),
+			(terra_energyfarm_datparser, 'post_station_records', self.post_station_records)
+		]
+		for module, name, value in self.patched:
+			setattr(self, '_original_' + name, getattr(module, name))
+			setattr(module, name, value)
+
+	def tearDown(self):
+		for module, name, value in self.patched:
+			setattr(module, name, getattr(self, '_original_' + name))
+		self.extractor.pool.terminate()
+		self.extractor.checkpoints.close()
+		shutil.rmtree(self.workdir)
+
+	def post_station_records(self, *args):
+		'''
+		Post the records like the extractor does, after waiting up to OVERLAP_TIMEOUT for another
+		message to get here too, so messages that can run at the same time do
+		'''
+		with self.condition:
+			self.posting += 1
+			self.mostPosting = max(self.mostPosting, self.posting)
+			self.condition.notify_all()
+			if self.posting < 2:
+				self.condition.wait(OVERLAP_TIMEOUT)
+		try:
+			return self._original_post_station_records(*args)
+		finally:
+			with self.condition:
+				self.posting -= 1
+
+	def write(self, filename, rows):
+		filepath = os.path.join(self.workdir, filename)
+		with open(filepath, 'wb') as datfile:
+			datfile.writelines(HEADER + [row_line(index) for index in rows])
+		return filepath
+
+	def process(self, resources):
+		'''
+		Process a message for each of the given resources, each in a thread of its own like the connectors
+		'''
+		errors = []
+
+		def process(resource):
+			try:
+				self.extractor.process_message(None, HOST, 'key', resource, {})
+			except Exception as error:
+				errors.append(error)
+
+		threads = [threading.Thread(target=process, args=(resource,)) for resource in resources]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(errors, [])
+
+	def resource(self, fileId, filename, rows):
+		return {'id': fileId, 'name': filename, 'local_paths': [self.write(filename, rows)]}
+
+	def test_stationsRunInParallel(self):
+		'''
+		Messages of different stations should post their records at the same time,
+		each to the stream of its station
+		'''
+		self.assertEqual(self.extractor.args.num, len(terra_energyfarm_datparser.STATIONS))
+
+		self.process([self.resource('file-ne', 'WeatherNE_Avg15.dat', xrange(8)),
+					  self.resource('file-se', 'WeatherSE_Avg15.dat', xrange(8))])
+
+		self.assertEqual(self.mostPosting, 2)
+		for stream in ['stream-NE', 'stream-SE']:
+			self.assertEqual(len([datapoint for datapoint in self.datapoints if datapoint[0] == stream]), 8)
+
+	def test_stationUpdatesRunOneAfterTheOther(self):
+		'''
+		Two updates of the same station should post one after the other, the second resuming from
+		the checkpoint of the first, so every record is posted once
+		'''
+		resource = self.resource('file-se', 'WeatherSE_Avg15.dat', xrange(8))
+		self.process([resource, dict(resource)])
+
+		self.assertEqual(self.mostPosting, 1)
+		self.assertEqual(len(self.datapoints), 8)
+		self.assertEqual(len(set(self.datapoints)), 8)
+
+	def test_poolClosedOnExit(self):
+		'''
+		The lookup pool should be shut down, its threads finished, once the extractor stops
+		'''
+		self.extractor.args.num = 0
+		self.extractor.start()
+
+		self.assertEqual(self.extractor.pool._state, multiprocessing.pool.CLOSE)
+		self.assertFalse([worker for worker in self.extractor.pool._pool if worker.is_alive()])
+
+
+if __name__ == "__main__":
+	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(terraEnergyfarmDatparserUnitTest))
@@ -1,6 +1,6 @@
 import numpy as np
 
-__all__ = ["AREA", "FLX_SNS", "calculateDownwellingSpectralFlux"]
+__all__ = ["AREA", "FLX_SNS", "calculateDownwellingSpectralFlux", "spectralFluxCalibration"]
 
 #Fibre optic collection surface area is pi * (fiber diameter squared) / 4
 AREA = np.pi * (3900.0 * 1.0e-6) ** 2 / 4.0  # [m2]
@@ -255,13 +255,36 @@ DARK_MEASUREMENTS = \
      1500, 1501, 1499, 1500, 1501, 1500, 1500, 1500, 1499, 1502, 1500, 1499, 1502, 1502, 1500, 1498, 1500, 1501, 1500, 1499, 1500, 1500, 1502, 1499, 
      1499, 1500, 1502, 1499, 1497, 1501, 1501, 1501, 1497, 1499, 1502, 1501, 1497, 1499, 1500, 1500]
 
+# Spectrometer integration time
+SPECTROMETER_INTEGRATION_TIME = 5000.0 * 1.0e-6 # [s]
+
+# (delta, integration time) -> float32 calibration vector, the wavelengths are the same in every file
+_CALIBRATIONS = {}
+
+# Dark reference as float32, subtracted from every spectrum
+_DARK_MEASUREMENTS = np.array(DARK_MEASUREMENTS, dtype=np.float32)
+
+def spectralFluxCalibration(delta, integrationTime=SPECTROMETER_INTEGRATION_TIME):
+    '''
+    Return the per-wavelength factor that turns dark corrected counts into downwelling spectral flux,
+    FLX_SNS * 1e-6 / delta / AREA / T, folded into one float32 vector so the spectrum is only scaled once.
+    The vector is computed once for each delta and integration time, and must not be modified.
+    '''
+    key = (tuple(delta), integrationTime)
+    if key not in _CALIBRATIONS:
+        calibration = np.array(FLX_SNS) * 1.0e-6 / np.asarray(delta, dtype=np.float64) / AREA / integrationTime # [J cnt-1 m-1 m-2 s-1]
+        _CALIBRATIONS[key] = calibration.astype(np.float32)
+    return _CALIBRATIONS[key]
+
 def calculateDownwellingSpectralFlux(wvl_lgr, spectrum, delta):
     '''
     This function will calculate the downwelling spectral flux.
     A desired type for wvl_lgr would be a single 1D list, and spectrum
-    should be a nested 2D list. The area for spectrometer and integration
+    should be a 2D (time, wavelength) array, preferably float32. The area for spectrometer and integration
     time are default.
 
+    The flux is computed in place in a new float32 array of the shape of the spectrum, the spectrum is left as it is.
+
     This function is based on the following algorithm, provided by Solmaz in 
     https://github.com/terraref/reference-data/issues/30#issuecomment-253000597
 
@@ -271,7 +294,7 @@ def calculateDownwellingSpectralFlux(wvl_lgr, spectrum, delta):
     Here:
     **Denominator**
     AREA                          -> the area of the sensor (A above)
-    Spectrometer_Integration_Time -> integartion time (5000us, T above)
+    SPECTROMETER_INTEGRATION_TIME -> integartion time (5000us, T above)
     delta                         -> The wavelength spread (dL above)
 
     **Numerator**
@@ -281,9 +304,6 @@ def calculateDownwellingSpectralFlux(wvl_lgr, spectrum, delta):
     '''
 
 
-    Spectrometer_Integration_Time_In_Microseconds = 5000.0 # [us]
-    Spectrometer_Integration_Time                 = Spectrometer_Integration_Time_In_Microseconds * 1.0e-6 # [s]
-
     # wvl_ntf  = [np.average([wvl_lgr[i], wvl_lgr[i+1]]) for i in range(len(wvl_lgr)-1)]
     # delta    = [wvl_ntf[i+1] - wvl_ntf[i] for i in range(len(wvl_ntf) - 1)]
     # delta.insert(0,  2*(wvl_ntf[0]  - wvl_lgr[0]))
@@ -293,9 +313,13 @@ def calculateDownwellingSpectralFlux(wvl_lgr, spectrum, delta):
 
     # General formula used in calculating downwelling spectral flux:
     # Downwelling Spectral Flux = (spectrum [cnt] - dark [cnt]) * flx_sns [J cnt-1]  / bandwidth [m] / area [m2] / time [s]
-    downwellingSpectralFlux = np.array(FLX_SNS) * 1.0e-6 * (np.array(spectrum) - np.array(DARK_MEASUREMENTS)) / np.array(delta) / AREA / Spectrometer_Integration_Time # [J m-2 m-1 s-1] = [W m-2 m-1]
+    # Both steps write into the same array, no full size temporary is allocated.
+    spectrum                = np.asarray(spectrum, dtype=np.float32)
+    downwellingSpectralFlux = np.empty(spectrum.shape, dtype=np.float32)
+    np.subtract(spectrum, _DARK_MEASUREMENTS, out=downwellingSpectralFlux)
+    downwellingSpectralFlux *= spectralFluxCalibration(delta) # [J m-2 m-1 s-1] = [W m-2 m-1]
 
     # downwellingFlux is the summation (integration) of downwelling flux
-    downwellingFlux = np.sum(downwellingSpectralFlux)
+    downwellingFlux = np.sum(downwellingSpectralFlux, dtype=np.float64)
 
     return downwellingSpectralFlux, downwellingFlux  
\ No newline at end of file
@@ -55,6 +55,11 @@ If the output folder does not exist, environmental_logger_json2netcdf.py creates
           2. Reinstate the integration time and sensor area (based on the discussion about the dimension of the flux sensitivity)
           3. Clean up based on Professor Zender's adjustment
 20160526: All units are now in SI
+20170601: 1. The JSON file is read one reading at a time and the spectrum goes straight into a 2D array,
+             instead of loading the whole file and all its spectrum lists at once
+          2. Each reading is transposed into one array per field in a single pass, see EnvironmentLoggerColumns
+          3. The spectrum is kept as float32 and the downwelling spectral flux is computed in a single float32 array,
+             with the calibration vector computed once
 
 ----------------------------------------------------------------------------------------
 Note:
@@ -112,6 +117,12 @@ _NAMES = {'airPressure'  : 'Atmospheric Air Pressure',
 
 _UNIX_BASETIME = date(year=1970, month=1, day=1)
 
+# Bytes read from the JSON file at a time by the incremental reader.
+_CHUNK_SIZE = 1 << 20
+
+# Characters a JSON number can go on with. The empty string is in it too, for the end of the buffer.
+_NUMBER_CHARACTERS = '0123456789.eE+-'
+
 def JSONHandler(fileLocation):
     '''
     Main JSON handler, write JSON file to a Python list with standard JSON module
@@ -120,6 +131,204 @@ def JSONHandler(fileLocation):
         return json.loads(fileHandler.read())
 
 
+class JSONStream(object):
+    '''
+    Decode the values of a JSON document one at a time, reading more of the file only when
+    the next value is not complete yet. Only the current chunk and the value being decoded
+    are in memory, never the whole document.
+    '''
+
+    def __init__(self, fileHandler, chunkSize=_CHUNK_SIZE):
+        self.fileHandler = fileHandler
+        self.chunkSize   = chunkSize
+        self.decoder     = json.JSONDecoder()
+        self.buffer      = ''
+        self.position    = 0
+        self.eof         = False
+
+    def read(self, size=None):
+        '''
+        Drop what was decoded already and append the next chunk of the file
+        '''
+        data = self.fileHandler.read(size or self.chunkSize)
+        if not data:
+            self.eof = True
+        self.buffer   = self.buffer[self.position:] + data
+        self.position = 0
+
+    def peek(self):
+        '''
+        Skip the whitespace and return the next character, or '' at the end of the file
+        '''
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position:self.position + 1]
+            self.read()
+
+    def expect(self, characters):
+        '''
+        Consume the next character, which has to be one of the given ones, and return it
+        '''
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of %s but found %r" % (", ".join(characters), character))
+        self.position += 1
+        return character
+
+    def value(self):
+        '''
+        Decode the next value
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the end of the buffer may go on in the next chunk, and so may one followed by
+                # what could be the start of its fraction or exponent, "337." or "1e" decode as 337 and 1.
+                if self.eof or self.buffer[end:end + 1] not in _NUMBER_CHARACTERS:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # Read at least as much again as the value so far, so a value larger than a chunk isn't decoded over and over.
+            self.read(max(self.chunkSize, len(self.buffer) - self.position))
+
+    def members(self):
+        '''
+        Iterate over the keys of the object that starts here, the caller decodes the value of each
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.expect('}')
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def items(self):
+        '''
+        Iterate over the values of the array that starts here, decoding one at a time
+        '''
+        self.expect('[')
+        if self.peek() == ']':
+            self.expect(']')
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class GrowingArray(object):
+    '''
+    Preallocated NumPy array filled one row at a time, doubling its capacity when it is full
+    '''
+
+    def __init__(self, capacity, rowShape=(), dtype=np.float64):
+        self.data  = np.empty((max(capacity, 1),) + tuple(rowShape), dtype=dtype)
+        self.count = 0
+
+    def append(self, row):
+        if self.count == len(self.data):
+            grown = np.empty((2 * len(self.data),) + self.data.shape[1:], dtype=self.data.dtype)
+            grown[:self.count] = self.data
+            self.data = grown
+        self.data[self.count] = row
+        self.count += 1
+
+    def values(self):
+        return self.data[:self.count]
+
+
+class EnvironmentLoggerColumns(object):
+    '''
+    The readings of an environmental logger file transposed into one preallocated array per field.
+    Each reading is visited once, by append(), which writes every one of its fields to its column.
+    The names, units and wavelengths come from the first reading, they are the same in all of them.
+    '''
+
+    def __init__(self, firstReading, capacity, fixedInfos=None):
+        spectrometer = firstReading["spectrometer"]
+
+        self.fixedInfos          = fixedInfos
+        self.wavelength          = spectrometer["wavelength"]
+        self.integrationTime     = float(spectrometer["integration time in us"])
+        self.weatherStationNames = list(firstReading["weather_station"])
+        self.sensorNames         = [data for data in firstReading if data.startswith("sensor")]
+        self.units               = dict([(data, _UNIT_DICTIONARY[firstReading["weather_station"][data]['unit']])
+                                         for data in self.weatherStationNames] +
+                                        [(data, _UNIT_DICTIONARY[firstReading[data]['unit']])
+                                         for data in self.sensorNames])
+
+        self.time              = GrowingArray(capacity)
+        self.maxFixedIntensity = GrowingArray(capacity)
+        # The counts fit in float32 exactly, and the spectrum is written as f4 anyway.
+        self.spectrum          = GrowingArray(capacity, (len(self.wavelength),), np.float32)
+        self.values            = dict((data, GrowingArray(capacity)) for data in self.units)
+        self.rawValues         = dict((data, GrowingArray(capacity)) for data in self.units)
+
+    def append(self, reading):
+        self.time.append(translateTime(reading["timestamp"]))
+        self.maxFixedIntensity.append(float(reading["spectrometer"]["maxFixedIntensity"]))
+        self.spectrum.append(reading["spectrometer"]["spectrum"])
+
+        for data in self.weatherStationNames:
+            member = reading["weather_station"][data]
+            self.values[data].append(float(member['value']))
+            self.rawValues[data].append(float(member['rawValue']))
+        for data in self.sensorNames:
+            member = reading[data]
+            self.values[data].append(float(member['value']))
+            self.rawValues[data].append(float(member['rawValue']))
+
+    def getValue(self, data):
+        '''
+        Return the values in SI, the SI unit and the raw values of a weather station or "sensor" variable
+        '''
+        converting_to = self.units[data]
+        return self.values[data].values() * converting_to["power"], converting_to["SI"], self.rawValues[data].values()
+
+
+def readEnvironmentLogger(fileLocation, chunkSize=_CHUNK_SIZE):
+    '''
+    Incremental JSON handler, read the environmental logger JSON file one reading at a time
+    and write each reading straight into EnvironmentLoggerColumns, which is returned.
+    '''
+    fixedInfos, columns = None, None
+
+    with open(fileLocation, 'r') as fileHandler:
+        fileSize = os.fstat(fileHandler.fileno()).st_size
+        stream   = JSONStream(fileHandler, chunkSize)
+
+        for key in stream.members():
+            if key == "environment_sensor_fixed_infos":
+                fixedInfos = stream.value()
+            elif key == "environment_sensor_readings":
+                for reading in stream.items():
+                    if columns is None:
+                        # The readings are about the same size, so the file size tells about how many there are.
+                        readingSize = len(json.dumps(reading, separators=(',', ':')))
+                        columns     = EnvironmentLoggerColumns(reading, fileSize // readingSize + 1)
+                    columns.append(reading)
+            else:
+                stream.value()
+
+        # Only whitespace may follow the object, json.load refuses anything else too.
+        if stream.peek():
+            raise ValueError("Extra data after the end of %s" % fileLocation)
+
+    if columns is None:
+        raise ValueError("%s has no environment sensor readings" % fileLocation)
+    columns.fixedInfos = fixedInfos
+    return columns
+
+
 def renameTheValue(name):
     '''
     Rename the value so they are legal in netCDF
@@ -151,56 +360,6 @@ def getSpectrometerInformation(arrayOfJSON):
     return maxFixedIntensity, integrationTime
 
 
-def getListOfWeatherStationValue(arrayOfJSON, dataName):
-    '''
-    Collect data from weather station objects which have "value" member
-    these data are:
-    1. values
-    2. units
-    3. raw values
-    '''
-    converting_to = _UNIT_DICTIONARY[arrayOfJSON[0]["weather_station"][dataName]['unit']]
-    
-    return np.array([float(valueMembers["weather_station"][dataName]['value'])\
-            for valueMembers in arrayOfJSON])*converting_to["power"],\
-           [converting_to["SI"]\
-            for valueMembers in arrayOfJSON],\
-           [float(valueMembers["weather_station"][dataName]['rawValue'])\
-            for valueMembers in arrayOfJSON] 
-
-
-def handleSpectrometer(JSONArray):
-    '''
-    This function will return the wavelength (1D array), spectrum (2D array) and maxFixedIntensity (1D array) in spectrometer readings
-    '''
-
-    wvl_lgr           = JSONArray[0]["spectrometer"]["wavelength"]
-    spectrum          = [valueMembers["spectrometer"]["spectrum"]\
-                         for valueMembers in JSONArray]
-    maxFixedIntensity = [float(valueMembers["spectrometer"]["maxFixedIntensity"])\
-                         for valueMembers in JSONArray]
-
-    return wvl_lgr, spectrum, maxFixedIntensity
-
-
-def sensorVariables(JSONArray, sensors):
-    '''
-    return the variables start with "sensor"
-    these are:
-    1. values
-    2. units
-    3. raw values
-    '''
-    converting_to = _UNIT_DICTIONARY[JSONArray[0][sensors]['unit']]
-
-    return np.array([float(valueMembers[sensors]['value'])
-            for valueMembers in JSONArray])*converting_to["power"],\
-           [converting_to["SI"]
-            for valueMembers in JSONArray],\
-           [float(valueMembers[sensors]['rawValue'])
-            for valueMembers in JSONArray]
-
-
 def translateTime(timeString):
     '''
     Translate the time the metadata included as the days offset to the basetime.
@@ -211,13 +370,12 @@ def translateTime(timeString):
     return (timeSplit.total_seconds() + timeUnpack.tm_hour * 3600.0 + timeUnpack.tm_min * 60.0 + timeUnpack.tm_sec) / (3600.0 * 24.0)
 
 
-def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=None, downwellingSpectralFlux=None, commandLine=None):
+def main(columns, outputFileType, outputFileName, commandLine=None):
     '''
-    Main netCDF handler, write data to the netCDF file indicated.
+    Main netCDF handler, write the readings transposed into EnvironmentLoggerColumns to the netCDF file indicated.
     '''
     with Dataset(outputFileName, 'w', format=outputFileType) as netCDFHandler:
-        loggerFixedInfos = JSONArray["environment_sensor_fixed_infos"]
-        loggerReadings   = JSONArray["environment_sensor_readings"]
+        loggerFixedInfos = columns.fixedInfos
 
         # for infos, atttributes in loggerFixedInfos.items():
         #     # infosGroup = netCDFHandler.createGroup(infos)
@@ -277,14 +435,14 @@ def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=No
             setattr(sensor_par_var, "sensor_par_"+key, value)
 
 
-        for data in loggerReadings[0]["weather_station"]: #writing the data from weather station
-            value, unit, rawValue           = getListOfWeatherStationValue(loggerReadings, data)
+        for data in columns.weatherStationNames: #writing the data from weather station
+            value, unit, rawValue           = columns.getValue(data)
             valueVariable, rawValueVariable = netCDFHandler.createVariable(data, "f4", ("time", )),\
                                               netCDFHandler.createVariable("".join(("raw_",data)), "f4", ("time", ))
                 
             valueVariable[:]    = value
             rawValueVariable[:] = rawValue
-            setattr(valueVariable, "units", unit[0])
+            setattr(valueVariable, "units", unit)
 
             setattr(valueVariable, "sensor", 'sensor_weather_station')
             if data in _CF_STANDARDS:
@@ -294,7 +452,8 @@ def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=No
             if data == "relHumidity":
                 setattr(valueVariable, "description", "Ratio of partial pressure of water vapor to equilibrium vapor pressure at measured temperature")
 
-        wvl_lgr, spectrum, maxFixedIntensity = handleSpectrometer(loggerReadings) #writing the data from spectrometer
+        #writing the data from spectrometer
+        wvl_lgr, spectrum, maxFixedIntensity = columns.wavelength, columns.spectrum.values(), columns.maxFixedIntensity.values()
 
         netCDFHandler.createDimension("wvl_lgr", len(wvl_lgr))
         wavelengthVariable = netCDFHandler.createVariable("wvl_lgr", "f4", ("wvl_lgr",))
@@ -323,33 +482,32 @@ def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=No
         setattr(intensityVariable, "notes", "maximum_fix_intensity (always equals to 2^14-1=16383)")
 
         timeVariable = netCDFHandler.createVariable("time", 'f8', ('time',))
-        timeVariable[:] = [translateTime(data["timestamp"]) for data in loggerReadings]
+        timeVariable[:] = columns.time.values()
         setattr(timeVariable, "units",    "days since 1970-01-01 00:00:00")
         setattr(timeVariable, "long_name", "Time")
         setattr(timeVariable, "calender", "gregorian")
 
-        for data in loggerReadings[0]:
-            if data.startswith("sensor"): # par sensor or co2 sensor
+        for data in columns.sensorNames: # par sensor or co2 sensor
 
-                sensorValue, sensorUnit, sensorRaw = sensorVariables(loggerReadings, data)
-                sensorValueVariable                = netCDFHandler.createVariable(renameTheValue(data),                    "f4", ("time", ))
-                sensorRawValueVariable             = netCDFHandler.createVariable("".join(("raw_", renameTheValue(data))), "f4", ("time", ))
+            sensorValue, sensorUnit, sensorRaw = columns.getValue(data)
+            sensorValueVariable                = netCDFHandler.createVariable(renameTheValue(data),                    "f4", ("time", ))
+            sensorRawValueVariable             = netCDFHandler.createVariable("".join(("raw_", renameTheValue(data))), "f4", ("time", ))
 
-                sensorValueVariable[:]    = sensorValue
-                sensorRawValueVariable[:] = sensorRaw
-                setattr(sensorValueVariable, "units", sensorUnit[0])
-                if data.endswith("co2"):
-                    setattr(sensorValueVariable, "sensor", 'sensor_co2')
-                else:
-                    setattr(sensorValueVariable, "sensor", 'sensor_par')
+            sensorValueVariable[:]    = sensorValue
+            sensorRawValueVariable[:] = sensorRaw
+            setattr(sensorValueVariable, "units", sensorUnit)
+            if data.endswith("co2"):
+                setattr(sensorValueVariable, "sensor", 'sensor_co2')
+            else:
+                setattr(sensorValueVariable, "sensor", 'sensor_par')
 
-                if renameTheValue(data) in _CF_STANDARDS:
-                    setattr(sensorValueVariable, "standard_name", _CF_STANDARDS[renameTheValue(data)])
-                
-                if renameTheValue(data) == 'Photosynthetically_Active_Radiation':
-                    setattr(sensorValueVariable, "long_name", "Photosynthetically Active Radiation")
-                else:
-                    setattr(sensorValueVariable, "long_name", "Atmosperic CO2 Concentration")
+            if renameTheValue(data) in _CF_STANDARDS:
+                setattr(sensorValueVariable, "standard_name", _CF_STANDARDS[renameTheValue(data)])
+            
+            if renameTheValue(data) == 'Photosynthetically_Active_Radiation':
+                setattr(sensorValueVariable, "long_name", "Photosynthetically Active Radiation")
+            else:
+                setattr(sensorValueVariable, "long_name", "Atmosperic CO2 Concentration")
 
         wvl_ntf  = [np.average([wvl_lgr[i], wvl_lgr[i+1]]) for i in range(len(wvl_lgr)-1)]
         delta    = [wvl_ntf[i+1] - wvl_ntf[i] for i in range(len(wvl_ntf) - 1)]
@@ -358,6 +516,7 @@ def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=No
 
         # Downwelling Flux = summation of (delta lambda(_wvl_dlt) * downwellingSpectralFlux)
         # Details in CalculationWorks.py
+        # The flux gets a float32 array of its own, columns.spectrum is left as read.
         downwellingSpectralFlux, downwellingFlux = calculateDownwellingSpectralFlux(wvl_lgr, spectrum, delta)
 
         # Add data from hyperspectral_calibration.nco
@@ -384,7 +543,7 @@ def main(JSONArray, outputFileType, outputFileName, wavelength=None, spectrum=No
 
         # #Other Constants used in calculation
         # #Integration Time
-        netCDFHandler.createVariable("time_integration", 'f4')[...] = float(loggerReadings[0]["spectrometer"]["integration time in us"]) / 1.0e-6
+        netCDFHandler.createVariable("time_integration", 'f4')[...] = columns.integrationTime / 1.0e-6
         setattr(netCDFHandler.variables["time_integration"], "units", "second")
         setattr(netCDFHandler.variables['time_integration'], 'long_name', 'Spectrometer Integration Time')
 
@@ -407,22 +566,22 @@ def mainProgramTrigger(fileInputLocation, fileOutputLocation, fileType="NETCDF4"
 
     if not os.path.isdir(fileInputLocation) or fileOutputLocation.endswith('.nc'):
         print "\nProcessing", "".join((fileInputLocation, '....')),"\n", "-" * (len(fileInputLocation) + 15)
-        tempJSONMasterList = JSONHandler(fileInputLocation)
+        loggerColumns = readEnvironmentLogger(fileInputLocation)
         if not os.path.isdir(fileOutputLocation):
-            main(tempJSONMasterList, fileType, fileOutputLocation, commandLine=" ".join(sys.argv))
+            main(loggerColumns, fileType, fileOutputLocation, commandLine=" ".join(sys.argv))
         else:
             outputFileName = os.path.split(fileInputLocation)[-1]
             print "Exported to", fileOutputLocation, "\n", "-" * (len(fileInputLocation) + 15)
-            main(tempJSONMasterList, fileType, os.path.join(fileOutputLocation,  "".join((outputFileName.strip('.json'), '.nc'))),commandLine=" ".join(sys.argv))
+            main(loggerColumns, fileType, os.path.join(fileOutputLocation,  "".join((outputFileName.strip('.json'), '.nc'))), commandLine=" ".join(sys.argv))
     else:    
         for filePath, fileDirectory, fileName in os.walk(fileInputLocation):
             for members in fileName:
                 if os.path.join(filePath, members).endswith('.json'):
                     print "\nProcessing", "".join((members, '....')),"\n","-" * (len(members) + 15)
                     outputFileName = "".join((members.strip('.json'), '.nc'))
-                    tempJSONMasterList = JSONHandler(os.path.join(filePath, members))
+                    loggerColumns = readEnvironmentLogger(os.path.join(filePath, members))
                     print "Exported to", str(os.path.join(fileOutputLocation, outputFileName)), "\n", "-" * (len(fileInputLocation) + 15)
-                    main(tempJSONMasterList, fileType, os.path.join(fileOutputLocation, outputFileName), commandLine=" ".join(sys.argv))
+                    main(loggerColumns, fileType, os.path.join(fileOutputLocation, outputFileName), commandLine=" ".join(sys.argv))
     
     endPoint = time.clock()
     print "Done. Execution time: {:.3f} seconds\n".format(endPoint-startPoint)
@@ -1,5 +1,5 @@
 '''
-This is the unit test module for environmental_logger_json2netcdf.py.
+This is the unit test module for environmental_logger_json2netcdf.py and environmental_logger_calculation.py.
 It will test whether the environmental_logger_json2netcdf.py works 
 appropriately and the validity of the imported JSON.
 
@@ -7,23 +7,135 @@ This module will run isolated, so there's no include dependency
 to other files, but make sure it is in the same location as environmental_logger_json2netcdf
 
 Before running this module, make sure you have passed
-it a valid JSON, or all the test will be skipped
+it a valid JSON, or all the tests of JSONHandler will be skipped.
+The tests of readEnvironmentLogger write their own JSON files.
 
 To run the unit test, simply use:
 python environmental_logger_unittest.py <testing JSON location>
 '''
 
 import unittest
+import tempfile
 import sys
 from environmental_logger_json2netcdf import *
+from environmental_logger_json2netcdf import _UNIT_DICTIONARY
+from environmental_logger_calculation import DARK_MEASUREMENTS
 
-fileLocation = sys.argv[1]
+fileLocation = sys.argv[1] if len(sys.argv) > 1 else ""
+
+# (name, unit) of the weather station variables in the generated readings
+WEATHER_STATION = [("airPressure",   "hPa"),
+				   ("temperature",   "DegCelsius"),
+				   ("relHumidity",   "relHumPerCent"),
+				   ("precipitation", "mm/h"),
+				   ("windVelocity",  "m/s"),
+				   ("brightness",    "kilo Lux")]
+
+SENSORS = [("sensor par", "umol/(m^2*s)"),
+		   ("sensor co2", "ppm")]
+
+
+def loggerDocument(count, width, seed=0):
+	'''
+	An environmental logger JSON object with count readings of width wavelengths, and
+	fixed infos whose strings hold the characters the incremental reader could trip on
+	'''
+	random      = np.random.RandomState(seed)
+	wavelengths = [round(wavelength, 4) for wavelength in np.linspace(337.7, 824.0, width)]
+
+	def member(unit, value):
+		# The logger writes most values as strings, some as numbers.
+		return {"unit": unit, "value": "%.2f" % value, "rawValue": round(value * 3.5, 3)}
+
+	readings = []
+	for index in range(count):
+		reading = {"timestamp"      : "2016.10.15-19:%02d:%02d" % (56 + index // 60, index % 60),
+				   "weather_station": dict((name, member(unit, random.uniform(0, 1000))) for name, unit in WEATHER_STATION),
+				   "spectrometer"   : {"wavelength"            : wavelengths,
+									   "integration time in us": "5000",
+									   "maxFixedIntensity"     : "16383",
+									   "spectrum"              : random.randint(1400, 16383, width).tolist()}}
+		for name, unit in SENSORS:
+			reading[name] = member(unit, random.uniform(0, 2000))
+		readings.append(reading)
+
+	return {"environment_sensor_fixed_infos": {"sensor \"par\" {id}": u"Quantum, [PAR] \u00b5mol \\ }",
+											   "units"                 : [u"\u00b5s", "", "{}", "[]", "\"", "\\\"", "a,b:c"],
+											   "empty"                 : {"object": {}, "array": [], "null": None, "flags": [True, False]}},
+			"environment_sensor_readings"   : readings,
+			"environment_sensor_comment"    : {"after": [1, -2.5e-3, 1E+2, "]}", None]}}
+
+
+def serialize(document):
+	'''
+	The document as the UTF-8 bytes of a file, with no trailing newline so the closing brace is its last byte
+	'''
+	text = json.dumps(document, ensure_ascii=False)
+	return text.encode("utf-8") if isinstance(text, unicode) else text
+
+
+def streamed(stream):
+	'''
+	Rebuild the next value of a JSONStream through members() and items()
+	'''
+	character = stream.peek()
+	if character == '{':
+		return dict((key, streamed(stream)) for key in stream.members())
+	if character == '[':
+		return list(stream.items())
+	return stream.value()
+
+
+def legacyVariables(JSONArray):
+	'''
+	The values main() wrote to each netCDF variable when it was given the readings loaded by JSONHandler,
+	and the units of the weather station and "sensor" variables. Frozen from main() as it was before the
+	readings were transposed into EnvironmentLoggerColumns, it is the reference the columns are checked against.
+	'''
+	loggerReadings = JSONArray["environment_sensor_readings"]
+	variables, units = {}, {}
+
+	for data in loggerReadings[0]["weather_station"]:
+		converting_to           = _UNIT_DICTIONARY[loggerReadings[0]["weather_station"][data]['unit']]
+		variables[data]         = np.array([float(valueMembers["weather_station"][data]['value'])
+											for valueMembers in loggerReadings]) * converting_to["power"]
+		variables["raw_"+data]  = [float(valueMembers["weather_station"][data]['rawValue']) for valueMembers in loggerReadings]
+		units[data]             = converting_to["SI"]
+
+	wvl_lgr = loggerReadings[0]["spectrometer"]["wavelength"]
+	spectrum = [valueMembers["spectrometer"]["spectrum"] for valueMembers in loggerReadings]
+	variables["wvl_lgr"]           = wvl_lgr
+	variables["spectrum"]          = spectrum
+	variables["maxFixedIntensity"] = [float(valueMembers["spectrometer"]["maxFixedIntensity"]) for valueMembers in loggerReadings]
+	variables["time"]              = [translateTime(data["timestamp"]) for data in loggerReadings]
+
+	for data in loggerReadings[0]:
+		if data.startswith("sensor"):
+			converting_to                                  = _UNIT_DICTIONARY[loggerReadings[0][data]['unit']]
+			variables[renameTheValue(data)]                = np.array([float(valueMembers[data]['value'])
+																	   for valueMembers in loggerReadings]) * converting_to["power"]
+			variables["".join(("raw_", renameTheValue(data)))] = [float(valueMembers[data]['rawValue']) for valueMembers in loggerReadings]
+			units[renameTheValue(data)]                    = converting_to["SI"]
+
+	wvl_ntf  = [np.average([wvl_lgr[i], wvl_lgr[i+1]]) for i in range(len(wvl_lgr)-1)]
+	delta    = [wvl_ntf[i+1] - wvl_ntf[i] for i in range(len(wvl_ntf) - 1)]
+	delta.insert(0, 2*(wvl_ntf[0] - wvl_lgr[0]))
+	delta.insert(-1, 2*(wvl_lgr[-1] - wvl_ntf[-1]))
+
+	downwellingSpectralFlux = np.array(FLX_SNS) * 1.0e-6 * (np.array(spectrum) - np.array(DARK_MEASUREMENTS)) / np.array(delta) / AREA / (5000.0 * 1.0e-6)
+	variables["wvl_dlt"]          = delta
+	variables["flx_spc_dwn"]      = downwellingSpectralFlux
+	variables["flx_dwn"]          = np.sum(downwellingSpectralFlux)
+	variables["time_integration"] = float(loggerReadings[0]["spectrometer"]["integration time in us"]) / 1.0e-6
+
+	return variables, units
 
 
 class environmental_logger_json2netcdfUnitTest(unittest.TestCase):
 
 	def setUp(self):
-		self.testCase = JSONHandler(fileLocation)
+		if os.path.isfile(fileLocation):
+			self.testCase = JSONHandler(fileLocation)
 
 	@unittest.skipIf(not os.path.isfile(fileLocation),
 					 "the testing JSON file does not exist")
@@ -111,5 +223,229 @@ class environmental_logger_json2netcdfUnitTest(unittest.TestCase):
 		pass
 
 
+class readEnvironmentLoggerUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.text = serialize(loggerDocument(3, 4))
+		self.path = self.write(self.text)
+
+	def tearDown(self):
+		os.remove(self.path)
+
+	def write(self, text, path=None):
+		if path is None:
+			fileHandle, path = tempfile.mkstemp(suffix=".json")
+			os.close(fileHandle)
+		with open(path, 'wb') as fileHandler:
+			fileHandler.write(text)
+		return path
+
+	def load(self):
+		with open(self.path, 'r') as fileHandler:
+			return json.load(fileHandler)
+
+	def assertColumnsMatch(self, columns, loaded):
+		readings = loaded["environment_sensor_readings"]
+
+		self.assertEqual(columns.fixedInfos, loaded["environment_sensor_fixed_infos"])
+		self.assertEqual(columns.wavelength, readings[0]["spectrometer"]["wavelength"])
+		self.assertEqual(columns.integrationTime, float(readings[0]["spectrometer"]["integration time in us"]))
+		self.assertEqual(sorted(columns.weatherStationNames), sorted(readings[0]["weather_station"]))
+		self.assertEqual(sorted(columns.sensorNames), sorted(data for data in readings[0] if data.startswith("sensor")))
+
+		self.assertEqual(columns.time.values().tolist(), [translateTime(reading["timestamp"]) for reading in readings])
+		self.assertEqual(columns.maxFixedIntensity.values().tolist(),
+						 [float(reading["spectrometer"]["maxFixedIntensity"]) for reading in readings])
+		np.testing.assert_array_equal(columns.spectrum.values(),
+									  np.array([reading["spectrometer"]["spectrum"] for reading in readings], dtype=np.float32))
+
+		for data in columns.weatherStationNames + columns.sensorNames:
+			members = [reading["weather_station"][data] if data in reading["weather_station"] else reading[data]
+					   for reading in readings]
+			value, unit, rawValue = columns.getValue(data)
+			self.assertEqual(unit, _UNIT_DICTIONARY[members[0]["unit"]]["SI"])
+			self.assertEqual(value.tolist(), [float(member["value"]) * _UNIT_DICTIONARY[member["unit"]]["power"] for member in members])
+			self.assertEqual(rawValue.tolist(), [float(member["rawValue"]) for member in members])
+
+	def test_readsWhatJSONLoadReads(self):
+		'''
+		This test checks that readEnvironmentLogger, with the default chunk size that holds the whole
+		file, fills the columns with the same values json.load gets from the file
+		'''
+		self.assertColumnsMatch(readEnvironmentLogger(self.path), self.load())
+
+	def test_chunkBoundaryAtEveryByte(self):
+		'''
+		This test checks that the columns are the same wherever the chunks end: inside a number, a key,
+		a string (in an escape or a multibyte character) and before the closing brace, the last byte
+		'''
+		loaded = self.load()
+		self.assertTrue(self.text.endswith('}'))
+
+		for chunkSize in range(1, len(self.text) + 1):
+			self.assertColumnsMatch(readEnvironmentLogger(self.path, chunkSize), loaded)
+
+	def test_streamedValuesMatchJSONLoad(self):
+		'''
+		This test checks that JSONStream rebuilds the whole document, empty objects and arrays included,
+		for every chunk size
+		'''
+		loaded = self.load()
+
+		for chunkSize in range(1, len(self.text) + 1):
+			with open(self.path, 'r') as fileHandler:
+				stream = JSONStream(fileHandler, chunkSize)
+				self.assertEqual(streamed(stream), loaded)
+				self.assertEqual(stream.peek(), '')
+
+	def test_truncatedInput(self):
+		'''
+		This test checks that a file cut at any byte raises a ValueError, as json.load does,
+		instead of returning the readings decoded so far
+		'''
+		for end in range(len(self.text)):
+			self.write(self.text[:end], self.path)
+			self.assertRaises(ValueError, self.load)
+			self.assertRaises(ValueError, readEnvironmentLogger, self.path, 7)
+
+	def test_trailingInput(self):
+		'''
+		This test checks that whitespace after the object is accepted and anything else raises a
+		ValueError, as json.load does
+		'''
+		loaded = self.load()
+
+		for trailing in ("\n", " \r\n\t "):
+			self.write(self.text + trailing, self.path)
+			self.assertEqual(self.load(), loaded)
+			self.assertColumnsMatch(readEnvironmentLogger(self.path, 5), loaded)
+
+		for trailing in (",", " {}", "\nx", "}"):
+			self.write(self.text + trailing, self.path)
+			self.assertRaises(ValueError, self.load)
+			self.assertRaises(ValueError, readEnvironmentLogger, self.path, 5)
+
+
+class netCDFVariablesUnitTest(unittest.TestCase):
+
+	# Variables main() writes whatever the readings are
+	CONSTANT_VARIABLES = set(["sensor_par", "sensor_co2", "sensor_spectrum", "sensor_weather_station", "flx_sns", "area_sensor"])
+
+	# The flux is computed in float32 now, the other variables are written exactly as before
+	FLUX_TOLERANCE = 1e-5
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.jsonPath  = os.path.join(self.directory, "2016-10-15_19-56-57_environmentlogger.json")
+		self.ncPath    = os.path.join(self.directory, "2016-10-15_19-56-57_environmentlogger.nc")
+		with open(self.jsonPath, 'wb') as fileHandler:
+			fileHandler.write(serialize(loggerDocument(5, 1024, seed=1)))
+
+	def tearDown(self):
+		for fileName in os.listdir(self.directory):
+			os.remove(os.path.join(self.directory, fileName))
+		os.rmdir(self.directory)
+
+	def test_variablesMatchJSONHandler(self):
+		'''
+		This test checks that the netCDF variables main() writes from the columns of readEnvironmentLogger
+		are the ones, with the same values and units, it wrote from the readings loaded by JSONHandler
+		'''
+		expected, units = legacyVariables(JSONHandler(self.jsonPath))
+		main(readEnvironmentLogger(self.jsonPath, 4096), "NETCDF4", self.ncPath, commandLine="test")
+
+		with Dataset(self.ncPath) as netCDFHandler:
+			variables = netCDFHandler.variables
+			self.assertEqual(set(variables), set(expected) | self.CONSTANT_VARIABLES)
+
+			for name, values in expected.items():
+				written = np.asarray(variables[name][...])
+				values  = np.asarray(values, dtype=written.dtype)
+				self.assertEqual(written.shape, values.shape, name)
+				if name in ("flx_spc_dwn", "flx_dwn"):
+					np.testing.assert_allclose(written, values, rtol=self.FLUX_TOLERANCE, err_msg=name)
+				else:
+					np.testing.assert_array_equal(written, values, err_msg=name)
+
+			for name, unit in units.items():
+				self.assertEqual(variables[name].units, unit)
+
+
+class downwellingSpectralFluxUnitTest(unittest.TestCase):
+
+	# float32 keeps 24 bits, the calibration and the product are rounded once each. The dark
+	# corrected counts are exact, they are integers below 2^24.
+	FLUX_TOLERANCE = 1e-6
+
+	def setUp(self):
+		random        = np.random.RandomState(2)
+		self.wvl_lgr  = np.linspace(337.7e-9, 824e-9, 1024).tolist()
+		wvl_ntf       = [np.average([self.wvl_lgr[i], self.wvl_lgr[i+1]]) for i in range(len(self.wvl_lgr)-1)]
+		self.delta    = [wvl_ntf[i+1] - wvl_ntf[i] for i in range(len(wvl_ntf) - 1)]
+		self.delta.insert(0, 2*(wvl_ntf[0] - self.wvl_lgr[0]))
+		self.delta.insert(-1, 2*(self.wvl_lgr[-1] - wvl_ntf[-1]))
+		# Counts around the dark reference too, so some of the flux is negative.
+		self.spectrum = random.randint(1000, 16384, (20, 1024)).astype(np.float32)
+
+	def float64Flux(self, integrationTime=5000.0 * 1.0e-6):
+		'''
+		The downwelling spectral flux as calculateDownwellingSpectralFlux computed it in float64
+		'''
+		return np.array(FLX_SNS) * 1.0e-6 * (np.array(self.spectrum, dtype=np.float64) - np.array(DARK_MEASUREMENTS)) / np.array(self.delta) / AREA / integrationTime
+
+	def test_matchesFloat64Formula(self):
+		'''
+		This test checks that the float32 flux is the float64 one within FLUX_TOLERANCE, element by element,
+		and that the total flux is too, relative to the sum of the magnitudes it adds up
+		'''
+		expected                                 = self.float64Flux()
+		downwellingSpectralFlux, downwellingFlux = calculateDownwellingSpectralFlux(self.wvl_lgr, self.spectrum, self.delta)
+
+		self.assertEqual(downwellingSpectralFlux.dtype, np.float32)
+		self.assertEqual(downwellingSpectralFlux.shape, expected.shape)
+		np.testing.assert_allclose(downwellingSpectralFlux, expected, rtol=self.FLUX_TOLERANCE, atol=0)
+		self.assertLessEqual(abs(downwellingFlux - np.sum(expected)), self.FLUX_TOLERANCE * np.sum(np.abs(expected)))
+
+	def test_acceptsNestedLists(self):
+		'''
+		This test checks that a spectrum given as nested lists of counts gives the same flux as the float32 array
+		'''
+		fromArray, totalFromArray = calculateDownwellingSpectralFlux(self.wvl_lgr, self.spectrum, self.delta)
+		fromLists, totalFromLists = calculateDownwellingSpectralFlux(self.wvl_lgr, self.spectrum.astype(int).tolist(), self.delta)
+
+		np.testing.assert_array_equal(fromLists, fromArray)
+		self.assertEqual(totalFromLists, totalFromArray)
+
+	def test_spectrumIsLeftAsItIs(self):
+		'''
+		This test checks that the flux is written to an array of its own and the spectrum is not modified
+		'''
+		spectrum                   = self.spectrum.copy()
+		downwellingSpectralFlux, _ = calculateDownwellingSpectralFlux(self.wvl_lgr, self.spectrum, self.delta)
+
+		self.assertFalse(np.may_share_memory(downwellingSpectralFlux, self.spectrum))
+		np.testing.assert_array_equal(self.spectrum, spectrum)
+
+	def test_calibrationIsComputedOnce(self):
+		'''
+		This test checks that the calibration vector is the float64 formula rounded to float32, computed
+		once for each delta and integration time
+		'''
+		calibration = spectralFluxCalibration(self.delta)
+		expected    = np.array(FLX_SNS) * 1.0e-6 / np.array(self.delta) / AREA / (5000.0 * 1.0e-6)
+
+		self.assertEqual(calibration.dtype, np.float32)
+		np.testing.assert_array_equal(calibration, expected.astype(np.float32))
+		self.assertIs(spectralFluxCalibration(list(self.delta)), calibration)
+		self.assertIs(spectralFluxCalibration(self.delta, 5000.0 * 1.0e-6), calibration)
+
+		longer = spectralFluxCalibration(self.delta, 10000.0 * 1.0e-6)
+		self.assertIsNot(longer, calibration)
+		np.testing.assert_allclose(longer, calibration / 2, rtol=self.FLUX_TOLERANCE)
+		self.assertIsNot(spectralFluxCalibration(self.delta[::-1]), calibration)
+
+
 if __name__ == "__main__":
-	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(environmental_logger_json2netcdfUnitTest))
+	for testCase in (environmental_logger_json2netcdfUnitTest, readEnvironmentLoggerUnitTest, netCDFVariablesUnitTest,
+	                 downwellingSpectralFluxUnitTest):
+		unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(testCase))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+'''
+geostreams_utils.py
+
+Helpers shared by the extractors for posting to the Clowder Geostreams API.
+Each extractor directory keeps its own copy of this module, so keep the copies in sync:
+geostreams_utils_unittest.py in weather_datparser fails when a definition differs between them.
+The envlog2netcdf copy leaves out DatapointUploader, that extractor posts its datapoints one by one.
+'''
+
+import threading
+import time
+
+import pyclowder.geostreams
+
+
+class GeostreamsCache(object):
+    '''
+    Thread-safe cache of sensor and stream name -> id lookups, with entries expiring after ttl seconds
+    of the clock, a function returning the time in seconds.
+    '''
+
+    def __init__(self, ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, host, name):
+        '''
+        Return the cached id, or None if it is unknown or expired.
+        '''
+        with self._lock:
+            entry = self._entries.get((kind, host, name))
+            if entry is None:
+                return None
+            if self.clock() - entry[1] > self.ttl:
+                del self._entries[(kind, host, name)]
+                return None
+            return entry[0]
+
+    def set(self, kind, host, name, id):
+        with self._lock:
+            self._entries[(kind, host, name)] = (id, self.clock())
+
+    def invalidate(self, kind=None, host=None, name=None):
+        '''
+        Drop the matching entries, arguments left as None match anything.
+        '''
+        with self._lock:
+            for entry_key in list(self._entries):
+                if (kind is None or entry_key[0] == kind) and (host is None or entry_key[1] == host) \
+                        and (name is None or entry_key[2] == name):
+                    del self._entries[entry_key]
+
+
+# Shared by every message handled by this worker process.
+GEOSTREAMS_CACHE = GeostreamsCache()
+
+
+def get_sensor_id(connector, host, key, sensorname, geom, type, region):
+    '''Get the id of a sensor by name, creating the sensor if it does not exist.
+
+    Lookups are cached for the whole process, see GEOSTREAMS_CACHE.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    sensorname -- name of the sensor
+    geom, type, region -- passed on to pyclowder.geostreams.create_sensor if the sensor is created
+    '''
+    sensor_id = GEOSTREAMS_CACHE.get('sensor', host, sensorname)
+    if sensor_id is not None:
+        return sensor_id
+
+    sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, key, sensorname)
+    if not sensor_data:
+        sensor_id = pyclowder.geostreams.create_sensor(connector, host, key, sensorname, geom, type, region)
+        # Streams cached for an older sensor of the same name are gone with it.
+        GEOSTREAMS_CACHE.invalidate('stream', host)
+    else:
+        sensor_id = sensor_data['id']
+
+    GEOSTREAMS_CACHE.set('sensor', host, sensorname, sensor_id)
+    return sensor_id
+
+
+def get_stream_id(connector, host, key, streamname, sensorid, geom, properties={}):
+    '''Get the id of a stream by name, creating the stream if it does not exist.
+
+    Lookups are cached for the whole process, see GEOSTREAMS_CACHE.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    streamname -- name of the stream
+    sensorid, geom, properties -- passed on to pyclowder.geostreams.create_stream if the stream is created
+    '''
+    stream_id = GEOSTREAMS_CACHE.get('stream', host, streamname)
+    if stream_id is not None:
+        return stream_id
+
+    stream_data = pyclowder.geostreams.get_stream_by_name(connector, host, key, streamname)
+    if not stream_data:
+        GEOSTREAMS_CACHE.invalidate('stream', host, streamname)
+        stream_id = pyclowder.geostreams.create_stream(connector, host, key, streamname, sensorid, geom, properties)
+    else:
+        stream_id = stream_data['id']
+
+    GEOSTREAMS_CACHE.set('stream', host, streamname, stream_id)
+    return stream_id
@@ -18,6 +18,7 @@ from netCDF4  import Dataset
 from datetime import datetime, timedelta
 
 import environmental_logger_json2netcdf as ela
+from geostreams_utils import get_sensor_id, get_stream_id
 
 
 class EnvironmentLoggerJSON2NetCDF(Extractor):
@@ -157,29 +158,25 @@ def prepareDatapoint(connector, host, secret_key, resource, ncdf):
     coords = [-111.974304, 33.075576, 0]
 
     with Dataset(ncdf, "r") as netCDF_handle:
-        sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, secret_key, "Full Field - Environmental Logger")
-        if not sensor_data:
-            sensor_id = pyclowder.geostreams.create_sensor(connector, host, secret_key, "Full Field - Environmental Logger", {
-                "type": "Point",
-                "coordinates": coords
-            })
-        else:
-            sensor_id = sensor_data['id']
+        # Sensor and stream IDs are cached for the whole worker process.
+        sensor_id = get_sensor_id(connector, host, secret_key, "Full Field - Environmental Logger", {
+            "type": "Point",
+            "coordinates": coords
+        }, {
+            "id": "Environmental Logger",
+            "title": "Environmental Logger",
+            "sensorType": 4
+        }, "Maricopa")
 
         stream_list = set([sensor_info.name for sensor_info in file_handler.variables.values() if sensor_info.name.startswith('sensor')])
         for stream in stream_list:
             # STREAM is plot x instrument
             stream_name = "EnvLog %s - Full Field" % stream
             logging.debug("checking for stream %s" % stream_name)
-            stream_data = pyclowder.geostreams.get_stream_by_name(connector, host, secret_key, stream_name)
-            if not stream_data:
-                logging.debug("...stream not found. creating")
-                stream_id = pyclowder.geostreams.create_stream(connector, host, secret_key, stream_name, sensor_id, {
-                    "type": "Point",
-                    "coordinates": coords
-                })
-            else:
-                stream_id = stream_data['id']
+            stream_id = get_stream_id(connector, host, secret_key, stream_name, sensor_id, {
+                "type": "Point",
+                "coordinates": coords
+            })
 
             try:
                 memberlist = netCDF_handle.get_variables_by_attributes(sensor=lambda x: x is not None)
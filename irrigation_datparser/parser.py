@@ -1,7 +1,91 @@
+import calendar
 import datetime
+import dateutil.parser
 import dateutil.tz
 import csv
 import json
+import numpy as np
+
+
+UTC_OFFSET = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+# Each row is the total of one day, from midnight to 23:59.
+# Same as datetime.timedelta(0,0,0,0,59,23).
+DURATION = np.timedelta64(23 * 60 * 60 + 59 * 60, 's')
+
+# Convert the given ISO time string to a timestamp in seconds.
+def ISOTimeString2TimeStamp(timeStr):
+    return calendar.timegm(dateutil.parser.parse(timeStr).utctimetuple())
+
+# Render the given timestamp in seconds as an ISO time string in the given timezone.
+def TimeStamp2ISOTimeString(timestamp, tz):
+    return datetime.datetime.fromtimestamp(timestamp, tz).isoformat()
+
+# Convert a column of flow meter time strings, "MM/DD/YYYY HH:MM", to a datetime64 array in seconds as if they were in UTC.
+# The fields may have no leading zeros, e.g. "3/1/2017 0:00", so the strings are split into integer arrays
+# and the dates built from them, instead of parsed as ISO strings.
+def flowmeterTimeStrings2DateTime64(timeStrs):
+    timeStrs = np.char.strip(np.asarray(timeStrs, dtype=np.str_))
+    if len(timeStrs) == 0:
+        return np.array([], dtype='datetime64[s]')
+    date, sep, clock = np.char.partition(timeStrs, ' ').T
+    month, sep, rest = np.char.partition(date, '/').T
+    day, sep, year = np.char.partition(rest, '/').T
+    hours, sep, minutes = np.char.partition(clock, ':').T
+    months = (year.astype(np.int64) - 1970) * 12 + month.astype(np.int64) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (day.astype(np.int64) - 1)
+    return days.astype('datetime64[s]') + (hours.astype(np.int64) * 3600 + minutes.astype(np.int64) * 60).astype('timedelta64[s]')
+
+# Get the offset of the given timezone from UTC in seconds.
+def utcOffsetSeconds(utc_offset):
+    offset = utc_offset.utcoffset(None)
+    return offset.days * 24 * 60 * 60 + offset.seconds
+
+# Geometries by coordinates, so the records at the same place share one geometry.
+GEOMETRIES = {}
+
+def internGeometry(coords):
+    key = tuple(coords)
+    if key not in GEOMETRIES:
+        GEOMETRIES[key] = {
+            'type': 'Point',
+            'coordinates': list(coords)
+        }
+    return GEOMETRIES[key]
+
+# One parsed row of a flow meter file, the irrigation of one day.
+# The times are stored as timestamps in seconds and the geometry is shared, see internGeometry.
+# The GeoJSON feature with ISO time strings is only built by toGeoJSON(), when the record is uploaded.
+# The fields can also be read like dictionary keys, e.g. record['properties'].
+class FlowmeterRecord(object):
+    __slots__ = ('start_time', 'end_time', 'properties', 'geometry')
+
+    type = 'Feature'
+
+    def __init__(self, start_time, end_time, properties, geometry):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.properties = properties
+        self.geometry = geometry
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return 'FlowmeterRecord(%r, %r, %r)' % (self.start_time, self.end_time, self.properties)
+
+    # Build the GeoJSON feature of the record with the times rendered in the given timezone.
+    def toGeoJSON(self, tz=UTC_OFFSET):
+        return {
+            'start_time': TimeStamp2ISOTimeString(self.start_time, tz),
+            'end_time': TimeStamp2ISOTimeString(self.end_time, tz),
+            'properties': self.properties,
+            'type': self.type,
+            'geometry': self.geometry
+        }
 
 
 def gallon2mm(value):
@@ -10,10 +94,13 @@ def gallon2mm(value):
         return (int(value)*3.78541)/((20*200)*(24*60*60))
     return 0.0
 
-# Parse CSV file
-def parse_file(filepath, main_coords):
-    results = []
+# Same as gallon2mm, on an array of gallons.
+def gallons2mm(gallons):
+    return (gallons*3.78541)/((20*200)*(24*60*60))
 
+# Read the Date Time and Gallons columns of a CSV file into arrays.
+# Return the start times as a datetime64 array in seconds and the irrigation flux of each row.
+def parse_file_columns(filepath):
     with open(filepath) as csvfile:
         header = []
         found_date = False
@@ -22,29 +109,36 @@ def parse_file(filepath, main_coords):
             header.append(curr_line)
             if curr_line.find("Date Time") > -1:
                 found_date = True
-        fields = header[-1].split(',')
+        fields = [field.strip() for field in header[-1].split(',')]
+        dateColumn = fields.index('Date Time')
+        gallonsColumn = fields.index('Gallons')
 
-        reader = csv.DictReader(csvfile, fieldnames=fields)
-        utc_offset = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+        # The rows are only collected here, both columns are converted as whole arrays.
+        timeStrs = []
+        gallons = []
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            timeStrs.append(row[dateColumn])
+            gallons.append(row[gallonsColumn].strip())
 
-        for row in reader:
-            start_time = datetime.datetime.strptime(row['Date Time'], '%m/%d/%Y %H:%M').isoformat() + utc_offset.tzname(None)
-            end_time = (datetime.datetime.strptime(row['Date Time'], '%m/%d/%Y %H:%M')+datetime.timedelta(0,0,0,0,59,23)).isoformat() + utc_offset.tzname(None)
+    start_times = flowmeterTimeStrings2DateTime64(timeStrs) - np.timedelta64(utcOffsetSeconds(UTC_OFFSET), 's')
+    # Days without a reading count as no irrigation, as in gallon2mm.
+    gallons = np.array(gallons, dtype=np.str_)
+    gallons[gallons == ''] = '0'
+    return start_times, gallons2mm(gallons.astype(np.float64))
 
-            results.append({
-                'start_time': start_time,
-		        'end_time': end_time,
-                'properties' : {'irrigation_flux':gallon2mm(row['Gallons'])},
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'Point',
-                    'coordinates': main_coords
-                }
-            })
+# Parse CSV file and return a list of FlowmeterRecords, times are timestamps in seconds.
+def parse_file(filepath, main_coords):
+    start_times, fluxes = parse_file_columns(filepath)
+    end_times = start_times + DURATION
+    geometry = internGeometry(main_coords)
 
-        return results
+    # datetime64 in seconds is a count of seconds since the epoch, the timestamps of the records.
+    return [FlowmeterRecord(start_time, end_time, {'irrigation_flux': flux}, geometry)
+            for start_time, end_time, flux in zip(start_times.astype(np.int64).tolist(), end_times.astype(np.int64).tolist(), fluxes.tolist())]
 
 
 if __name__ == "__main__":
     infile = "flowmetertotals_March-2017.csv"
-    print json.dumps(parse_file(infile)[:5])
+    print json.dumps([record.toGeoJSON() for record in parse_file(infile, [-111.974304, 33.075576, 361])[:5]])
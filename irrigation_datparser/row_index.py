@@ -0,0 +1,80 @@
+'''
+row_index.py
+
+Remember which rows of the flow meter files were already posted to each stream, so a file
+uploaded again later in the month only posts the rows that are new or whose value changed.
+The id of the datapoint posted for each row is kept too, so the datapoint of a changed row can
+be deleted before the row is posted again.
+
+The index is a local SQLite database with a hash of every posted row and the id of its datapoint,
+by stream and start time.
+'''
+
+import json
+import sqlite3
+import threading
+import zlib
+
+
+# Hash of the values of a record, the time it starts at is the key it is stored under.
+def rowHash(record):
+    return zlib.crc32(json.dumps([record.end_time, record.properties], sort_keys=True)) & 0xffffffff
+
+
+class RowHashIndex(object):
+    '''
+    Start time -> row hash and datapoint id of the records posted to each stream, kept in a SQLite database.
+    The connection is shared by the worker threads, behind a lock.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS rows (stream_id TEXT NOT NULL, start_time INTEGER NOT NULL, '
+                                     'hash INTEGER NOT NULL, datapoint_id TEXT, PRIMARY KEY (stream_id, start_time))')
+            # Indexes from before the datapoint ids were kept, their rows have no id.
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(rows)')]
+            if 'datapoint_id' not in columns:
+                self._connection.execute('ALTER TABLE rows ADD COLUMN datapoint_id TEXT')
+            self._connection.commit()
+
+    def has_stream(self, stream_id):
+        '''
+        Return whether any row of the stream is in the index.
+        '''
+        with self._lock:
+            row = self._connection.execute('SELECT 1 FROM rows WHERE stream_id = ? LIMIT 1', (str(stream_id),)).fetchone()
+        return row != None
+
+    def compare(self, stream_id, records):
+        '''
+        Return the records that are not in the index of the stream, and the ones whose values changed since
+        they were posted as (record, id of the datapoint posted for it) pairs. The id is None if it is unknown.
+        '''
+        with self._lock:
+            posted = dict((start_time, (hash, datapoint_id)) for start_time, hash, datapoint_id in self._connection.execute(
+                'SELECT start_time, hash, datapoint_id FROM rows WHERE stream_id = ?', (str(stream_id),)))
+        new = []
+        changed = []
+        for record in records:
+            if record.start_time not in posted:
+                new.append(record)
+            elif posted[record.start_time][0] != rowHash(record):
+                changed.append((record, posted[record.start_time][1]))
+        return new, changed
+
+    def update(self, stream_id, rows):
+        '''
+        Add the given (record, datapoint id) pairs to the index of the stream, once they are posted.
+        '''
+        rows = [(str(stream_id), record.start_time, rowHash(record), None if datapoint_id == None else str(datapoint_id))
+                for record, datapoint_id in rows]
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO rows (stream_id, start_time, hash, datapoint_id) VALUES (?, ?, ?, ?)', rows)
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,4 +1,5 @@
 import logging
+import requests
 
 import datetime
 from dateutil.parser import parse
@@ -11,6 +12,8 @@ import pyclowder.datasets
 import pyclowder.geostreams
 
 from parser import *
+from geostreams_utils import get_sensor_id, get_stream_id
+from row_index import RowHashIndex
 
 
 class IrrigationFileParser(Extractor):
@@ -30,6 +33,10 @@ class IrrigationFileParser(Extractor):
                                  default="", help="InfluxDB password")
         self.parser.add_argument('--influxDB', dest="influx_db", type=str, nargs='?',
                                  default="extractor_db", help="InfluxDB databast")
+        self.parser.add_argument('--rowIndex', dest="row_index", type=str, nargs='?',
+                                 default="/home/extractor/data/rows.sqlite",
+                                 help="SQLite database of the rows already posted, so only new rows are posted " +
+                                 "(the Docker image keeps it in the /home/extractor/data volume)")
 
         self.setup()
 
@@ -41,6 +48,7 @@ class IrrigationFileParser(Extractor):
         self.influx_user = self.args.influx_user
         self.influx_pass = self.args.influx_pass
         self.influx_db = self.args.influx_db
+        self.row_index = RowHashIndex(self.args.row_index)
 
     def check_message(self, connector, host, secret_key, resource, parameters):
         filename = resource["name"]
@@ -60,36 +68,51 @@ class IrrigationFileParser(Extractor):
         fileId = resource["id"]
 
         sensor_name = "AZMET Maricopa Weather Station"
-        sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, secret_key, sensor_name)
-        if not sensor_data:
-            sensor_id = pyclowder.geostreams.create_sensor(connector, host, secret_key, sensor_name, {
-                "type": "Point",
-                "coordinates": main_coords
-            }, {
-                "id": "MAC Met Station",
-                "title":"MAC Met Station",
-                "sensorType": 4
-            }, "Maricopa")
-        else:
-            sensor_id = sensor_data['id']
+        # Sensor and stream IDs are cached for the whole worker process.
+        sensor_id = get_sensor_id(connector, host, secret_key, sensor_name, {
+            "type": "Point",
+            "coordinates": main_coords
+        }, {
+            "id": "MAC Met Station",
+            "title":"MAC Met Station",
+            "sensorType": 4
+        }, "Maricopa")
 
         stream_name = "Irrigation Observations"
-        stream_data =pyclowder.geostreams.get_stream_by_name(connector,host, secret_key, stream_name)
-        if not stream_data:
-            stream_id = pyclowder.geostreams.create_stream(connector, host, secret_key, stream_name, sensor_id, {
-                "type": "Point",
-                "coordinates": main_coords
-            })
-        else:
-            stream_id = stream_data['id']
+        stream_id = get_stream_id(connector, host, secret_key, stream_name, sensor_id, {
+            "type": "Point",
+            "coordinates": main_coords
+        })
 
         records = parse_file(inputfile, main_coords)
-        for record in records:
-            record['source_file'] = fileId
-            record['stream_id'] = str(stream_id)
-
-            pyclowder.geostreams.create_datapoint(connector, host, secret_key, stream_id, record['geometry'],
-                                                  record['start_time'], record['end_time'], record['properties'])
+        if records and not self.row_index.has_stream(stream_id):
+            # Nothing was indexed for the stream yet, e.g. on the first run after the index was set up.
+            # The datapoints already on the stream are indexed first, so their rows are not posted again.
+            # A row with several datapoints, posted again by earlier versions, is indexed without an id,
+            # so all of them are looked up and replaced if the row changes.
+            seeded = []
+            for rows in posted_datapoints(connector, host, secret_key, stream_id, records).values():
+                seeded.append((rows[-1][0], rows[0][1] if len(rows) == 1 else None))
+            self.row_index.update(stream_id, seeded)
+
+        # The files are uploaded again as the month goes on, only post the rows that are new or changed since.
+        # There are at most a month of daily rows, so each is posted on its own to get the id of its datapoint.
+        records, changed = self.row_index.compare(stream_id, records)
+        self.row_index.update(stream_id, [(record, post_datapoint(connector, host, secret_key, stream_id, record))
+                                          for record in records])
+
+        if changed:
+            logging.getLogger(__name__).info("%s: replacing %d rows changed since they were posted: %s" % (
+                fileId, len(changed), ', '.join(TimeStamp2ISOTimeString(record.start_time, UTC_OFFSET) for record, datapoint_id in changed)))
+            if None in [datapoint_id for record, datapoint_id in changed]:
+                posted = posted_datapoints(connector, host, secret_key, stream_id, [record for record, datapoint_id in changed])
+            for record, datapoint_id in changed:
+                old_ids = [datapoint_id] if datapoint_id != None else [row[1] for row in posted.get(record.start_time, [])]
+                # The new datapoint is indexed before the old ones are deleted, so the row is never posted twice.
+                self.row_index.update(stream_id, [(record, post_datapoint(connector, host, secret_key, stream_id, record))])
+                for old_id in old_ids:
+                    delete_datapoint(connector, host, secret_key, old_id)
+            records += [record for record, datapoint_id in changed]
 
         metadata = {
             "@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld"],
@@ -129,6 +152,56 @@ class IrrigationFileParser(Extractor):
             "fields": {"value": int(bytecount)}
         }], tags={"extractor": self.extractor_info['name'], "type": "bytes"})
 
+# Post the record as a datapoint and return the id of the datapoint.
+def post_datapoint(connector, host, key, stream_id, record):
+    # Times are only rendered as ISO strings for the upload.
+    feature = record.toGeoJSON(UTC_OFFSET)
+    return pyclowder.geostreams.create_datapoint(connector, host, key, stream_id, feature['geometry'],
+                                                 feature['start_time'], feature['end_time'], feature['properties'])
+
+# The datapoints of the stream over the days of the given records, as start time -> list of (record, datapoint id).
+# The records are rebuilt from the datapoints with the properties of the given records, so they hash like the rows posted.
+def posted_datapoints(connector, host, key, stream_id, records):
+    keys = records[0].properties.keys()
+    posted = {}
+    for datapoint in get_datapoints(connector, host, key, stream_id,
+                                    TimeStamp2ISOTimeString(min(record.start_time for record in records), UTC_OFFSET),
+                                    TimeStamp2ISOTimeString(max(record.end_time for record in records), UTC_OFFSET)):
+        record = FlowmeterRecord(ISOTimeString2TimeStamp(datapoint['start_time']), ISOTimeString2TimeStamp(datapoint['end_time']),
+                                 dict((name, datapoint['properties'].get(name)) for name in keys), datapoint['geometry'])
+        posted.setdefault(record.start_time, []).append((record, datapoint['id']))
+    return posted
+
+def get_datapoints(connector, host, key, streamid, since, until):
+    """Get the datapoints of a stream from Geostreams.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    streamid -- the stream to get the datapoints of
+    since, until -- ISO time strings of the time span of the datapoints
+    """
+    url = '%sapi/geostreams/datapoints' % host
+    result = requests.get(url, params={'stream_id': streamid, 'since': since, 'until': until, 'format': 'json', 'key': key},
+                          verify=connector.ssl_verify if connector else True)
+    result.raise_for_status()
+    return result.json()
+
+def delete_datapoint(connector, host, key, datapointid):
+    """Delete one datapoint from Geostreams, a datapoint that is already gone is not an error.
+
+    Keyword arguments:
+    connector -- connector information, used to get missing parameters and send status updates
+    host -- the clowder host, including http and port, should end with a /
+    key -- the secret key to login to clowder
+    datapointid -- the id of the datapoint
+    """
+    url = '%sapi/geostreams/datapoints/%s?key=%s' % (host, datapointid, key)
+    result = requests.delete(url, verify=connector.ssl_verify if connector else True)
+    if result.status_code != 404:
+        result.raise_for_status()
+
 
 if __name__ == "__main__":
     extractor = IrrigationFileParser()
@@ -0,0 +1,349 @@
+'''
+This is the unit test module for geostreams_utils.py.
+It runs the datapoint uploader against a stub Geostreams HTTP server
+on localhost, so no Clowder instance is needed. The sensor and stream lookups
+are checked against a fake clock and fake pyclowder calls. It also checks that the
+copies of the module in the other extractor directories are in sync with this one.
+
+To run the unit test, simply use:
+python geostreams_utils_unittest.py
+'''
+
+import ast
+import glob
+import json
+import os
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+import pyclowder.geostreams
+
+import geostreams_utils
+from geostreams_utils import DatapointUploader, GeostreamsCache
+
+# Definitions each copy of geostreams_utils.py leaves out, by extractor directory.
+LEFT_OUT_DEFINITIONS = {
+	'envlog2netcdf': ['DatapointUploader']
+}
+
+
+# The source of the module docstring and of each top-level class, function and variable by name.
+def module_definitions(filepath):
+	with open(filepath) as infile:
+		module = ast.parse(infile.read(), filepath)
+	definitions = {'__doc__': ast.get_docstring(module)}
+	for node in module.body:
+		if isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+			definitions[node.name] = ast.dump(node)
+		elif isinstance(node, ast.Assign):
+			for target in node.targets:
+				definitions[ast.dump(target)] = ast.dump(node)
+	return definitions
+
+
+class StubGeostreamsHandler(BaseHTTPRequestHandler):
+	'''
+	Answers datapoint posts and records every request on the server.
+	'''
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+		path = self.path.split('?')[0]
+		with self.server.lock:
+			self.server.requests.append((path, body))
+
+		if path == '/api/geostreams/datapoints/bulk' and not self.server.bulk:
+			self.reply(404, {})
+		elif path == '/api/geostreams/datapoints' and self.server.fail:
+			self.reply(500, {})
+		else:
+			self.reply(200, {'id': len(self.server.requests)})
+
+	def reply(self, status, content):
+		data = json.dumps(content)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class StubGeostreamsServer(ThreadingMixIn, HTTPServer):
+	'''
+	Keep-alive connections hold on to their thread, so serve each one in its own.
+	'''
+	daemon_threads = True
+
+
+class FakeConnector(object):
+	ssl_verify = True
+
+
+class geostreamsUtilsUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = StubGeostreamsServer(('127.0.0.1', 0), StubGeostreamsHandler)
+		self.server.lock = threading.Lock()
+		self.server.requests = []
+		self.server.bulk = True
+		self.server.fail = False
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.host = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+	def addDatapoints(self, uploader, count):
+		for index in xrange(count):
+			uploader.add('stream-1', {'type': 'Point', 'coordinates': [0, 0, 0]},
+						 '2017-04-01T00:00:%02d-07:00' % index, '2017-04-01T00:00:%02d-07:00' % index,
+						 {'index': index})
+
+	def test_postsBatchesToTheBulkEndpoint(self):
+		'''
+		Datapoints should be posted in batches of batch_size, with the rest posted on close
+		'''
+		with DatapointUploader(FakeConnector(), self.host, 'secret', batch_size=2) as uploader:
+			self.addDatapoints(uploader, 5)
+
+		self.assertEqual([path for path, body in self.server.requests], ['/api/geostreams/datapoints/bulk'] * 3)
+		self.assertEqual([len(body) for path, body in self.server.requests], [2, 2, 1])
+		self.assertEqual([datapoint['properties']['index'] for path, body in self.server.requests for datapoint in body], range(5))
+		self.assertEqual(self.server.requests[0][1][0]['stream_id'], 'stream-1')
+		self.assertEqual(uploader.count, 5)
+		self.assertTrue(uploader.bulk_supported)
+
+	def test_fallsBackToSingleDatapoints(self):
+		'''
+		Without the bulk endpoint, every datapoint should be posted once on its own
+		and the bulk endpoint should not be tried again
+		'''
+		self.server.bulk = False
+		with DatapointUploader(FakeConnector(), self.host, 'secret', batch_size=3, connections=2) as uploader:
+			self.addDatapoints(uploader, 7)
+
+		paths = [path for path, body in self.server.requests]
+		self.assertEqual(paths.count('/api/geostreams/datapoints/bulk'), 1)
+		self.assertEqual(paths.count('/api/geostreams/datapoints'), 7)
+		posted = [body['properties']['index'] for path, body in self.server.requests if path == '/api/geostreams/datapoints']
+		self.assertEqual(sorted(posted), range(7))
+		self.assertEqual(uploader.count, 7)
+		self.assertFalse(uploader.bulk_supported)
+
+	def test_bulkDatapointsMatchSingleDatapoints(self):
+		'''
+		Each datapoint in a bulk post should be the same object pyclowder posts to the single datapoint endpoint
+		'''
+		geom = {'type': 'Point', 'coordinates': [-111.974304, 33.075576, 0]}
+		properties = {'air_temperature': 293.15, 'source': 'https://example.org/datasets/1'}
+		pyclowder.geostreams.create_datapoint(FakeConnector(), self.host, 'secret', 42, geom,
+											  '2017-04-01T00:00:00-07:00', '2017-04-01T00:05:00-07:00', properties)
+		with DatapointUploader(FakeConnector(), self.host, 'secret') as uploader:
+			uploader.add(42, geom, '2017-04-01T00:00:00-07:00', '2017-04-01T00:05:00-07:00', properties)
+
+		self.assertEqual([path for path, body in self.server.requests],
+						 ['/api/geostreams/datapoints', '/api/geostreams/datapoints/bulk'])
+		single = self.server.requests[0][1]
+		bulk = self.server.requests[1][1]
+		self.assertEqual(bulk, [single])
+
+	def test_copiesAreInSync(self):
+		'''
+		Every copy of geostreams_utils.py should have the same definitions as this one,
+		apart from the ones left out on purpose
+		'''
+		directory = os.path.dirname(os.path.abspath(__file__))
+		expected = module_definitions(os.path.join(directory, 'geostreams_utils.py'))
+		copies = glob.glob(os.path.join(directory, '..', '*', 'geostreams_utils.py'))
+		self.assertEqual(len(copies), 4)
+
+		for filepath in copies:
+			extractor = os.path.basename(os.path.dirname(os.path.abspath(filepath)))
+			definitions = module_definitions(filepath)
+			for name in LEFT_OUT_DEFINITIONS.get(extractor, []):
+				self.assertNotIn(name, definitions, '%s should leave out %s' % (filepath, name))
+			for name, source in expected.iteritems():
+				if name in LEFT_OUT_DEFINITIONS.get(extractor, []):
+					continue
+				self.assertEqual(definitions.get(name), source, '%s differs from this copy in %s' % (filepath, name))
+			self.assertEqual(sorted(set(definitions) - set(expected)), [], '%s has definitions this copy does not' % filepath)
+
+	def test_raisesOnFailedPosts(self):
+		'''
+		Errors from the server should not be swallowed
+		'''
+		self.server.bulk = False
+		self.server.fail = True
+		uploader = DatapointUploader(FakeConnector(), self.host, 'secret', batch_size=10)
+		self.addDatapoints(uploader, 3)
+		self.assertRaises(requests.HTTPError, uploader.close)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class FakeClock(object):
+	'''
+	Time in seconds that only moves when the test says so.
+	'''
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+class geostreamsCacheUnitTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.cache = GeostreamsCache(ttl=60, clock=self.clock)
+		self.calls = []
+		self.sensors = {}
+		self.streams = {}
+
+		self.patched = [(pyclowder.geostreams, 'get_sensor_by_name', self.get_sensor_by_name),
+						(pyclowder.geostreams, 'create_sensor', self.create_sensor),
+						(pyclowder.geostreams, 'get_stream_by_name', self.get_stream_by_name),
+						(pyclowder.geostreams, 'create_stream', self.create_stream),
+						(geostreams_utils, 'GEOSTREAMS_CACHE', self.cache)]
+		for module, name, value in self.patched:
+			setattr(self, '_original_' + name, getattr(module, name))
+			setattr(module, name, value)
+
+	def get_sensor_by_name(self, connector, host, key, sensorname):
+		self.calls.append(('get_sensor_by_name', host, sensorname))
+		if (host, sensorname) in self.sensors:
+			return {'id': self.sensors[(host, sensorname)]}
+		return None
+
+	def create_sensor(self, connector, host, key, sensorname, geom, type, region):
+		self.calls.append(('create_sensor', host, sensorname))
+		self.sensors[(host, sensorname)] = 'sensor-%s' % len(self.calls)
+		return self.sensors[(host, sensorname)]
+
+	def get_stream_by_name(self, connector, host, key, streamname):
+		self.calls.append(('get_stream_by_name', host, streamname))
+		if (host, streamname) in self.streams:
+			return {'id': self.streams[(host, streamname)]}
+		return None
+
+	def create_stream(self, connector, host, key, streamname, sensorid, geom, properties={}):
+		self.calls.append(('create_stream', host, streamname))
+		self.streams[(host, streamname)] = 'stream-%s' % len(self.calls)
+		return self.streams[(host, streamname)]
+
+	def getSensorId(self, host, sensorname):
+		return geostreams_utils.get_sensor_id(None, host, 'secret', sensorname, {}, 'Weather Station', 'Maricopa')
+
+	def getStreamId(self, host, streamname, sensorid):
+		return geostreams_utils.get_stream_id(None, host, 'secret', streamname, sensorid, {})
+
+	def test_entriesExpireAfterTheTTL(self):
+		'''
+		An entry should be returned up to ttl seconds after it was set, and dropped after that
+		'''
+		self.cache.set('sensor', 'host-a', 'station', 'sensor-1')
+		self.clock.now += 60
+		self.assertEqual(self.cache.get('sensor', 'host-a', 'station'), 'sensor-1')
+		self.clock.now += 1
+		self.assertEqual(self.cache.get('sensor', 'host-a', 'station'), None)
+
+		# Setting it again starts the TTL over.
+		self.cache.set('sensor', 'host-a', 'station', 'sensor-2')
+		self.clock.now += 30
+		self.assertEqual(self.cache.get('sensor', 'host-a', 'station'), 'sensor-2')
+
+	def test_invalidateMatchesTheGivenArguments(self):
+		'''
+		invalidate should only drop the entries matching every argument given
+		'''
+		for kind in ['sensor', 'stream']:
+			for host in ['host-a', 'host-b']:
+				for name in ['one', 'two']:
+					self.cache.set(kind, host, name, (kind, host, name))
+
+		self.cache.invalidate('stream', 'host-a', 'one')
+		self.assertEqual(self.cache.get('stream', 'host-a', 'one'), None)
+		self.assertEqual(self.cache.get('stream', 'host-a', 'two'), ('stream', 'host-a', 'two'))
+
+		self.cache.invalidate('stream', 'host-a')
+		self.assertEqual(self.cache.get('stream', 'host-a', 'two'), None)
+		self.assertEqual(self.cache.get('stream', 'host-b', 'one'), ('stream', 'host-b', 'one'))
+		self.assertEqual(self.cache.get('sensor', 'host-a', 'one'), ('sensor', 'host-a', 'one'))
+
+		self.cache.invalidate()
+		for kind in ['sensor', 'stream']:
+			for host in ['host-a', 'host-b']:
+				for name in ['one', 'two']:
+					self.assertEqual(self.cache.get(kind, host, name), None)
+
+	def test_cachedLookupsSkipClowder(self):
+		'''
+		Looking up the same sensor and stream again should not call Clowder until the entries expire
+		'''
+		self.sensors[('host-a', 'station')] = 'sensor-0'
+		self.streams[('host-a', 'station - weather')] = 'stream-0'
+		self.assertEqual(self.getSensorId('host-a', 'station'), 'sensor-0')
+		self.assertEqual(self.getStreamId('host-a', 'station - weather', 'sensor-0'), 'stream-0')
+		self.assertEqual(len(self.calls), 2)
+
+		self.clock.now += 60
+		self.assertEqual(self.getSensorId('host-a', 'station'), 'sensor-0')
+		self.assertEqual(self.getStreamId('host-a', 'station - weather', 'sensor-0'), 'stream-0')
+		self.assertEqual(len(self.calls), 2)
+
+		self.clock.now += 1
+		self.assertEqual(self.getSensorId('host-a', 'station'), 'sensor-0')
+		self.assertEqual(self.getStreamId('host-a', 'station - weather', 'sensor-0'), 'stream-0')
+		self.assertEqual(self.calls[2:], [('get_sensor_by_name', 'host-a', 'station'),
+										  ('get_stream_by_name', 'host-a', 'station - weather')])
+
+	def test_creatingASensorDropsTheStreamsOfItsHost(self):
+		'''
+		Streams cached on a host should be looked up again once a sensor is created there,
+		the streams of other hosts should stay cached
+		'''
+		self.streams[('host-a', 'old stream')] = 'stream-a'
+		self.streams[('host-b', 'old stream')] = 'stream-b'
+		self.getStreamId('host-a', 'old stream', 'sensor-0')
+		self.getStreamId('host-b', 'old stream', 'sensor-0')
+		del self.calls[:]
+
+		sensor_id = self.getSensorId('host-a', 'station')
+		self.assertEqual(self.calls, [('get_sensor_by_name', 'host-a', 'station'),
+									  ('create_sensor', 'host-a', 'station')])
+		self.assertEqual(self.cache.get('sensor', 'host-a', 'station'), sensor_id)
+		self.assertEqual(self.cache.get('stream', 'host-a', 'old stream'), None)
+		self.assertEqual(self.cache.get('stream', 'host-b', 'old stream'), 'stream-b')
+
+		# The stream was deleted with the old sensor, so it is created again for the new one.
+		del self.streams[('host-a', 'old stream')]
+		del self.calls[:]
+		stream_id = self.getStreamId('host-a', 'old stream', sensor_id)
+		self.assertEqual(self.calls, [('get_stream_by_name', 'host-a', 'old stream'),
+									  ('create_stream', 'host-a', 'old stream')])
+		self.assertEqual(self.cache.get('stream', 'host-a', 'old stream'), stream_id)
+
+		del self.calls[:]
+		self.assertEqual(self.getSensorId('host-a', 'station'), sensor_id)
+		self.assertEqual(self.getStreamId('host-a', 'old stream', sensor_id), stream_id)
+		self.assertEqual(self.getStreamId('host-b', 'old stream', 'sensor-0'), 'stream-b')
+		self.assertEqual(self.calls, [])
+
+	def tearDown(self):
+		for module, name, value in self.patched:
+			setattr(module, name, getattr(self, '_original_' + name))
+
+
+if __name__ == "__main__":
+	for testCase in (geostreamsUtilsUnitTest, geostreamsCacheUnitTest):
+		unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(testCase))
@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 import math
+import calendar
 import datetime
 import dateutil.parser
 import dateutil.tz
 import csv
 import json
+import heapq
+import multiprocessing
+import numpy as np
 
 DEBUG = True
 
@@ -27,33 +31,85 @@ def ISOTimeString2TimeStamp(timeStr):
 	isoStartTime = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, ISO_8601_UTC_MEAN)
 	return int((time - isoStartTime).total_seconds())
 
-def tempUnit2K(value, unit):
+# ISO time strings already rendered, by timezone and then by timestamp.
+# Consecutive records and packages share their boundaries, so the same timestamps come up again and again.
+# Each entry keeps its timezone alive so that the id used as the key can't be reused by another object.
+ISO_TIME_STRINGS = {}
+ISO_TIME_STRINGS_LIMIT = 65536
+
+# Render the given timestamp in seconds as an ISO time string in the given timezone.
+def TimeStamp2ISOTimeString(timestamp, tz):
+	entry = ISO_TIME_STRINGS.get(id(tz))
+	if entry == None:
+		entry = ISO_TIME_STRINGS[id(tz)] = (tz, {})
+	strings = entry[1]
+	timeStr = strings.get(timestamp)
+	if timeStr == None:
+		if len(strings) >= ISO_TIME_STRINGS_LIMIT:
+			strings.clear()
+		timeStr = strings[timestamp] = datetime.datetime.fromtimestamp(timestamp, tz).isoformat()
+	return timeStr
+
+# Timestamps in seconds of the dates already seen, a file only spans a few of them.
+TOA5_DATES = {}
+
+# Convert a TOA5 time string, which is always "YYYY-MM-DD HH:MM:SS", to a timestamp in seconds
+# as if it was in UTC. The fields are sliced out of the fixed layout instead of going through strptime.
+def TOA5TimeString2TimeStamp(timeStr):
+	if len(timeStr) != 19 or timeStr[10] != ' ':
+		return calendar.timegm(datetime.datetime.strptime(timeStr, '%Y-%m-%d %H:%M:%S').timetuple())
+	day = TOA5_DATES.get(timeStr[:10])
+	if day == None:
+		day = TOA5_DATES[timeStr[:10]] = calendar.timegm(datetime.date(int(timeStr[0:4]), int(timeStr[5:7]), int(timeStr[8:10])).timetuple())
+	return day + int(timeStr[11:13]) * 3600 + int(timeStr[14:16]) * 60 + int(timeStr[17:19])
+
+def identity(value):
+	return value
+
+# Unit converters are resolved once per file header, so only the arithmetic is left for each value.
+# The returned functions work on single values and on NumPy arrays alike.
+def tempUnitConverter(unit):
 	if unit == 'Deg C':
-		return value + 273.15
+		return lambda value: value + 273.15
 	elif unit == 'Deg F':
-		return (value + 459.67) * 5 / 9
+		return lambda value: (value + 459.67) * 5 / 9
 	elif unit == 'Deg K':
-		return value
+		return identity
 	else:
 		raise ValueError('Unsupported unit "%s".' % unit)
 
-def relHumidUnit2Percent(value, unit):
+def relHumidUnitConverter(unit):
 	if unit == '%':
-		return value
+		return identity
 	else:
 		raise ValueError('Unsupported unit "%s".' % unit)
 
-def speedUnit2MeterPerSecond(value, unit):
+def speedUnitConverter(unit):
 	if unit == 'meters/second':
-		return value
+		return identity
 	else:
 		raise ValueError('Unsupported unit "%s".' % unit)
 
+def tempUnit2K(value, unit):
+	return tempUnitConverter(unit)(value)
+
+def relHumidUnit2Percent(value, unit):
+	return relHumidUnitConverter(unit)(value)
+
+def speedUnit2MeterPerSecond(value, unit):
+	return speedUnitConverter(unit)(value)
+
 def extractXFactor(magnitude, degreeFromNorth):
 	return magnitude * math.sin(math.radians(degreeFromNorth));
 def extractYFactor(magnitude, degreeFromNorth):
 	return magnitude * math.cos(math.radians(degreeFromNorth));
 
+# Same as above, but for whole columns of values.
+def extractXFactorColumn(magnitude, degreeFromNorth):
+	return magnitude * np.sin(np.radians(degreeFromNorth))
+def extractYFactorColumn(magnitude, degreeFromNorth):
+	return magnitude * np.cos(np.radians(degreeFromNorth))
+
 STATION_GEOMETRY = {
 	'type': 'Point',
 	'coordinates': [
@@ -73,40 +129,45 @@ STATION_GEOMETRY = {
 # 'WS_ms': 'wind_speed',
 # 'Rain_mm_Tot': 'precipitation_rate'
 
-# Each mapping function can decide to return one or multiple tuple, so leave the list to them.
+# Each mapping function gets the header details of its column and returns the list of properties
+# computed from it, as (property name, source columns, converter) tuples.
+# The converter is called with the values of the source columns, in that order.
 PROP_MAPPING = {
-	'AirTC': lambda d: [(
-		'air_temperature',
-		tempUnit2K(float(d['value']), d['meta']['unit'])
-	)],
-	'RH': lambda d: [(
-		'relative_humidity',
-		relHumidUnit2Percent(float(d['value']), d['meta']['unit'])
-	)],
-	'Pyro': lambda d: [(
-		'surface_downwelling_shortwave_flux_in_air',
-		float(d['value'])
-	)],
-	'PAR_ref': lambda d: [(
-		'surface_downwelling_photosynthetic_photon_flux_in_air',
-		float(d['value'])
-	)],
+	'AirTC': lambda meta: [
+		('air_temperature', ('AirTC',), tempUnitConverter(meta['unit']))
+	],
+	'RH': lambda meta: [
+		('relative_humidity', ('RH',), relHumidUnitConverter(meta['unit']))
+	],
+	'Pyro': lambda meta: [
+		('surface_downwelling_shortwave_flux_in_air', ('Pyro',), identity)
+	],
+	'PAR_ref': lambda meta: [
+		('surface_downwelling_photosynthetic_photon_flux_in_air', ('PAR_ref',), identity)
+	],
 	# If Wind Direction is present, split into speed east and speed north it if we can find Wind Speed.
-	'WindDir': lambda d: [
-		('eastward_wind', extractXFactor(float(d['record']['WS_ms']), float(d['value']))),
-		('northward_wind', extractYFactor(float(d['record']['WS_ms']), float(d['value'])))
+	'WindDir': lambda meta: [
+		('eastward_wind', ('WS_ms', 'WindDir'), extractXFactor),
+		('northward_wind', ('WS_ms', 'WindDir'), extractYFactor)
 	],
 	# If Wind Speed is present, process it if we can find Wind Direction.
-	'WS_ms': lambda d: [(
-		'wind_speed',
-		speedUnit2MeterPerSecond(float(d['value']), d['meta']['unit'])
-	)],
-	'Rain_mm_Tot': lambda d: [(
-		'precipitation_rate',
-		float(d['value'])
-	)]
+	'WS_ms': lambda meta: [
+		('wind_speed', ('WS_ms',), speedUnitConverter(meta['unit']))
+	],
+	'Rain_mm_Tot': lambda meta: [
+		('precipitation_rate', ('Rain_mm_Tot',), identity)
+	]
 }
 
+# Column counterpart of PROP_MAPPING, where the values are whole columns as NumPy float arrays.
+# The unit converters work on arrays as they are, only the wind split needs its own functions.
+COLUMN_MAPPING = dict(PROP_MAPPING, **{
+	'WindDir': lambda meta: [
+		('eastward_wind', ('WS_ms', 'WindDir'), extractXFactorColumn),
+		('northward_wind', ('WS_ms', 'WindDir'), extractYFactorColumn)
+	]
+})
+
 # Aggregation functions for each property.
 PROP_AGGREGATE = {
 	'air_temperature': avg,
@@ -119,77 +180,327 @@ PROP_AGGREGATE = {
 	'precipitation_rate': sum
 }
 
+# ----------------------------------------------------------------------
+# Compile the header of a file into the conversions to run on each of its rows.
+# Returns the plan as (columns, steps):
+# columns -- indices of the columns to read, in the order their values are passed to transformValues
+# steps -- (property name, positions of the source values, converter) for each property
+def compilePropPlan(propMetaDict, prop_names, mapping = PROP_MAPPING):
+	columns = []
+	steps = []
+	for propName in prop_names:
+		if propName not in mapping:
+			continue
+		for name, sources, converter in mapping[propName](propMetaDict[propName]):
+			positions = []
+			for source in sources:
+				if source not in prop_names:
+					raise ValueError('Column "%s" is needed for "%s".' % (source, name))
+				index = prop_names.index(source)
+				if index not in columns:
+					columns.append(index)
+				positions.append(columns.index(index))
+			steps.append((name, tuple(positions), converter))
+	return columns, steps
+
+# Run the steps of a plan on the values read from its columns.
+# Values can be single numbers or whole columns, as long as they match the converters.
+def transformValues(steps, values):
+	newProps = {}
+	for name, positions, converter in steps:
+		if len(positions) == 1:
+			newProps[name] = converter(values[positions[0]])
+		else:
+			newProps[name] = converter(*[values[position] for position in positions])
+	return newProps
+
+# Convert one record read as a dictionary, compiling the plan for it on the spot.
+# Use compilePropPlan and transformValues when there are many records with the same header.
 def transformProps(propMetaDict, propValDict):
-	newProps = []
-	for propName in propValDict:
-		if propName in PROP_MAPPING:
-			newProps += PROP_MAPPING[propName]({
-				'meta': propMetaDict[propName],
-				'value': propValDict[propName],
-				'record': propValDict
-			})
-	return dict(newProps)
+	prop_names = propValDict.keys()
+	columns, steps = compilePropPlan(propMetaDict, prop_names)
+	return transformValues(steps, [float(propValDict[prop_names[index]]) for index in columns])
 
 def parse_file_header_line(linestr):
 	return map(lambda x: json.loads(x), str(linestr).split(','))
 
+# Get the offset of the given timezone from UTC in seconds.
+def utcOffsetSeconds(utc_offset):
+	offset = utc_offset.utcoffset(None)
+	return offset.days * 24 * 60 * 60 + offset.seconds
+
 # ----------------------------------------------------------------------
-# Parse the CSV file and return a list of dictionaries.
-def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
-	results = []
+# One parsed record.
+# Records are kept in memory by the thousands, so the times are stored as timestamps in seconds
+# and the geometry is shared by all the records of a station. The GeoJSON feature with ISO time
+# strings is only built by toGeoJSON(), when the record is uploaded.
+# The fields can also be read like dictionary keys, e.g. record['properties'].
+class DATRecord(object):
+	__slots__ = ('start_time', 'end_time', 'properties', 'geometry')
+
+	# @type {string}
+	type = 'Feature'
+
+	# @param {int} start_time  seconds since epoch
+	# @param {int} end_time  seconds since epoch
+	# @param {dict} properties
+	# @param {dict} geometry  Shared by all the records of the station, never modify it.
+	def __init__(self, start_time, end_time, properties, geometry = STATION_GEOMETRY):
+		self.start_time = start_time
+		self.end_time = end_time
+		self.properties = properties
+		self.geometry = geometry
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __repr__(self):
+		return 'DATRecord(%r, %r, %r)' % (self.start_time, self.end_time, self.properties)
+
+	# Build the GeoJSON feature of the record with the times rendered in the given timezone.
+	def toGeoJSON(self, tz):
+		return {
+			'start_time': TimeStamp2ISOTimeString(self.start_time, tz),
+			'end_time': TimeStamp2ISOTimeString(self.end_time, tz),
+			'properties': self.properties,
+			'type': self.type,
+			'geometry': self.geometry
+		}
+
+# ----------------------------------------------------------------------
+# A batch of parsed records stored column by column.
+# Records are only built as dictionaries when they are asked for, so the batch can be passed
+# anywhere a list of parsed records is expected, including aggregate().
+class ColumnBatch(object):
+	# @param {numpy.ndarray} timestamps  int64 timestamps of the records in seconds.
+	# @param {dict} properties  Transformed property name -> float64 column.
+	def __init__(self, timestamps, properties, geometry = STATION_GEOMETRY):
+		self.timestamps = timestamps
+		self.properties = properties
+		self.geometry = geometry
+
+	def __len__(self):
+		return len(self.timestamps)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			# Slicing NumPy arrays gives views, so no data is copied here.
+			return ColumnBatch(
+				self.timestamps[index],
+				dict((key, column[index]) for key, column in self.properties.iteritems()),
+				self.geometry
+			)
+		return self.record(index)
+
+	def __iter__(self):
+		for index in xrange(len(self)):
+			yield self.record(index)
+
+	def __add__(self, other):
+		if isinstance(other, ColumnBatch):
+			return ColumnBatch(
+				np.concatenate((self.timestamps, other.timestamps)),
+				dict((key, np.concatenate((column, other.properties[key]))) for key, column in self.properties.iteritems()),
+				self.geometry
+			)
+		if len(other) == 0:
+			return self
+		return self.records() + list(other)
+
+	def __radd__(self, other):
+		if len(other) == 0:
+			return self
+		return list(other) + self.records()
+
+	def record(self, index):
+		timestamp = int(self.timestamps[index])
+		return DATRecord(
+			timestamp,
+			timestamp,
+			dict((key, float(column[index])) for key, column in self.properties.iteritems()),
+			self.geometry
+		)
+
+	# Build the list of DATRecords parse_file returns.
+	def records(self):
+		timestamps = self.timestamps.tolist()
+		keys = self.properties.keys()
+		# tolist() converts every column to Python floats in one go.
+		rows = zip(*[self.properties[key].tolist() for key in keys]) if keys else [()] * len(self)
+		geometry = self.geometry
+		return [DATRecord(timestamp, timestamp, dict(zip(keys, row)), geometry) for timestamp, row in zip(timestamps, rows)]
+
+# ----------------------------------------------------------------------
+# Read the TOA5 header lines and leave the file at the first data row.
+# Returns the property details and the list of property names in column order.
+def parse_file_header(csvfile):
+	# First line is always the header.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
+	header_lines = [
+		csvfile.readline()
+	]
+
+	file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
+
+	if file_format != 'TOA5':
+		raise ValueError('Unsupported format "%s".' % file_format)
+
+	# For TOA5, there are in total 4 header lines.
+	# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
+	while (len(header_lines) < 4):
+		header_lines.append(csvfile.readline())
+
+	prop_names = parse_file_header_line(header_lines[1])
+	prop_units = parse_file_header_line(header_lines[2])
+	prop_sample_method = parse_file_header_line(header_lines[3])
+
+	# Associate the above lists.
+	props = dict()
+	for x in xrange(len(prop_names)):
+		props[prop_names[x]] = {
+			'title': prop_names[x],
+			'unit': prop_units[x],
+			'sample_method': prop_sample_method[x]
+		}
+	# [DEBUG] Print the property details if needed.
+	#print json.dumps(props)
+
+	return props, prop_names
+
+# ----------------------------------------------------------------------
+# Parse the CSV file column by column and return a ColumnBatch.
+def parse_file_columns(filepath, utc_offset = ISO_8601_UTC_MEAN):
 	with open(filepath) as csvfile:
-		# First line is always the header.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=41#manual}
-		header_lines = [
-			csvfile.readline()
-		]
-
-		file_format, station_name, logger_model, logger_serial, os_version, dld_file, dld_sig, table_name = parse_file_header_line(header_lines[0])
-
-		if file_format != 'TOA5':
-			raise ValueError('Unsupported format "%s".' % file_format)
-
-		# For TOA5, there are in total 4 header lines.
-		# @see {@link https://www.manualslib.com/manual/538296/Campbell-Cr9000.html?page=43#manual}
-		while (len(header_lines) < 4):
-			header_lines.append(csvfile.readline())
-
-		prop_names = parse_file_header_line(header_lines[1])
-		prop_units = parse_file_header_line(header_lines[2])
-		prop_sample_method = parse_file_header_line(header_lines[3])
-
-		# Associate the above lists.
-		props = dict()
-		for x in xrange(len(prop_names)):
-			props[prop_names[x]] = {
-				'title': prop_names[x],
-				'unit': prop_units[x],
-				'sample_method': prop_sample_method[x]
-			}
-		# [DEBUG] Print the property details if needed.
-		#print json.dumps(props)
-
-		reader = csv.DictReader(csvfile, fieldnames=prop_names)
-		for row in reader:
-			timestamp = datetime.datetime.strptime(row['TIMESTAMP'], '%Y-%m-%d %H:%M:%S').isoformat() + utc_offset.tzname(None)
-			newResult = {
-				# @type {string}
-				'start_time': timestamp,
-				# @type {string}
-				'end_time': timestamp,
-				'properties': transformProps(props, row),
-				# @type {string}
-				'type': 'Feature',
-				'geometry': STATION_GEOMETRY
-			}
-			# Enable this if the raw data needs to be kept.
-# 			newResult['properties']['_raw'] = {
-# 				'data': row,
-# 				'units': prop_units,
-# 				'sample_method': prop_sample_method
-# 			}
-			results.append(newResult)
-	return results
+		props, prop_names = parse_file_header(csvfile)
+
+		# Transpose the rows into columns, skipping blank lines like csv.DictReader does.
+		rows = [row for row in csv.reader(csvfile) if row]
+		columns = zip(*rows) if rows else [()] * len(prop_names)
+
+	# TOA5 timestamps are in the logger's local time, NumPy reads them as if they were UTC.
+	timestamps = np.array(columns[prop_names.index('TIMESTAMP')], dtype='datetime64[s]').astype(np.int64) - utcOffsetSeconds(utc_offset)
+
+	# Only the columns used by the plan need to be converted to numbers.
+	planColumns, steps = compilePropPlan(props, prop_names, COLUMN_MAPPING)
+	values = [np.array(columns[index], dtype=np.float64) for index in planColumns]
+
+	return ColumnBatch(timestamps, transformValues(steps, values))
+
+# Unpack the arguments for parse_file_columns in a worker process.
+def _parse_file_columns_worker(args):
+	return parse_file_columns(*args)
+
+# ----------------------------------------------------------------------
+# Parse several CSV files in parallel with a pool of worker processes.
+# Returns (filepath, ColumnBatch) pairs for the files with records, ordered by the time
+# of their first record so they can be fed to the aggregation one after another.
+# Files whose records overlap in time are merged into one batch, see merge_batches.
+# @param {int} workers  Number of worker processes, all CPUs if None.
+def parse_files_columns(filepaths, utc_offset = ISO_8601_UTC_MEAN, workers = None):
+	jobs = [(filepath, utc_offset) for filepath in filepaths]
+	if workers == 1 or len(jobs) < 2:
+		batches = map(_parse_file_columns_worker, jobs)
+	else:
+		pool = multiprocessing.Pool(workers)
+		try:
+			batches = pool.map(_parse_file_columns_worker, jobs)
+		finally:
+			pool.close()
+			pool.join()
+
+	parsedFiles = [(filepath, batch) for filepath, batch in zip(filepaths, batches) if len(batch) > 0]
+	parsedFiles.sort(key=lambda parsedFile: parsedFile[1].timestamps[0])
+	return merge_batches(parsedFiles)
+
+# Merge the batches of files which overlap in time, so the records of the batches are in time order
+# from one batch to the next. A merged batch is paired with the path of the last of its files.
+# @param {list} parsedFiles  (filepath, ColumnBatch) pairs sorted by the time of their first record.
+def merge_batches(parsedFiles):
+	merged = []
+	for filepath, batch in parsedFiles:
+		if merged and batch.timestamps[0] < merged[-1][1].timestamps[-1]:
+			group = merged[-1][1] + batch
+			# A stable sort keeps the records with the same time in file order.
+			order = np.argsort(group.timestamps, kind='mergesort')
+			batch = ColumnBatch(
+				group.timestamps[order],
+				dict((key, column[order]) for key, column in group.properties.iteritems()),
+				group.geometry
+			)
+			merged[-1] = (filepath, batch)
+		else:
+			merged.append((filepath, batch))
+	return merged
+
+# ----------------------------------------------------------------------
+# Parse the CSV file and yield the records one at a time.
+# Only one row is held in memory, use this with StreamAggregator to process files of any size.
+def iter_records(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	offset = utcOffsetSeconds(utc_offset)
+	with open(filepath) as csvfile:
+		props, prop_names = parse_file_header(csvfile)
+
+		columns, steps = compilePropPlan(props, prop_names)
+		timestampIndex = prop_names.index('TIMESTAMP')
+
+		for row in csv.reader(csvfile):
+			# Skip blank lines like csv.DictReader does.
+			if not row:
+				continue
+			timestamp = TOA5TimeString2TimeStamp(row[timestampIndex]) - offset
+			yield DATRecord(timestamp, timestamp, transformValues(steps, [float(row[index]) for index in columns]))
+
+# ----------------------------------------------------------------------
+# Read the time of the first record of the CSV file, without parsing the rest of it.
+# Returns None if the file has no records.
+def peek_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	with open(filepath) as csvfile:
+		props, prop_names = parse_file_header(csvfile)
+		timestampIndex = prop_names.index('TIMESTAMP')
+		for row in csv.reader(csvfile):
+			if row:
+				return TOA5TimeString2TimeStamp(row[timestampIndex]) - utcOffsetSeconds(utc_offset)
+	return None
+
+# ----------------------------------------------------------------------
+# Yield the records of several CSV files in time order, as (filepath, DATRecord) pairs.
+# The files are ordered by their first record with peek_file and the records are merged with a heap,
+# so the files can be listed in any order and can overlap. A file is only opened once the merge
+# reaches its first record, so only the files which overlap are read at the same time.
+# Records with the same time come in file order.
+# Note: the records of each file have to be sorted by time.
+def merge_records(filepaths, utc_offset = ISO_8601_UTC_MEAN):
+	pending = []
+	for order, filepath in enumerate(filepaths):
+		firstTime = peek_file(filepath, utc_offset)
+		if firstTime != None:
+			pending.append((firstTime, order, filepath))
+	pending.sort(reverse=True)
+
+	# Heap of (time, file order, row order, record, records, filepath), one entry per open file.
+	heap = []
+	def push(order, row, records, filepath):
+		record = next(records, None)
+		if record != None:
+			heapq.heappush(heap, (record.end_time, order, row, record, records, filepath))
+
+	while heap or pending:
+		# Open the files starting before the next record.
+		while pending and (not heap or pending[-1][:2] <= heap[0][:2]):
+			firstTime, order, filepath = pending.pop()
+			push(order, 0, iter_records(filepath, utc_offset), filepath)
+		time, order, row, record, records, filepath = heapq.heappop(heap)
+		yield filepath, record
+		push(order, row + 1, records, filepath)
+
+# ----------------------------------------------------------------------
+# Parse the CSV file and return a list of DATRecords.
+# Record times are kept as timestamps in seconds, ISO strings are only rendered for aggregated packages.
+def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
+	return parse_file_columns(filepath, utc_offset).records()
 
 # ----------------------------------------------------------------------
 # Aggregate the list of parsed results.
@@ -198,8 +509,14 @@ def parse_file(filepath, utc_offset = ISO_8601_UTC_MEAN):
 # which should be fed back into the function to continue or end the aggregation.
 # If there's no more data to input, provide None and the aggregation will stop.
 # When aggregation ended, the state package returned should be None to indicate that.
-# Note: data has to be sorted by time.
+# The state package only holds the running accumulators of the open window, never the records,
+# and it can be serialized as JSON.
+# Note: data should be sorted by time, records older than the open window are dropped, see StreamAggregator.
+# Note: inputData is a list of DATRecords or a ColumnBatch.
 # Note: cutoffSize is in seconds.
+# Note: cutoffSize can also be a list of sizes, to aggregate into all of them in one pass.
+#       The packages are then a dictionary of the list of packages of each size, see RollupAggregator.
+# Note: record times and the times kept in the state are timestamps in seconds.
 def aggregate(cutoffSize, tz, inputData, state):
 	# This function should always return this complex package no matter what happens.
 	result = {
@@ -208,96 +525,452 @@ def aggregate(cutoffSize, tz, inputData, state):
 		'state': None if state == None else dict(state)
 	}
 
+	if isinstance(cutoffSize, (list, tuple)):
+		aggregator = RollupAggregator(cutoffSize, tz, state)
+	else:
+		aggregator = StreamAggregator(cutoffSize, tz, state)
+
 	# The aggregation ends when no more data is available. (inputData is None)
-	# In which case it needs to recover leftover data in the state package.
+	# In which case it needs to recover the open window from the state package.
 	if inputData == None:
-		debug_log('Ending aggregation...')
+		result['packages'] += aggregator.finish()
+		# Mark state with None to indicate the aggregation is done.
+		result['state'] = None
+	else:
+		debug_log('Aggregating...')
 
-		# The aggregation is ending, try recover leftover data from the state.
-		if state == None:
-			# There is nothing to do.
-			pass
+		if isinstance(inputData, ColumnBatch):
+			result['packages'] += aggregator.addColumns(inputData)
 		else:
-			# Recover leftover data from state.
+			result['packages'] += aggregator.feed(inputData)
 
-			data = state['leftover']
+		# The open window is saved into the state.
+		result['state'] = aggregator.state()
 
-			if len(data) == 0:
-				# There is nothing to recover.
-				pass
-			else:
-				# Aggregate leftover data.
-				# Assume leftover data never contain more data than the cutoff allows.
+	if isinstance(aggregator, RollupAggregator):
+		packages = dict((size, []) for size in aggregator.cutoffSizes)
+		for size, newPackage in result['packages']:
+			packages[size].append(newPackage)
+		result['packages'] = packages
 
-				startTime = state['starttime']
-				# Use the latest date in the data entries.
-				# Assuming the data is always sorted, the last one should be the latest.
-				endTime = ISOTimeString2TimeStamp(data[-1]['end_time'])
+	return result
 
-				newPackage = aggregate_chunk(data, tz, startTime, endTime)
-				if newPackage != None:
-					result['packages'].append(newPackage)
+# ----------------------------------------------------------------------
+# Running accumulators for the properties of one window.
+# Each property keeps [sum, count, min, max, mean, M2], so the state of a window is O(#properties).
+# The mean and M2 (the sum of squared differences from the mean) are updated with Welford's method
+# and merged with Chan's formula, which stay accurate where sum of squares would cancel out.
+ACC_SUM, ACC_COUNT, ACC_MIN, ACC_MAX, ACC_MEAN, ACC_M2 = range(6)
 
-			# Mark state with None to indicate the aggregation is done.
-			result['state'] = None
-	else:
-		debug_log('Aggregating...')
+# How each aggregation function in PROP_AGGREGATE is computed from an accumulator.
+ACCUMULATED_AGGREGATE = {
+	avg: lambda acc: float(acc[ACC_SUM]) / max(acc[ACC_COUNT], 1),
+	sum: lambda acc: acc[ACC_SUM]
+}
 
-		data = inputData
+# Statistics which can be added to the packages, computed from an accumulator.
+# Note: std is the population standard deviation of the window.
+ACCUMULATED_STATISTICS = {
+	'mean': lambda acc: acc[ACC_MEAN],
+	'min': lambda acc: acc[ACC_MIN],
+	'max': lambda acc: acc[ACC_MAX],
+	'std': lambda acc: math.sqrt(acc[ACC_M2] / acc[ACC_COUNT]),
+	'count': lambda acc: acc[ACC_COUNT],
+	'sum': lambda acc: acc[ACC_SUM]
+}
 
-		# More data is provided, continue aggregation.
-		if state == None:
-			debug_log('Fresh start...')
-			# There is no previous state, starting afresh.
+# Statistics added to the packages for each property on top of its PROP_AGGREGATE value,
+# as "<property>_<statistic>", e.g. {'air_temperature': ['min', 'max']}.
+PROP_STATISTICS = {}
+
+# Parse statistics given as "property:statistic,statistic" strings into a PROP_STATISTICS dictionary.
+def parseStatistics(specs):
+	statistics = {}
+	for spec in specs:
+		propName, sep, names = spec.partition(':')
+		if propName not in PROP_AGGREGATE:
+			raise ValueError('Unsupported property "%s".' % propName)
+		for name in names.split(','):
+			if name not in ACCUMULATED_STATISTICS:
+				raise ValueError('Unsupported statistic "%s".' % name)
+			statistics.setdefault(propName, []).append(name)
+	return statistics
 
-			# Use the earliest date in the input data entries.
-			# Assuming the input data is always sorted, the first one should be the earliest.
-			startTime = ISOTimeString2TimeStamp(data[0]['start_time'])
+# Accumulators saved before mean and M2 were kept have 4 entries.
+# The mean can be recovered from the sum, M2 can't, so the std of that window is unknown.
+def upgradeAccumulator(acc):
+	acc = list(acc)
+	if len(acc) == 4:
+		acc += [float(acc[ACC_SUM]) / max(acc[ACC_COUNT], 1), float('nan')]
+	return acc
 
+# Add the properties of one record to the accumulators.
+def accumulateProps(accumulators, properties):
+	for key in properties:
+		# Properties start with "_" shouldn't be processed.
+		# If there is no aggregation function, ignore the property.
+		if key.startswith('_') or key not in PROP_AGGREGATE:
+			continue
+		value = properties[key]
+		acc = accumulators.get(key)
+		if acc == None:
+			accumulators[key] = [value, 1, value, value, float(value), 0.0]
 		else:
-			debug_log('Continuing...')
-			# Resume aggregation from a previous state.
-
-			startTime = state['starttime']
-			# Left over data should be part of the data being processed.
-			data = state['leftover'] + inputData
-
-		startIndex = 0
-
-		# Keep aggregating until all the data is consumed.
-		while startIndex < len(data):
-			# Find the nearest cut-off point.
-			endTimeCutoff = startTime - startTime % cutoffSize + cutoffSize
-			# Scan the input data to find the portion that fits in the cutoff.
-			endIndex = startIndex
-			while endIndex < len(data) and ISOTimeString2TimeStamp(data[endIndex]['end_time']) < endTimeCutoff:
-				endIndex += 1
-
-			# If everything fits in the cutoff, there may be more data in the next run.
-			# Otherwise, these data should be aggregated.
-			if endIndex >= len(data):
-				# End of data reached, but cutoff is not.
-				# Save everything into state.
-				result['state'] = {
-					'starttime': startTime,
-					'leftover': data[startIndex:]
-				}
-			else:
-				# Cutoff reached.
-				# Aggregate this chunk.
-				newPackage = aggregate_chunk(data[startIndex:endIndex], tz, startTime, endTimeCutoff)
-				if newPackage != None:
-					result['packages'].append(newPackage)
-
-			# Update variables for the next loop.
-			startTime = endTimeCutoff
-			startIndex = endIndex
-
-		# The above loop should end with some chunks aggregated into result['packages'],
-		# with the last chunk saved in result['state']['leftover']
+			acc[ACC_SUM] += value
+			acc[ACC_COUNT] += 1
+			if value < acc[ACC_MIN]:
+				acc[ACC_MIN] = value
+			if value > acc[ACC_MAX]:
+				acc[ACC_MAX] = value
+			delta = value - acc[ACC_MEAN]
+			acc[ACC_MEAN] += delta / acc[ACC_COUNT]
+			acc[ACC_M2] += delta * (value - acc[ACC_MEAN])
+
+# Add whole columns of values to the accumulators.
+# The columns are reduced as a single window, so the values stay in NumPy arrays throughout.
+def accumulateColumns(accumulators, columnDict):
+	count = max([len(column) for column in columnDict.values()] or [0])
+	if count == 0:
+		return
+	mergeAccumulators(accumulators, reduceColumns(columnDict, np.array([0]), [count])[0])
 
+# Compute the accumulators of every window of records at once.
+# @param {dict} columnDict  Property name -> column, sorted by time.
+# @param {numpy.ndarray} starts  Index of the first record of each window.
+# @param {list} counts  Number of records in each window.
+# @return {list} One accumulators dictionary per window.
+def reduceColumns(columnDict, starts, counts):
+	windowAccumulators = [{} for x in xrange(len(starts))]
+	for key in columnDict:
+		if key.startswith('_') or key not in PROP_AGGREGATE:
+			continue
+		column = columnDict[key]
+		sums = np.add.reduceat(column, starts)
+		# fmin and fmax skip NaN values like the comparisons in accumulateProps do.
+		mins = np.fmin.reduceat(column, starts).tolist()
+		maxs = np.fmax.reduceat(column, starts).tolist()
+		# The mean of each window is spread back over its records to get M2 in a second pass.
+		means = sums / counts
+		m2s = np.add.reduceat(np.square(column - np.repeat(means, counts)), starts).tolist()
+		sums = sums.tolist()
+		means = means.tolist()
+		for index in xrange(len(starts)):
+			windowAccumulators[index][key] = [sums[index], counts[index], mins[index], maxs[index], means[index], m2s[index]]
+	return windowAccumulators
+
+# Merge the source accumulators into the target accumulators.
+def mergeAccumulators(target, source):
+	for key in source:
+		acc = target.get(key)
+		if acc == None:
+			target[key] = list(source[key])
+		else:
+			other = source[key]
+			count = acc[ACC_COUNT] + other[ACC_COUNT]
+			delta = other[ACC_MEAN] - acc[ACC_MEAN]
+			acc[ACC_M2] += other[ACC_M2] + delta * delta * acc[ACC_COUNT] * other[ACC_COUNT] / count
+			acc[ACC_MEAN] += delta * other[ACC_COUNT] / count
+			acc[ACC_SUM] += other[ACC_SUM]
+			acc[ACC_COUNT] = count
+			acc[ACC_MIN] = min(acc[ACC_MIN], other[ACC_MIN])
+			acc[ACC_MAX] = max(acc[ACC_MAX], other[ACC_MAX])
+
+# Compute the aggregated properties from the accumulators.
+# @param {dict} statistics  Extra statistics of each property, see PROP_STATISTICS.
+def accumulatedProps(accumulators, statistics = None):
+	if statistics == None:
+		statistics = PROP_STATISTICS
+	result = {}
+	for key in accumulators:
+		func = PROP_AGGREGATE[key]
+		result[key] = ACCUMULATED_AGGREGATE[func](accumulators[key])
+		for name in statistics.get(key, []):
+			result[key + '_' + name] = ACCUMULATED_STATISTICS[name](accumulators[key])
 	return result
 
+# ----------------------------------------------------------------------
+# Aggregate a stream of parsed records, one record at a time.
+# Same windows as aggregate(), but each package is yielded as soon as its cutoff has passed.
+# Only the accumulators of the open window are kept, never the records.
+# The state package has the same layout as the one used by aggregate().
+# Note: records should come in time order. Records out of order within the open window are added
+#       to it, but a record older than the open window belongs to a window which is already packaged,
+#       so it is dropped and counted in dropped. The windows never go back in time.
+class StreamAggregator(object):
+	# @param {function} windowClosed  Called with (startTime, endTime, count, accumulators) of each
+	#                                 window with records as it is closed, see RollupAggregator.
+	# @param {dict} statistics  Extra statistics of each property, PROP_STATISTICS if None.
+	# @param {int} closedUntil  Records before this time are dropped, e.g. the end of a finished aggregation.
+	def __init__(self, cutoffSize, tz, state = None, windowClosed = None, statistics = None, closedUntil = None):
+		self.cutoffSize = cutoffSize
+		self.tz = tz
+		self.windowClosed = windowClosed
+		self.statistics = statistics
+		self.closedUntil = closedUntil
+		# Number of records dropped for coming after their window was packaged.
+		self.dropped = 0
+		if state == None:
+			self.reset(None)
+		else:
+			self.startTime = state['starttime']
+			self.endTime = state['endtime']
+			self.count = state['count']
+			self.accumulators = dict((key, upgradeAccumulator(acc)) for key, acc in state['accumulators'].iteritems())
+			self.closedUntil = max(self.closedUntil, state.get('closeduntil'))
+
+	# Open a new, empty window starting at the given time.
+	def reset(self, startTime):
+		self.startTime = startTime
+		self.endTime = None
+		self.count = 0
+		self.accumulators = {}
+
+	# Close the open window at the given time and return its package, None if it's empty.
+	# Records before that time are dropped from then on.
+	def package(self, endTime):
+		self.closedUntil = max(self.closedUntil, endTime)
+		if self.count == 0:
+			# There is nothing to aggregate.
+			return None
+		if self.windowClosed != None:
+			self.windowClosed(self.startTime, self.endTime, self.count, self.accumulators)
+		return {
+			'start_time': TimeStamp2ISOTimeString(self.startTime, self.tz),
+			'end_time': TimeStamp2ISOTimeString(endTime, self.tz),
+			'properties': accumulatedProps(self.accumulators, self.statistics),
+			'type': 'Point',
+			'geometry': STATION_GEOMETRY
+		}
+
+	# Find the nearest cut-off point of the open window.
+	def cutoff(self):
+		return self.startTime - self.startTime % self.cutoffSize + self.cutoffSize
+
+	# Whether a record at the given time belongs to a window which is already packaged, or one before the open window.
+	def late(self, time):
+		if self.closedUntil != None and time < self.closedUntil:
+			return True
+		return self.startTime != None and time < self.cutoff() - self.cutoffSize
+
+	# Add one record and return the list of packages completed by it.
+	def add(self, record):
+		packages = []
+
+		if self.late(record.end_time):
+			self.dropped += 1
+			return packages
+
+		if self.startTime == None:
+			debug_log('Fresh start...')
+			# The first record opens the first window.
+			self.startTime = record.start_time
+
+		endTimeCutoff = self.cutoff()
+		if record.end_time >= endTimeCutoff:
+			# Cutoff reached.
+			# Aggregate the window and move on to the window of this record, skipping any empty ones.
+			newPackage = self.package(endTimeCutoff)
+			if newPackage != None:
+				packages.append(newPackage)
+			self.reset(record.end_time - record.end_time % self.cutoffSize)
+
+		accumulateProps(self.accumulators, record.properties)
+		self.count += 1
+		# A record out of order within the window doesn't move the end of the window back.
+		self.startTime = min(self.startTime, record.start_time)
+		self.endTime = max(self.endTime, record.end_time)
+		return packages
+
+	# Add all the records and yield the packages as they are completed.
+	def feed(self, records):
+		for record in records:
+			for newPackage in self.add(record):
+				yield newPackage
+
+	# Add a ColumnBatch and return the list of packages completed by it.
+	# Each record is assigned to its window in one pass and all the windows are reduced
+	# at once with NumPy, so the only Python loop is over the windows.
+	def addColumns(self, columnBatch):
+		packages = []
+		timestamps = columnBatch.timestamps
+
+		if np.any(np.diff(timestamps) < 0):
+			# A stable sort keeps the records with the same time in batch order.
+			order = np.argsort(timestamps, kind='mergesort')
+			columnBatch = ColumnBatch(
+				timestamps[order],
+				dict((key, column[order]) for key, column in columnBatch.properties.iteritems()),
+				columnBatch.geometry
+			)
+			timestamps = columnBatch.timestamps
+
+		if self.closedUntil != None and len(timestamps) > 0 and timestamps[0] < self.closedUntil:
+			# Drop the records of the windows which are already packaged.
+			first = np.searchsorted(timestamps, self.closedUntil)
+			self.dropped += int(first)
+			columnBatch = columnBatch[first:]
+			timestamps = columnBatch.timestamps
+
+		if len(timestamps) == 0:
+			return packages
+
+		if self.startTime == None:
+			debug_log('Fresh start...')
+			self.startTime = int(timestamps[0])
+
+		# The window of each record is the start time of its cutoff.
+		buckets = timestamps - timestamps % self.cutoffSize
+		# Timestamps are sorted, so each window is a run of records.
+		starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+		ends = np.append(starts[1:], len(timestamps))
+
+		windowStartTimes = timestamps[starts].tolist()
+		windowEndTimes = timestamps[ends - 1].tolist()
+		windowCounts = (ends - starts).tolist()
+		windowAccumulators = reduceColumns(columnBatch.properties, starts, windowCounts)
+
+		for index in xrange(len(windowStartTimes)):
+			packages += self.addAccumulated(windowStartTimes[index], windowEndTimes[index],
+											windowCounts[index], windowAccumulators[index])
+
+		return packages
+
+	# Add the accumulators of a run of records which all fall in the same window
+	# and return the list of packages completed by it.
+	# @param {int} startTime  Time of the first record of the run.
+	# @param {int} endTime  Time of the last record of the run.
+	def addAccumulated(self, startTime, endTime, count, accumulators):
+		packages = []
+
+		if self.late(startTime):
+			self.dropped += count
+			return packages
+
+		if self.startTime == None:
+			debug_log('Fresh start...')
+			self.startTime = startTime
+
+		windowStart = startTime - startTime % self.cutoffSize
+		if windowStart > self.cutoff() - self.cutoffSize:
+			# Cutoff reached.
+			newPackage = self.package(self.cutoff())
+			if newPackage != None:
+				packages.append(newPackage)
+			self.reset(windowStart)
+
+		mergeAccumulators(self.accumulators, accumulators)
+		self.count += count
+		self.startTime = min(self.startTime, startTime)
+		self.endTime = max(self.endTime, endTime)
+		return packages
+
+	# End the aggregation and yield the package of the last window, if any.
+	def finish(self):
+		debug_log('Ending aggregation...')
+		if self.startTime != None:
+			# Use the latest date in the data entries.
+			newPackage = self.package(self.endTime)
+			if newPackage != None:
+				yield newPackage
+			# The last record is in that package too.
+			self.closedUntil = self.endTime + 1
+		self.reset(None)
+
+	# The state package to continue the aggregation from, None if there is nothing to continue.
+	def state(self):
+		if self.startTime == None:
+			return None
+		state = {
+			'starttime': self.startTime,
+			# Time of the latest record, the end of the last package.
+			'endtime': self.endTime,
+			'count': self.count,
+			'accumulators': dict((key, list(acc)) for key, acc in self.accumulators.iteritems())
+		}
+		if self.closedUntil != None:
+			state['closeduntil'] = self.closedUntil
+		return state
+
+# ----------------------------------------------------------------------
+# Sort the cutoff sizes and check each one is a multiple of the size below it.
+# Raises ValueError naming the first size that isn't.
+def checkCutoffSizes(cutoffSizes):
+	cutoffSizes = sorted(set(cutoffSizes))
+	for x in xrange(1, len(cutoffSizes)):
+		if cutoffSizes[x] % cutoffSizes[x - 1] != 0:
+			raise ValueError('Cutoff size %s is not a multiple of %s.' % (cutoffSizes[x], cutoffSizes[x - 1]))
+	return cutoffSizes
+
+# Aggregate a stream of parsed records into windows of several cutoff sizes in one pass.
+# Only the finest size sees the records, each coarser size is built from the accumulators
+# of the windows closed by the size below it. Every size has to be a multiple of the size
+# below it so its windows are made of whole finer windows.
+# Packages are returned as (cutoffSize, package) pairs, the state package holds the
+# state package of each size by the size as a string, so it can be serialized as JSON.
+# Note: records should come in time order, late records are dropped by the finest size, see StreamAggregator.
+class RollupAggregator(object):
+	def __init__(self, cutoffSizes, tz, state = None, statistics = None, closedUntil = None):
+		self.cutoffSizes = checkCutoffSizes(cutoffSizes)
+
+		if state == None:
+			state = {}
+		# Packages of the coarser sizes completed while handling the current input.
+		self.pending = []
+		self.aggregators = []
+		for cutoffSize in reversed(self.cutoffSizes):
+			windowClosed = self.rollup(self.aggregators[0]) if self.aggregators else None
+			self.aggregators.insert(0, StreamAggregator(cutoffSize, tz, state.get(str(cutoffSize)), windowClosed, statistics))
+		self.aggregators[0].closedUntil = max(self.aggregators[0].closedUntil, closedUntil)
+
+	# Records before this time are dropped, see StreamAggregator.
+	@property
+	def closedUntil(self):
+		return self.aggregators[0].closedUntil
+
+	# Number of records dropped for coming after their window was packaged.
+	@property
+	def dropped(self):
+		return self.aggregators[0].dropped
+
+	# Make the callback passing the windows closed by a finer aggregator on to the given one.
+	def rollup(self, aggregator):
+		def windowClosed(startTime, endTime, count, accumulators):
+			for newPackage in aggregator.addAccumulated(startTime, endTime, count, accumulators):
+				self.pending.append((aggregator.cutoffSize, newPackage))
+		return windowClosed
+
+	# Tag the packages of the finest size and collect the ones of the coarser sizes.
+	def collect(self, packages):
+		result = [(self.cutoffSizes[0], newPackage) for newPackage in packages] + self.pending
+		self.pending = []
+		return result
+
+	def add(self, record):
+		return self.collect(self.aggregators[0].add(record))
+
+	def feed(self, records):
+		for record in records:
+			for newPackage in self.add(record):
+				yield newPackage
+
+	def addColumns(self, columnBatch):
+		return self.collect(self.aggregators[0].addColumns(columnBatch))
+
+	# End the aggregation of every size, finest first so its last window reaches the coarser ones.
+	def finish(self):
+		for aggregator in self.aggregators:
+			for newPackage in aggregator.finish():
+				self.pending.append((aggregator.cutoffSize, newPackage))
+			for newPackage in self.collect([]):
+				yield newPackage
+
+	def state(self):
+		state = {}
+		for aggregator in self.aggregators:
+			if aggregator.state() != None:
+				state[str(aggregator.cutoffSize)] = aggregator.state()
+		return state if state else None
+
 # Helper function for aggregating a chunk of data.
 # @param {timestamp} startTime
 # @param {timestamp} endTime
@@ -306,41 +979,27 @@ def aggregate_chunk(dataChunk, tz, startTime, endTime):
 		# There is nothing to aggregate.
 		return None
 	else:
-		# Prepare the list of properties for aggregation.
-		propertiesList = map(lambda x: x['properties'], dataChunk)
+		if isinstance(dataChunk, ColumnBatch):
+			accumulators = {}
+			accumulateColumns(accumulators, dataChunk.properties)
+			properties = accumulatedProps(accumulators)
+		else:
+			# Prepare the list of properties for aggregation.
+			properties = aggregateProps(map(lambda x: x.properties, dataChunk))
 
 		return {
-			'start_time': datetime.datetime.fromtimestamp(startTime, tz).isoformat(),
-			'end_time': datetime.datetime.fromtimestamp(endTime, tz).isoformat(),
-			'properties': aggregateProps(propertiesList),
+			'start_time': TimeStamp2ISOTimeString(startTime, tz),
+			'end_time': TimeStamp2ISOTimeString(endTime, tz),
+			'properties': properties,
 			'type': 'Point',
 			'geometry': STATION_GEOMETRY
 		}
 
 def aggregateProps(propertiesList):
-	collection = {}
-
+	accumulators = {}
 	for properties in propertiesList:
-		for key in properties:
-			# Properties start with "_" shouldn't be processed.
-			if key.startswith('_'):
-				continue
-			value = properties[key]
-			# Collect property values and save them into collection
-			if key not in collection:
-				collection[key] = [value]
-			else:
-				collection[key].append(value)
-
-	result = {}
-	for key in properties:
-		# If there is no aggregation function, ignore the property.
-		if key not in PROP_AGGREGATE:
-			continue
-		func = PROP_AGGREGATE[key]
-		result[key] = func(collection[key])
-
-	return result
+		accumulateProps(accumulators, properties)
+	return accumulatedProps(accumulators)
 
 if __name__ == "__main__":
 	size = 5 * 60
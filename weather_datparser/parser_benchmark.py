@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+'''
+parser_benchmark.py
+
+Time parser.py on synthetic TOA5 files of growing size and write the results as JSON.
+Each benchmark runs in a process of its own, so the peak memory reported is its own.
+
+To run the benchmarks, use:
+python parser_benchmark.py [--rows 1000 10000 ...] [--output results.json]
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+
+import dateutil.tz
+import numpy as np
+
+import parser
+import toa5_generator
+
+TZ = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+
+DEFAULT_ROWS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+
+
+def bench_parse_file(filepath, cutoff):
+	start = time.time()
+	records = parser.parse_file(filepath, TZ)
+	return time.time() - start, len(records)
+
+
+def bench_aggregate(filepath, cutoff):
+	records = parser.parse_file(filepath, TZ)
+	start = time.time()
+	result = parser.aggregate(cutoff, TZ, records, None)
+	packages = result['packages'] + parser.aggregate(cutoff, TZ, None, result['state'])['packages']
+	return time.time() - start, len(packages)
+
+
+def bench_aggregate_columns(filepath, cutoff):
+	batch = parser.parse_file_columns(filepath, TZ)
+	start = time.time()
+	result = parser.aggregate(cutoff, TZ, batch, None)
+	packages = result['packages'] + parser.aggregate(cutoff, TZ, None, result['state'])['packages']
+	return time.time() - start, len(packages)
+
+
+def bench_aggregate_chunk(filepath, cutoff):
+	records = parser.parse_file(filepath, TZ)
+	start = time.time()
+	parser.aggregate_chunk(records, TZ, records[0].start_time, records[-1].end_time)
+	return time.time() - start, 1
+
+
+def bench_stream(filepath, cutoff):
+	# Parse and aggregate one record at a time, the way the extractor does.
+	start = time.time()
+	aggregator = parser.StreamAggregator(cutoff, TZ)
+	packages = list(aggregator.feed(parser.iter_records(filepath, TZ))) + list(aggregator.finish())
+	return time.time() - start, len(packages)
+
+
+BENCHMARKS = {
+	'parse_file': bench_parse_file,
+	'aggregate': bench_aggregate,
+	'aggregate_columns': bench_aggregate_columns,
+	'aggregate_chunk': bench_aggregate_chunk,
+	'stream': bench_stream
+}
+
+
+def peak_memory_kb():
+	# ru_maxrss is in kilobytes on Linux.
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_in_process(name, filepath, cutoff, results):
+	baseline = peak_memory_kb()
+	seconds, outputs = BENCHMARKS[name](filepath, cutoff)
+	results.put({
+		'seconds': seconds,
+		'outputs': outputs,
+		'baseline_kb': baseline,
+		'peak_kb': peak_memory_kb()
+	})
+
+
+def run(rows, names, cutoff, workdir, repeat=1):
+	'''
+	Run the benchmarks on a file of each size and return the list of results.
+	'''
+	# The debug messages of the aggregation would be timed too.
+	parser.debug_log = lambda message: None
+	results = []
+	for count in rows:
+		filepath = os.path.join(workdir, 'synthetic-%d.dat' % count)
+		if not os.path.isfile(filepath):
+			toa5_generator.generate(filepath, count)
+
+		for name in names:
+			for attempt in xrange(repeat):
+				queue = multiprocessing.Queue()
+				process = multiprocessing.Process(target=run_in_process, args=(name, filepath, cutoff, queue))
+				process.start()
+				# The result is small enough to stay in the queue until the process is done.
+				process.join()
+				if process.exitcode != 0:
+					raise RuntimeError('Benchmark %s failed on %d rows.' % (name, count))
+				result = queue.get()
+
+				result.update({
+					'benchmark': name,
+					'rows': count,
+					'cutoff': cutoff,
+					'rows_per_second': count / result['seconds'] if result['seconds'] > 0 else None
+				})
+				results.append(result)
+				print '%-18s %9d rows %8.3f s %9d KB peak' % (name, count, result['seconds'], result['peak_kb'])
+	return results
+
+
+if __name__ == "__main__":
+	argParser = argparse.ArgumentParser(description='Benchmark parser.py on synthetic TOA5 files.')
+	argParser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS,
+						   help='sizes of the files to benchmark (default is %s)' % ' '.join(map(str, DEFAULT_ROWS)))
+	argParser.add_argument('--benchmarks', nargs='+', default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS),
+						   help='benchmarks to run (default is all of them)')
+	argParser.add_argument('--cutoff', type=int, default=300, help='aggregation cutoff size in seconds (default is 300)')
+	argParser.add_argument('--repeat', type=int, default=1, help='runs of each benchmark')
+	argParser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'toa5_benchmark'),
+						   help='where the synthetic files are written and kept between runs')
+	argParser.add_argument('--output', default='parser_benchmark.json', help='the JSON file to write the results to')
+	args = argParser.parse_args()
+
+	if not os.path.isdir(args.workdir):
+		os.makedirs(args.workdir)
+
+	results = run(args.rows, args.benchmarks, args.cutoff, args.workdir, args.repeat)
+	with open(args.output, 'w') as outfile:
+		json.dump({
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'machine': platform.machine(),
+			'results': results
+		}, outfile, indent=2)
@@ -0,0 +1,566 @@
+'''
+This is the unit test module for parser.py.
+It writes two hours of synthetic TOA5 files with toa5_generator.py and checks that every
+way of parsing and aggregating them gives the packages of the baseline aggregation, the
+record by record aggregate() the parser had before the accumulators, which is kept here as it was.
+
+To run the unit test, simply use:
+python parser_unittest.py
+'''
+
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import dateutil.tz
+import numpy as np
+
+import parser
+import toa5_generator
+
+TZ = dateutil.tz.tzoffset("-07:00", -7 * 60 * 60)
+CUTOFF = 300
+
+# The column paths sum each window with NumPy instead of one record at a time, so the
+# float results can differ from the record paths in the last bits.
+RELATIVE_TOLERANCE = 1e-9
+
+# Every statistic of every property, to check them all against NumPy.
+STATISTICS = dict((key, sorted(parser.ACCUMULATED_STATISTICS)) for key in parser.PROP_AGGREGATE)
+
+# ----------------------------------------------------------------------
+# The original aggregation, frozen so a change to parser.aggregate can't change the expected packages too.
+# It keeps the records of the open window in the state and takes records as GeoJSON features
+# with ISO time strings, see DATRecord.toGeoJSON.
+BASELINE_AGGREGATE = {
+	'air_temperature': parser.avg,
+	'relative_humidity': parser.avg,
+	'surface_downwelling_shortwave_flux_in_air': parser.avg,
+	'surface_downwelling_photosynthetic_photon_flux_in_air': parser.avg,
+	'eastward_wind': parser.avg,
+	'northward_wind': parser.avg,
+	'wind_speed': parser.avg,
+	'precipitation_rate': sum
+}
+
+def baseline_aggregate(cutoffSize, tz, inputData, state):
+	result = {
+		'packages': [],
+		'state': None if state == None else dict(state)
+	}
+
+	if inputData == None:
+		if state != None:
+			data = state['leftover']
+			if len(data) > 0:
+				startTime = state['starttime']
+				endTime = parser.ISOTimeString2TimeStamp(data[-1]['end_time'])
+				newPackage = baseline_aggregate_chunk(data, tz, startTime, endTime)
+				if newPackage != None:
+					result['packages'].append(newPackage)
+			result['state'] = None
+	else:
+		data = inputData
+		if state == None:
+			startTime = parser.ISOTimeString2TimeStamp(data[0]['start_time'])
+		else:
+			startTime = state['starttime']
+			data = state['leftover'] + inputData
+
+		startIndex = 0
+		while startIndex < len(data):
+			endTimeCutoff = startTime - startTime % cutoffSize + cutoffSize
+			endIndex = startIndex
+			while endIndex < len(data) and parser.ISOTimeString2TimeStamp(data[endIndex]['end_time']) < endTimeCutoff:
+				endIndex += 1
+
+			if endIndex >= len(data):
+				result['state'] = {
+					'starttime': startTime,
+					'leftover': data[startIndex:]
+				}
+			else:
+				newPackage = baseline_aggregate_chunk(data[startIndex:endIndex], tz, startTime, endTimeCutoff)
+				if newPackage != None:
+					result['packages'].append(newPackage)
+
+			startTime = endTimeCutoff
+			startIndex = endIndex
+
+	return result
+
+def baseline_aggregate_chunk(dataChunk, tz, startTime, endTime):
+	if len(dataChunk) == 0:
+		return None
+	return {
+		'start_time': datetime.datetime.fromtimestamp(startTime, tz).isoformat(),
+		'end_time': datetime.datetime.fromtimestamp(endTime, tz).isoformat(),
+		'properties': baseline_aggregate_props(map(lambda x: x['properties'], dataChunk)),
+		'type': 'Point',
+		'geometry': parser.STATION_GEOMETRY
+	}
+
+def baseline_aggregate_props(propertiesList):
+	collection = {}
+	for properties in propertiesList:
+		for key in properties:
+			if key.startswith('_'):
+				continue
+			collection.setdefault(key, []).append(properties[key])
+
+	result = {}
+	for key in properties:
+		if key not in BASELINE_AGGREGATE:
+			continue
+		result[key] = BASELINE_AGGREGATE[key](collection[key])
+	return result
+
+# The packages of the baseline aggregation of the records, all given at once.
+def baseline_packages(records, cutoffSize = CUTOFF):
+	features = [record.toGeoJSON(TZ) for record in records]
+	result = baseline_aggregate(cutoffSize, TZ, features, None)
+	return result['packages'] + baseline_aggregate(cutoffSize, TZ, None, result['state'])['packages']
+
+
+class parserUnitTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		# The debug messages of the aggregation would flood the test output.
+		cls.debug_log = parser.debug_log
+		parser.debug_log = lambda message: None
+
+		cls.workdir = tempfile.mkdtemp()
+		cls.filepaths = []
+		for hour in xrange(2):
+			filepath = os.path.join(cls.workdir, 'WeatherStation_%02d.dat' % hour)
+			toa5_generator.generate(filepath, 3600, start=datetime.datetime(2017, 4, 1, hour), seed=hour)
+			cls.filepaths.append(filepath)
+
+	@classmethod
+	def tearDownClass(cls):
+		parser.debug_log = cls.debug_log
+		shutil.rmtree(cls.workdir)
+
+	def records(self):
+		records = []
+		for filepath in self.filepaths:
+			records += parser.parse_file(filepath, TZ)
+		return records
+
+	def baseline(self):
+		'''
+		The packages of the baseline aggregation of the records of both files
+		'''
+		return baseline_packages(self.records())
+
+	def gappedRecords(self):
+		'''
+		The records of both files starting off a window boundary, with a gap of several windows
+		which also starts and ends off the boundaries
+		'''
+		records = self.records()
+		return records[137:1250] + records[3000:7000] + records[7003:]
+
+	def windows(self, records, cutoffSize = CUTOFF):
+		'''
+		The records grouped by the window their end time falls in, empty windows left out
+		'''
+		windows = []
+		for record in records:
+			window = record.end_time - record.end_time % cutoffSize
+			if not windows or windows[-1][0] != window:
+				windows.append((window, []))
+			windows[-1][1].append(record)
+		return [chunk for window, chunk in windows]
+
+	def assertStatistics(self, packages, windows, unknownStd = ()):
+		'''
+		Check the statistics of each package against NumPy on the records of its window.
+		The std of the windows listed in unknownStd should be NaN.
+		'''
+		self.assertEqual(len(packages), len(windows))
+		for index, (newPackage, chunk) in enumerate(zip(packages, windows)):
+			properties = newPackage['properties']
+			for key in parser.PROP_AGGREGATE:
+				values = np.array([record.properties[key] for record in chunk])
+				delta = RELATIVE_TOLERANCE * max(np.max(np.abs(values)), 1.0)
+				self.assertEqual(properties[key + '_count'], len(values))
+				self.assertEqual(properties[key + '_min'], np.min(values))
+				self.assertEqual(properties[key + '_max'], np.max(values))
+				self.assertAlmostEqual(properties[key + '_mean'], np.mean(values), delta=delta)
+				self.assertAlmostEqual(properties[key + '_sum'], np.sum(values), delta=delta * len(values))
+				if index in unknownStd:
+					self.assertTrue(math.isnan(properties[key + '_std']))
+				else:
+					# The population standard deviation.
+					self.assertAlmostEqual(properties[key + '_std'], np.std(values), delta=delta)
+
+	def withoutStatistics(self, packages):
+		'''
+		The packages with only the PROP_AGGREGATE value of each property, as the baseline has
+		'''
+		result = []
+		for newPackage in packages:
+			newPackage = dict(newPackage)
+			newPackage['properties'] = dict((key, value) for key, value in newPackage['properties'].iteritems()
+											if key in parser.PROP_AGGREGATE)
+			result.append(newPackage)
+		return result
+
+	def assertPackagesEqual(self, expected, actual, tolerance = 0):
+		self.assertEqual(len(expected), len(actual))
+		for expectedPackage, actualPackage in zip(expected, actual):
+			self.assertEqual(expectedPackage['start_time'], actualPackage['start_time'])
+			self.assertEqual(expectedPackage['end_time'], actualPackage['end_time'])
+			self.assertEqual(sorted(expectedPackage['properties']), sorted(actualPackage['properties']))
+			for key, value in expectedPackage['properties'].iteritems():
+				if tolerance == 0:
+					self.assertEqual(value, actualPackage['properties'][key], key)
+				else:
+					self.assertAlmostEqual(value, actualPackage['properties'][key], delta=abs(value) * tolerance, msg=key)
+
+	def test_baselineMatchesWindowChunks(self):
+		'''
+		The baseline should give one package per window, each the aggregation of the records of its window
+		'''
+		records = self.records()
+		windows = self.windows(records)
+
+		expected = []
+		for index, chunk in enumerate(windows):
+			window = chunk[0].end_time - chunk[0].end_time % CUTOFF
+			startTime = records[0].start_time if index == 0 else window
+			endTime = records[-1].end_time if index == len(windows) - 1 else window + CUTOFF
+			expected.append(parser.aggregate_chunk(chunk, TZ, startTime, endTime))
+
+		self.assertEqual(len(expected), 2 * 60 * 60 / CUTOFF)
+		self.assertPackagesEqual(expected, self.baseline())
+
+	def test_aggregate(self):
+		'''
+		Every record given to aggregate() at once should give the packages of the baseline
+		'''
+		result = parser.aggregate(CUTOFF, TZ, self.records(), None)
+		packages = result['packages'] + parser.aggregate(CUTOFF, TZ, None, result['state'])['packages']
+		self.assertPackagesEqual(self.baseline(), packages)
+
+	def test_gapAndUnalignedStart(self):
+		'''
+		Records starting off a window boundary and with a gap should give the packages of the baseline,
+		through every aggregation path
+		'''
+		records = self.gappedRecords()
+		expected = baseline_packages(records)
+		self.assertEqual(expected[0]['start_time'], parser.TimeStamp2ISOTimeString(records[0].start_time, TZ))
+		self.assertTrue(len(expected) < 2 * 60 * 60 / CUTOFF)
+
+		packages = []
+		state = None
+		for start in xrange(0, len(records), 1000):
+			result = parser.aggregate(CUTOFF, TZ, records[start:start + 1000], state)
+			packages += result['packages']
+			state = result['state']
+		packages += parser.aggregate(CUTOFF, TZ, None, state)['packages']
+		self.assertPackagesEqual(expected, packages)
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertPackagesEqual(expected, packages)
+
+		batch = parser.parse_file_columns(self.filepaths[0], TZ) + parser.parse_file_columns(self.filepaths[1], TZ)
+		batch = batch[137:1250] + batch[3000:7000] + batch[7003:]
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = aggregator.addColumns(batch) + list(aggregator.finish())
+		self.assertPackagesEqual(expected, packages, RELATIVE_TOLERANCE)
+
+	def test_recordsInChunks(self):
+		'''
+		Records given to aggregate() a few at a time, through the state package, should give the same packages
+		'''
+		records = self.records()
+		packages = []
+		state = None
+		for start in xrange(0, len(records), 1000):
+			result = parser.aggregate(CUTOFF, TZ, records[start:start + 1000], state)
+			packages += result['packages']
+			state = result['state']
+		packages += parser.aggregate(CUTOFF, TZ, None, state)['packages']
+		self.assertPackagesEqual(self.baseline(), packages)
+
+	def test_streaming(self):
+		'''
+		Records streamed from the files through a StreamAggregator should give the same packages
+		'''
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		records = (record for filepath, record in parser.merge_records(self.filepaths, TZ))
+		packages = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertPackagesEqual(self.baseline(), packages)
+
+	def test_columns(self):
+		'''
+		Column batches given to aggregate() should give the same packages, within the tolerance
+		'''
+		packages = []
+		state = None
+		for filepath in self.filepaths:
+			result = parser.aggregate(CUTOFF, TZ, parser.parse_file_columns(filepath, TZ), state)
+			packages += result['packages']
+			state = result['state']
+		packages += parser.aggregate(CUTOFF, TZ, None, state)['packages']
+		self.assertPackagesEqual(self.baseline(), packages, RELATIVE_TOLERANCE)
+
+	def test_pool(self):
+		'''
+		Files parsed by a pool of worker processes, listed in any order, should give the same packages,
+		within the tolerance
+		'''
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = []
+		for filepath, batch in parser.parse_files_columns(list(reversed(self.filepaths)), TZ, workers=2):
+			packages += aggregator.addColumns(batch)
+		packages += list(aggregator.finish())
+		self.assertPackagesEqual(self.baseline(), packages, RELATIVE_TOLERANCE)
+
+	def test_columnChunk(self):
+		'''
+		A whole column batch given to aggregate_chunk() should give the package of its records, within the tolerance
+		'''
+		batch = parser.parse_file_columns(self.filepaths[0], TZ)
+		records = batch.records()
+		startTime = records[0].start_time
+		endTime = records[-1].end_time
+		self.assertPackagesEqual([parser.aggregate_chunk(records, TZ, startTime, endTime)],
+								 [parser.aggregate_chunk(batch, TZ, startTime, endTime)], RELATIVE_TOLERANCE)
+
+	def test_shuffledFiles(self):
+		'''
+		Files listed in any order should be merged in time order and give the packages of the baseline
+		'''
+		filepaths = []
+		for quarter in xrange(8):
+			filepath = os.path.join(self.workdir, 'WeatherStation_quarter_%d.dat' % quarter)
+			toa5_generator.generate(filepath, 900, start=datetime.datetime(2017, 4, 1, quarter / 4, quarter % 4 * 15),
+									seed=quarter)
+			filepaths.append(filepath)
+		records = []
+		for filepath in filepaths:
+			records += parser.parse_file(filepath, TZ)
+		baseline = baseline_packages(records)
+
+		random.Random(0).shuffle(filepaths)
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		records = (record for filepath, record in parser.merge_records(filepaths, TZ))
+		packages = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertPackagesEqual(baseline, packages)
+		self.assertEqual(aggregator.dropped, 0)
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = []
+		for filepath, batch in parser.parse_files_columns(filepaths, TZ, workers=2):
+			packages += aggregator.addColumns(batch)
+		packages += list(aggregator.finish())
+		self.assertPackagesEqual(baseline, packages, RELATIVE_TOLERANCE)
+		self.assertEqual(aggregator.dropped, 0)
+
+	def test_outOfOrderWithinWindow(self):
+		'''
+		Records out of order within their window should still give the packages of the baseline, within the tolerance
+		'''
+		records = self.records()
+		for start in xrange(0, len(records), CUTOFF):
+			records[start:start + CUTOFF] = reversed(records[start:start + CUTOFF])
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertPackagesEqual(self.baseline(), packages, RELATIVE_TOLERANCE)
+
+		batch = parser.parse_file_columns(self.filepaths[0], TZ) + parser.parse_file_columns(self.filepaths[1], TZ)
+		order = range(len(batch))
+		random.Random(0).shuffle(order)
+		batch = parser.ColumnBatch(batch.timestamps[order], dict((key, column[order]) for key, column in batch.properties.iteritems()))
+		aggregator = parser.StreamAggregator(CUTOFF, TZ)
+		packages = aggregator.addColumns(batch) + list(aggregator.finish())
+		self.assertPackagesEqual(self.baseline(), packages, RELATIVE_TOLERANCE)
+
+	def test_lateHoursAreDropped(self):
+		'''
+		An hour given after the following one should be dropped, not folded into the open window,
+		and no package should end before it starts or before the previous package
+		'''
+		laterHour = parser.parse_file(self.filepaths[1], TZ)
+		expected = baseline_packages(laterHour)
+
+		for addRecords in [
+			lambda aggregator, filepath: list(aggregator.feed(parser.iter_records(filepath, TZ))),
+			lambda aggregator, filepath: aggregator.addColumns(parser.parse_file_columns(filepath, TZ))
+		]:
+			packages = []
+			state = None
+			dropped = 0
+			# Each hour in a run of its own, through the state package, like the extractor does.
+			for filepath in reversed(self.filepaths):
+				aggregator = parser.RollupAggregator([CUTOFF], TZ, state)
+				packages += [newPackage for size, newPackage in addRecords(aggregator, filepath)]
+				state = aggregator.state()
+				dropped += aggregator.dropped
+			aggregator = parser.RollupAggregator([CUTOFF], TZ, state)
+			packages += [newPackage for size, newPackage in aggregator.finish()]
+
+			self.assertEqual(dropped, 3600)
+			self.assertPackagesEqual(expected, packages, RELATIVE_TOLERANCE)
+			for index, newPackage in enumerate(packages):
+				self.assertTrue(newPackage['start_time'] <= newPackage['end_time'])
+				if index > 0:
+					self.assertTrue(packages[index - 1]['end_time'] <= newPackage['start_time'])
+
+	def test_lateFileAfterFinish(self):
+		'''
+		Once the aggregation is finished, records up to its end should be dropped by the next aggregation
+		so the windows are not posted again
+		'''
+		aggregator = parser.RollupAggregator([CUTOFF, 3600], TZ)
+		packages = list(aggregator.feed(parser.iter_records(self.filepaths[1], TZ))) + list(aggregator.finish())
+		self.assertEqual(len(packages), 3600 / CUTOFF + 1)
+		self.assertEqual(aggregator.state(), None)
+
+		aggregator = parser.RollupAggregator([CUTOFF, 3600], TZ, None, closedUntil=aggregator.closedUntil)
+		packages = list(aggregator.feed(parser.iter_records(self.filepaths[0], TZ)))
+		packages += list(aggregator.feed(parser.iter_records(self.filepaths[1], TZ))) + list(aggregator.finish())
+		self.assertEqual(packages, [])
+		self.assertEqual(aggregator.dropped, 7200)
+
+	def test_statisticsMatchNumpy(self):
+		'''
+		The mean, min, max, std, count and sum of each window should be those NumPy computes from its records,
+		whether the records are added one at a time, in column batches or through the state package
+		'''
+		records = self.gappedRecords()
+		windows = self.windows(records)
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ, statistics=STATISTICS)
+		packages = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertStatistics(packages, windows)
+		self.assertPackagesEqual(baseline_packages(records), self.withoutStatistics(packages))
+
+		# The batches end inside windows, whose accumulators are then merged.
+		batch = parser.parse_file_columns(self.filepaths[0], TZ) + parser.parse_file_columns(self.filepaths[1], TZ)
+		batch = batch[137:1250] + batch[3000:7000] + batch[7003:]
+		aggregator = parser.StreamAggregator(CUTOFF, TZ, statistics=STATISTICS)
+		packages = []
+		for start in xrange(0, len(batch), 1000):
+			packages += aggregator.addColumns(batch[start:start + 1000])
+		packages += list(aggregator.finish())
+		self.assertStatistics(packages, windows)
+
+		packages = []
+		state = None
+		for start in xrange(0, len(records), 1000):
+			aggregator = parser.StreamAggregator(CUTOFF, TZ, state, statistics=STATISTICS)
+			packages += list(aggregator.feed(records[start:start + 1000]))
+			state = json.loads(json.dumps(aggregator.state()))
+		packages += list(parser.StreamAggregator(CUTOFF, TZ, state, statistics=STATISTICS).finish())
+		self.assertStatistics(packages, windows)
+
+	def test_parseStatistics(self):
+		'''
+		Statistics given as "property:statistic,statistic" should be collected by property,
+		and unknown properties or statistics rejected
+		'''
+		self.assertEqual(parser.parseStatistics([]), {})
+		self.assertEqual(parser.parseStatistics(['air_temperature:min,max', 'wind_speed:std', 'air_temperature:count']),
+						 {'air_temperature': ['min', 'max', 'count'], 'wind_speed': ['std']})
+		self.assertRaises(ValueError, parser.parseStatistics, ['air_pressure:min'])
+		self.assertRaises(ValueError, parser.parseStatistics, ['air_temperature:median'])
+		self.assertRaises(ValueError, parser.parseStatistics, ['air_temperature'])
+		self.assertRaises(ValueError, parser.parseStatistics, ['air_temperature:min,'])
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ, statistics=parser.parseStatistics(['air_temperature:min,std']))
+		newPackage = list(aggregator.feed(self.records()[:CUTOFF])) + list(aggregator.finish())
+		self.assertEqual(sorted(newPackage[0]['properties']),
+						 sorted(list(parser.PROP_AGGREGATE) + ['air_temperature_min', 'air_temperature_std']))
+
+	def test_checkpointWithoutMeanAndM2(self):
+		'''
+		A state package saved before the mean and M2 were kept, with [sum, count, min, max] accumulators,
+		should go on with the same packages. Only the std of the window it left open is unknown.
+		'''
+		records = self.records()
+		split = 1000
+
+		aggregator = parser.StreamAggregator(CUTOFF, TZ, statistics=STATISTICS)
+		packages = list(aggregator.feed(records[:split]))
+		state = aggregator.state()
+		state['accumulators'] = dict((key, acc[:4]) for key, acc in state['accumulators'].iteritems())
+		state = json.loads(json.dumps({str(CUTOFF): state}))
+
+		aggregator = parser.RollupAggregator([CUTOFF], TZ, state, STATISTICS)
+		packages += [newPackage for size, newPackage in aggregator.feed(records[split:])]
+		packages += [newPackage for size, newPackage in aggregator.finish()]
+
+		self.assertPackagesEqual(self.baseline(), self.withoutStatistics(packages))
+		self.assertStatistics(packages, self.windows(records), unknownStd=(split // CUTOFF,))
+
+	def test_rollupMatchesDirectAggregation(self):
+		'''
+		The 3600 second packages rolled up from the 300 second windows should be those of aggregating
+		the records at 3600 seconds directly, partial first and last windows and statistics included,
+		whether the records are added one at a time, in column batches or through the state package
+		'''
+		records = self.gappedRecords()
+		windows = self.windows(records, 3600)
+		expected = baseline_packages(records, 3600)
+		self.assertEqual(len(expected), 2)
+		self.assertEqual(expected[0]['start_time'], parser.TimeStamp2ISOTimeString(records[0].start_time, TZ))
+		self.assertEqual(expected[-1]['end_time'], parser.TimeStamp2ISOTimeString(records[-1].end_time, TZ))
+
+		aggregator = parser.StreamAggregator(3600, TZ, statistics=STATISTICS)
+		direct = list(aggregator.feed(records)) + list(aggregator.finish())
+		self.assertPackagesEqual(expected, self.withoutStatistics(direct))
+		self.assertStatistics(direct, windows)
+
+		def rolledUp(packages):
+			return [newPackage for size, newPackage in packages if size == 3600]
+
+		aggregator = parser.RollupAggregator([CUTOFF, 3600], TZ, statistics=STATISTICS)
+		packages = rolledUp(list(aggregator.feed(records)) + list(aggregator.finish()))
+		self.assertPackagesEqual(direct, packages, RELATIVE_TOLERANCE)
+		self.assertStatistics(packages, windows)
+
+		batch = parser.parse_file_columns(self.filepaths[0], TZ) + parser.parse_file_columns(self.filepaths[1], TZ)
+		batch = batch[137:1250] + batch[3000:7000] + batch[7003:]
+		aggregator = parser.RollupAggregator([CUTOFF, 3600], TZ, statistics=STATISTICS)
+		packages = []
+		for start in xrange(0, len(batch), 1000):
+			packages += rolledUp(aggregator.addColumns(batch[start:start + 1000]))
+		packages += rolledUp(aggregator.finish())
+		self.assertPackagesEqual(direct, packages, RELATIVE_TOLERANCE)
+		self.assertStatistics(packages, windows)
+
+		packages = []
+		state = None
+		for start in xrange(0, len(records), 1000):
+			aggregator = parser.RollupAggregator([CUTOFF, 3600], TZ, state, STATISTICS)
+			packages += rolledUp(aggregator.feed(records[start:start + 1000]))
+			state = json.loads(json.dumps(aggregator.state()))
+		packages += rolledUp(parser.RollupAggregator([CUTOFF, 3600], TZ, state, STATISTICS).finish())
+		self.assertPackagesEqual(direct, packages, RELATIVE_TOLERANCE)
+		self.assertStatistics(packages, windows)
+
+	def test_checkCutoffSizes(self):
+		'''
+		Cutoff sizes should be sorted, and rejected unless each is a multiple of the size below it
+		'''
+		self.assertEqual(parser.checkCutoffSizes([3600, 300, 86400, 300]), [300, 3600, 86400])
+		self.assertRaises(ValueError, parser.checkCutoffSizes, [300, 700])
+		self.assertRaises(ValueError, parser.checkCutoffSizes, [300, 1800, 2700])
+		self.assertRaises(ValueError, parser.RollupAggregator, [300, 450], TZ)
+
+
+if __name__ == "__main__":
+	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(parserUnitTest))
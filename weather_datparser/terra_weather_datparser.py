@@ -5,6 +5,7 @@ import json
 import requests
 import urlparse
 import logging
+import multiprocessing
 
 import datetime
 from dateutil.parser import parse
@@ -16,6 +17,7 @@ import pyclowder.files
 import pyclowder.datasets
 
 from parser import *
+from geostreams_utils import DatapointUploader, get_sensor_id, get_stream_id
 
 
 class MetDATFileParser(Extractor):
@@ -31,6 +33,18 @@ class MetDATFileParser(Extractor):
 		self.parser.add_argument('--aggregation', dest="agg_cutoff", type=int, nargs='?',
 								 default=(300),
 								 help="minute chunks to aggregate records into (default is 5 mins)")
+		self.parser.add_argument('--rollups', dest="rollups", type=int, nargs='*',
+								 default=[],
+								 help="coarser chunks in seconds to also aggregate records into, each posted to its own stream")
+		self.parser.add_argument('--statistics', dest="statistics", type=str, nargs='*',
+								 default=[],
+								 help="extra statistics of a property to add to each package, e.g. air_temperature:min,max,std " +
+								 "(available: mean, min, max, std, count, sum)")
+		self.parser.add_argument('--batchSize', dest="batch_size", type=int, nargs='?',
+								 default=500, help="number of datapoints posted to geostreams per request")
+		self.parser.add_argument('--workers', dest="workers", type=int, nargs='?',
+								 default=multiprocessing.cpu_count(),
+								 help="processes parsing .dat files in parallel, 1 streams one file at a time (default is the number of CPUs)")
 		self.parser.add_argument('--influxHost', dest="influx_host", type=str, nargs='?',
 								 default="terra-logging.ncsa.illinois.edu", help="InfluxDB URL for logging")
 		self.parser.add_argument('--influxPort', dest="influx_port", type=int, nargs='?',
@@ -53,27 +67,42 @@ class MetDATFileParser(Extractor):
 		# assign other arguments
 		self.sensor_name = self.args.sensor_name
 		self.agg_cutoff = self.args.agg_cutoff
+		self.rollups = self.args.rollups
+		self.statistics = parseStatistics(self.args.statistics)
+		self.workers = self.args.workers
+		self.batch_size = self.args.batch_size
 		self.influx_host = self.args.influx_host
 		self.influx_port = self.args.influx_port
 		self.influx_user = self.args.influx_user
 		self.influx_pass = self.args.influx_pass
 		self.influx_db = self.args.influx_db
 
+		# Fail now rather than on the first dataset if the rollups can't be built from the main windows.
+		for cutoffSize in self.rollups:
+			if cutoffSize <= self.agg_cutoff:
+				self.parser.error('--rollups: %s is not coarser than --aggregation %s' % (cutoffSize, self.agg_cutoff))
+		try:
+			checkCutoffSizes([self.agg_cutoff] + self.rollups)
+		except ValueError as e:
+			self.parser.error('--rollups: %s Each rollup has to be a multiple of --aggregation %s and of the rollups below it.'
+							  % (e, self.agg_cutoff))
+
 	def check_message(self, connector, host, secret_key, resource, parameters):
-		# Check for expected input files before beginning processing
-		if len(get_all_files(resource)) >= 23:
-			md = pyclowder.datasets.download_metadata(connector, host, secret_key,
-													  resource['id'], self.extractor_info['name'])
-			for m in md:
-				if 'agent' in m and 'name' in m['agent'] and m['agent']['name'].endswith(self.extractor_info['name']):
-					logging.info('skipping %s, dataset already handled' % resource['id'])
-					return CheckMessage.ignore
-
-			return CheckMessage.download
-		else:
-			logging.info('skipping %s, not all input files are ready' % resource['id'])
+		target_files = get_all_files(resource)
+		if len(target_files) == 0:
+			logging.info('skipping %s, no input files' % resource['id'])
 			return CheckMessage.ignore
 
+		# Only the files that are not in the checkpoint of the previous run need processing.
+		md = pyclowder.datasets.download_metadata(connector, host, secret_key,
+												  resource['id'], self.extractor_info['name'])
+		checkpoint = get_checkpoint(md, self.extractor_info['name'])
+		if checkpoint != None and len(get_new_files(target_files, checkpoint)) == 0:
+			logging.info('skipping %s, dataset already handled' % resource['id'])
+			return CheckMessage.ignore
+
+		return CheckMessage.download
+
 	def process_message(self, connector, host, secret_key, resource, parameters):
 		starttime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
 		created_count = 0
@@ -83,91 +112,159 @@ class MetDATFileParser(Extractor):
 		main_coords = [ -111.974304, 33.075576, 0]
 
 		# SENSOR is Full Field by default
-		sensor_data = pyclowder.geostreams.get_sensor_by_name(connector, host, secret_key, self.sensor_name)
-		if not sensor_data:
-			sensor_id = pyclowder.geostreams.create_sensor(connector, host, secret_key, self.sensor_name, {
-				"type": "Point",
-				# These are a point off to the right of the field
-				"coordinates": main_coords
-			}, {
-				"id": "MAC Met Station",
-				"title": "MAC Met Station",
-				"sensorType": 4
-			}, "Maricopa")
-		else:
-			sensor_id = sensor_data['id']
-
-		# STREAM is Weather Station
+		# Sensor and stream IDs are cached for the whole worker process.
+		sensor_id = get_sensor_id(connector, host, secret_key, self.sensor_name, {
+			"type": "Point",
+			# These are a point off to the right of the field
+			"coordinates": main_coords
+		}, {
+			"id": "MAC Met Station",
+			"title": "MAC Met Station",
+			"sensorType": 4
+		}, "Maricopa")
+
+		# STREAM is Weather Station, each rollup goes to a stream of its own.
 		stream_name = self.sensor_name + " - Weather Observations"
-		stream_data = pyclowder.geostreams.get_stream_by_name(connector, host, secret_key, stream_name)
-		if not stream_data:
-			stream_id = pyclowder.geostreams.create_stream(connector, host, secret_key, stream_name, sensor_id, {
+		stream_ids = {}
+		for cutoffSize in [self.agg_cutoff] + self.rollups:
+			stream_ids[cutoffSize] = get_stream_id(connector, host, secret_key,
+												   get_stream_name(stream_name, cutoffSize, self.agg_cutoff), sensor_id, {
 				"type": "Point",
 				"coordinates": main_coords
 			})
-		else:
-			stream_id = stream_data['id']
 
 		# Find input files in dataset
-		target_files = get_all_files(resource)
+		all_files = get_all_files(resource)
 		datasetUrl = urlparse.urljoin(host, 'datasets/%s' % resource['id'])
 
-		#! Files should be sorted for the aggregation to work.
-		aggregationState = None
-		lastAggregatedFile = None
-
-		# Process each file and concatenate results together.
-		# To work with the aggregation process, add an extra NULL file to indicate we are done with all the files.
-		for file in (list(target_files) + [ None ]):
-			if file == None:
-				# We are done with all the files, finish up aggregation.
-				# Pass None as data into the aggregation to let it wrap up any work left.
-				records = None
-				# The file ID would be the last file processed.
-				fileId = lastAggregatedFile['id']
-			else:
-				# Add this file to the aggregation.
-				for p in resource['local_paths']:
-					if os.path.basename(p) == file['filename']:
-						filepath = p
-
-				# Parse one file and get all the records in it.
-				records = parse_file(filepath, utc_offset=ISO_8601_UTC_OFFSET)
-				fileId = file['id']
-
-			aggregationResult = aggregate(
-					cutoffSize=self.agg_cutoff,
-					tz=ISO_8601_UTC_OFFSET,
-					inputData=records,
-					state=aggregationState
-			)
-			aggregationState = aggregationResult['state']
-			aggregationRecords = aggregationResult['packages']
-
-			# Add props to each record.
-			for record in aggregationRecords:
+		# Continue from the checkpoint of the previous run, only the new files are parsed.
+		md = pyclowder.datasets.download_metadata(connector, host, secret_key,
+												  resource['id'], self.extractor_info['name'])
+		checkpoint = get_checkpoint(md, self.extractor_info['name'])
+		if checkpoint == None:
+			checkpoint = {
+				"files_processed": [],
+				"aggregation_state": None,
+				"datapoints_created": 0
+			}
+		if checkpoint['files_processed'] == None or checkpoint.get('finished'):
+			# Files added after the day was finished would start an aggregation of their own, whose
+			# first window is cut short at the end of the finished one, so they are not accepted.
+			logging.info('skipping %s, the aggregation of the day is finished' % resource['id'])
+			return
+		# Entries replaced by the new checkpoint once it is saved.
+		old_checkpoints = get_checkpoint_metadata(md, self.extractor_info['name'])
+		processed_files = list(checkpoint['files_processed'])
+		pending_files = checkpoint.get('files_pending', [])
+		lastFileId = processed_files[-1] if processed_files else None
+		# The file held back by the previous run is aggregated along with the new ones.
+		target_files = [file for file in all_files if file['id'] in pending_files] + get_new_files(all_files, checkpoint)
+
+		for file in target_files:
+			for p in resource['local_paths']:
+				if os.path.basename(p) == file['filename']:
+					file['path'] = p
+
+		# Once all the files of the day are in, the aggregation is finished.
+		finished = len(processed_files) + len(target_files) >= 23
+		pending_files = []
+		if not finished and len(target_files) > 0:
+			# The windows of the files aggregated now are closed for good, so an hour uploaded after the
+			# next one would be dropped. The newest file is held back until another file arrives, so hours
+			# uploaded one after the other in the wrong order are still merged in time order.
+			newest = max(target_files, key=lambda file: peek_file(file['path'], ISO_8601_UTC_OFFSET))
+			target_files.remove(newest)
+			pending_files = [newest['id']]
+
+		aggregation_state = checkpoint['aggregation_state']
+		if aggregation_state != None and 'accumulators' in aggregation_state:
+			# Checkpoint from before rollups, it only has the state of the main aggregation.
+			aggregation_state = {str(self.agg_cutoff): aggregation_state}
+
+		# The files can come in any order, their records are merged in time order before the aggregation.
+		# Records are streamed from file to file through one aggregator, so memory use
+		# is bounded by one aggregation window rather than by the whole dataset.
+		# The rollups are built from the windows of the finer cutoffs in the same pass.
+		# Records of the windows posted by the previous runs, including all of them once the day
+		# was finished, are dropped rather than posted again in overlapping windows.
+		aggregator = RollupAggregator([self.agg_cutoff] + self.rollups, ISO_8601_UTC_OFFSET, aggregation_state,
+									  self.statistics, checkpoint.get('closed_until'))
+		datapoint_count = checkpoint['datapoints_created']
+
+		fileIds = dict((file['path'], file['id']) for file in target_files)
+
+		# Packages are posted as soon as their cutoff passes.
+		# The datapoints still buffered are only posted if the whole run succeeds.
+		with DatapointUploader(connector, host, secret_key, batch_size=self.batch_size) as uploader:
+			def create_package_datapoint(aggregated, fileId):
+				cutoffSize, record = aggregated
+				stream_id = stream_ids[cutoffSize]
+				# Add props to each record.
 				record['properties']['source'] = datasetUrl
 				record['properties']['source_file'] = fileId
 				record['stream_id'] = str(stream_id)
-				pyclowder.geostreams.create_datapoint(connector, host, secret_key, stream_id, record['geometry'],
-													  record['start_time'], record['end_time'], record['properties'])
+				uploader.add(stream_id, record['geometry'], record['start_time'], record['end_time'], record['properties'])
+
+			if self.workers > 1:
+				# Parse all the files in parallel, then aggregate them in time order.
+				parsedFiles = parse_files_columns([file['path'] for file in target_files],
+												  utc_offset=ISO_8601_UTC_OFFSET, workers=self.workers)
+				for filepath, batch in parsedFiles:
+					lastFileId = fileIds[filepath]
+					for record in aggregator.addColumns(batch):
+						create_package_datapoint(record, lastFileId)
+						datapoint_count += 1
+			else:
+				for filepath, record in merge_records([file['path'] for file in target_files], utc_offset=ISO_8601_UTC_OFFSET):
+					lastFileId = fileIds[filepath]
+					for newPackage in aggregator.add(record):
+						create_package_datapoint(newPackage, lastFileId)
+						datapoint_count += 1
+
+			processed_files += [file['id'] for file in target_files]
 
-			lastAggregatedFile = file
+			# Once all the files of the day are in, finish up aggregation.
+			# Until then the last window stays open in the checkpoint for the next run.
+			if finished:
+				# The file ID would be the last file processed.
+				for record in aggregator.finish():
+					create_package_datapoint(record, lastFileId)
+					datapoint_count += 1
 
-		# Mark dataset as processed.
+		records_dropped = checkpoint.get('records_dropped', 0) + aggregator.dropped
+		if aggregator.dropped > 0:
+			logging.warning('%s: dropped %d records older than the windows already posted' % (resource['id'], aggregator.dropped))
+
+		# Save the checkpoint, replacing the one from the previous run.
 		metadata = {
 			# TODO: Generate JSON-LD context for additional fields
 			"@context": ["https://clowder.ncsa.illinois.edu/contexts/metadata.jsonld"],
 			"dataset_id": resource['id'],
 			"content": {
-				"datapoints_created": len(aggregationRecords)
+				"datapoints_created": datapoint_count,
+				"files_processed": processed_files,
+				"aggregation_state": aggregator.state(),
+				# The newest file, left for the next run to aggregate along with the file after it.
+				"files_pending": pending_files,
+				"finished": finished,
+				# Records before this time are in windows which are already posted.
+				"closed_until": aggregator.closedUntil,
+				"records_dropped": records_dropped,
+				"sequence": checkpoint.get('sequence', 0) + 1
 			},
 			"agent": {
 				"@type": "extractor",
 				"extractor_id": host + "/api/extractors/" + self.extractor_info['name']
 			}
 		}
+		# The old checkpoint is only deleted once the new one is saved. If deleting it fails,
+		# both stay in the metadata and get_checkpoint picks the new one by its sequence.
 		pyclowder.datasets.upload_metadata(connector, host, secret_key, resource['id'], metadata)
+		for md in old_checkpoints:
+			if 'id' in md:
+				remove_metadata_entry(connector, host, secret_key, md['id'])
+			else:
+				logging.warning('%s: the old checkpoint has no id to delete it by, it is left in the metadata' % resource['id'])
 
 		endtime = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
 		self.logToInfluxDB(starttime, endtime, created_count, bytes)
@@ -210,6 +307,60 @@ def get_all_files(resource):
 
 	return target_files
 
+# Find the metadata entries this extractor saved in the dataset metadata.
+def get_checkpoint_metadata(metadata, extractor_name):
+	return [m for m in metadata if 'agent' in m and 'name' in m['agent'] and m['agent']['name'].endswith(extractor_name)]
+
+# Find the checkpoint this extractor saved in the dataset metadata, None if there is none.
+# If a run failed to delete the checkpoint it replaced, the one with the highest sequence is used.
+def get_checkpoint(metadata, extractor_name):
+	checkpoint = None
+	for m in get_checkpoint_metadata(metadata, extractor_name):
+		if 'content' in m and 'files_processed' in m['content']:
+			content = m['content']
+		else:
+			# Metadata from before checkpoints were saved, the whole dataset was handled.
+			content = {
+				"files_processed": None,
+				"aggregation_state": None,
+				"datapoints_created": m.get('content', {}).get('datapoints_created', 0)
+			}
+		if checkpoint == None or content.get('sequence', 0) > checkpoint.get('sequence', 0):
+			checkpoint = content
+	return checkpoint
+
+def remove_metadata_entry(connector, host, key, metadataid):
+	"""Delete one JSON-LD metadata entry from Clowder, by its id.
+
+	Keyword arguments:
+	connector -- connector information, used to get missing parameters and send status updates
+	host -- the clowder host, including http and port, should end with a /
+	key -- the secret key to login to clowder
+	metadataid -- the id of the metadata entry
+	"""
+	url = '%sapi/metadata.jsonld/%s?key=%s' % (host, metadataid, key)
+	result = requests.delete(url, verify=connector.ssl_verify if connector else True)
+	result.raise_for_status()
+
+# Filter out the files that are already in the checkpoint, none are new once the day is finished.
+def get_new_files(target_files, checkpoint):
+	if checkpoint['files_processed'] == None or checkpoint.get('finished'):
+		return []
+	processed = set(checkpoint['files_processed'] + checkpoint.get('files_pending', []))
+	return [file for file in target_files if file['id'] not in processed]
+
+# Name of the stream of the given cutoff size, the main aggregation keeps the plain stream name.
+def get_stream_name(stream_name, cutoffSize, mainCutoffSize):
+	if cutoffSize == mainCutoffSize:
+		return stream_name
+	if cutoffSize % (24 * 60 * 60) == 0:
+		return "%s - %s day" % (stream_name, cutoffSize / (24 * 60 * 60))
+	if cutoffSize % (60 * 60) == 0:
+		return "%s - %s hour" % (stream_name, cutoffSize / (60 * 60))
+	if cutoffSize % 60 == 0:
+		return "%s - %s min" % (stream_name, cutoffSize / 60)
+	return "%s - %s sec" % (stream_name, cutoffSize)
+
 def get_output_filename(raw_filename):
 	return '%s.nc' % raw_filename[:-len('_raw')]
 
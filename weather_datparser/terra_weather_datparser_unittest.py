@@ -0,0 +1,196 @@
+'''
+This is the unit test module for terra_weather_datparser.py.
+It runs the extractor on a dataset that gets one hourly file at a time, with the dataset
+metadata kept in memory and the datapoints collected instead of posted, so no Clowder
+instance is needed.
+
+To run the unit test, simply use:
+python terra_weather_datparser_unittest.py
+'''
+
+import copy
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pyclowder.datasets
+from pyclowder.utils import CheckMessage
+
+import parser
+import terra_weather_datparser
+import toa5_generator
+
+HOST = 'http://clowder.test/'
+
+
+class FakeUploader(object):
+	'''
+	Collects the datapoints the extractor adds, in place of the geostreams uploader.
+	'''
+
+	def __init__(self, datapoints):
+		self.datapoints = datapoints
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+	def add(self, stream_id, geom, start_time, end_time, properties):
+		self.datapoints.append((stream_id, start_time, end_time, properties['air_temperature']))
+
+
+class terraWeatherDatparserUnitTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.debug_log = parser.debug_log
+		parser.debug_log = lambda message: None
+
+		# 23 hourly files of one record every 10 seconds, and the file of the last hour of the day.
+		cls.workdir = tempfile.mkdtemp()
+		cls.files = []
+		for hour in xrange(24):
+			filepath = os.path.join(cls.workdir, 'WeatherStation_%02d.dat' % hour)
+			toa5_generator.generate(filepath, 360, rate=10, start=datetime.datetime(2017, 4, 1, hour), seed=hour)
+			cls.files.append({'id': 'file-%02d' % hour, 'filename': os.path.basename(filepath), 'path': filepath})
+
+		# The extractor reads its arguments and extractor_info.json as if it was started from its directory.
+		argv = sys.argv
+		sys.argv = [os.path.abspath(terra_weather_datparser.__file__)]
+		try:
+			cls.extractor = terra_weather_datparser.MetDATFileParser()
+		finally:
+			sys.argv = argv
+		cls.extractor.logToInfluxDB = lambda *args: None
+
+	@classmethod
+	def tearDownClass(cls):
+		parser.debug_log = cls.debug_log
+		shutil.rmtree(cls.workdir)
+
+	def setUp(self):
+		self.newDataset()
+		self.patched = [
+			(pyclowder.datasets, 'download_metadata', self.download_metadata),
+			(pyclowder.datasets, 'upload_metadata', self.upload_metadata),
+			(terra_weather_datparser, 'remove_metadata_entry', self.remove_metadata_entry),
+			(terra_weather_datparser, 'get_sensor_id', lambda *args: 'sensor-1'),
+			(terra_weather_datparser, 'get_stream_id', lambda connector, host, key, name, *args: name),
+			(terra_weather_datparser, 'DatapointUploader', lambda *args, **kwargs: FakeUploader(self.datapoints))
+		]
+		for module, name, value in self.patched:
+			setattr(self, '_original_' + name, getattr(module, name))
+			setattr(module, name, value)
+
+	def tearDown(self):
+		for module, name, value in self.patched:
+			setattr(module, name, getattr(self, '_original_' + name))
+
+	def newDataset(self):
+		self.metadata = []
+		self.metadataCount = 0
+		self.datapoints = []
+		self.uploaded = []
+
+	def download_metadata(self, connector, host, key, datasetid, extractor=None):
+		return copy.deepcopy(self.metadata)
+
+	def upload_metadata(self, connector, host, key, datasetid, metadata):
+		self.metadataCount += 1
+		self.metadata.append({
+			'id': 'metadata-%d' % self.metadataCount,
+			'agent': {'name': metadata['agent']['extractor_id']},
+			'content': copy.deepcopy(metadata['content'])
+		})
+
+	def remove_metadata_entry(self, connector, host, key, metadataid):
+		self.metadata = [md for md in self.metadata if md['id'] != metadataid]
+
+	def checkpoint(self):
+		return terra_weather_datparser.get_checkpoint(self.metadata, self.extractor.extractor_info['name'])
+
+	def upload(self, hours):
+		'''
+		Add the files of the given hours to the dataset one at a time, running the extractor after each like Clowder does,
+		and return whether the extractor accepted each upload
+		'''
+		accepted = []
+		for hour in hours:
+			self.uploaded.append(self.files[hour])
+			resource = {
+				'id': 'dataset-1',
+				'files': [{'id': file['id'], 'filename': file['filename']} for file in self.uploaded],
+				'local_paths': [file['path'] for file in self.uploaded]
+			}
+			check = self.extractor.check_message(None, HOST, 'secret', resource, {})
+			accepted.append(check == CheckMessage.download)
+			if check == CheckMessage.download:
+				self.extractor.process_message(None, HOST, 'secret', resource, {})
+		return accepted
+
+	def assertPostedInOrder(self):
+		for stream_id in set(datapoint[0] for datapoint in self.datapoints):
+			datapoints = [datapoint for datapoint in self.datapoints if datapoint[0] == stream_id]
+			for index in xrange(1, len(datapoints)):
+				self.assertTrue(datapoints[index - 1][2] <= datapoints[index][1])
+
+	def test_inOrderUpload(self):
+		'''
+		Hourly files uploaded in order should give one package per window of the day, the last
+		file's windows only once the day is finished
+		'''
+		self.upload(xrange(22))
+		# The newest file is held back until the next one arrives.
+		self.assertEqual(self.checkpoint()['files_pending'], ['file-21'])
+		self.assertEqual(len(self.datapoints), 21 * 3600 / 300 - 1)
+
+		self.upload(xrange(22, 23))
+		self.assertEqual(len(self.datapoints), 23 * 3600 / 300)
+		checkpoint = self.checkpoint()
+		self.assertTrue(checkpoint['finished'])
+		self.assertEqual(checkpoint['files_pending'], [])
+		self.assertEqual(checkpoint['records_dropped'], 0)
+		self.assertEqual(checkpoint['datapoints_created'], len(self.datapoints))
+		self.assertEqual(len(self.metadata), 1)
+		self.assertPostedInOrder()
+
+	def test_outOfOrderUpload(self):
+		'''
+		An hour uploaded after the next one should still be aggregated, giving the packages of the in-order upload
+		'''
+		self.upload(xrange(23))
+		expected = self.datapoints
+
+		self.newDataset()
+		self.upload([0, 1, 2, 3, 4, 6, 5] + range(7, 23))
+		self.assertEqual(self.checkpoint()['records_dropped'], 0)
+		self.assertEqual(self.datapoints, expected)
+		self.assertPostedInOrder()
+
+	def test_noFilesAfterFinish(self):
+		'''
+		Once the day is finished, a file added later should not be accepted, so no partial window is posted after the finish
+		'''
+		self.assertEqual(self.upload(xrange(24)), [True] * 23 + [False])
+		checkpoint = self.checkpoint()
+		self.assertEqual(len(self.datapoints), 23 * 3600 / 300)
+		self.assertNotIn('file-23', checkpoint['files_processed'])
+
+		# Even if the extractor is run on it, nothing is posted and the checkpoint is kept.
+		resource = {
+			'id': 'dataset-1',
+			'files': [{'id': file['id'], 'filename': file['filename']} for file in self.files],
+			'local_paths': [file['path'] for file in self.files]
+		}
+		self.extractor.process_message(None, HOST, 'secret', resource, {})
+		self.assertEqual(len(self.datapoints), 23 * 3600 / 300)
+		self.assertEqual(self.checkpoint(), checkpoint)
+
+
+if __name__ == "__main__":
+	unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(terraWeatherDatparserUnitTest))
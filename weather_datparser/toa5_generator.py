@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+'''
+toa5_generator.py
+
+Write synthetic TOA5 .dat files like the ones of the weather station, to test and
+benchmark parser.py without real data.
+
+To write a file, use:
+python toa5_generator.py <output file> [--rows N] [--rate SECONDS] [--columns AirTC RH ...]
+'''
+
+import argparse
+import datetime
+import random
+
+# Header details and value range of each column the generator can write.
+# (unit, sample method, lowest value, highest value, format)
+COLUMN_TYPES = {
+	'AirTC': ('Deg C', 'Smp', -5.0, 45.0, '%.2f'),
+	'RH': ('%', 'Smp', 5.0, 95.0, '%.1f'),
+	'Pyro': ('W/m^2', 'Smp', 0.0, 1100.0, '%.1f'),
+	'PAR_ref': ('umol/s/m^2', 'Smp', 0.0, 2200.0, '%.1f'),
+	'WindDir': ('degrees', 'Smp', 0.0, 360.0, '%.1f'),
+	'WS_ms': ('meters/second', 'Smp', 0.0, 15.0, '%.2f'),
+	'Rain_mm_Tot': ('mm', 'Tot', 0.0, 0.3, '%.1f')
+}
+
+DEFAULT_COLUMNS = ['AirTC', 'RH', 'Pyro', 'PAR_ref', 'WindDir', 'WS_ms', 'Rain_mm_Tot']
+
+DEFAULT_START = datetime.datetime(2017, 4, 1)
+
+
+def quote(values):
+	return ','.join('"%s"' % value for value in values)
+
+
+def generate(filepath, rows, columns=DEFAULT_COLUMNS, rate=1, start=DEFAULT_START, seed=0):
+	'''
+	Write a TOA5 file and return the number of rows written.
+
+	Keyword arguments:
+	filepath -- the file to write
+	rows -- number of records
+	columns -- names of the columns after TIMESTAMP and RECORD, see COLUMN_TYPES
+	rate -- seconds between two records
+	start -- logger time of the first record
+	seed -- seed of the random values, the same arguments always give the same file
+	'''
+	for column in columns:
+		if column not in COLUMN_TYPES:
+			raise ValueError('Unsupported column "%s".' % column)
+
+	generator = random.Random(seed)
+	types = [COLUMN_TYPES[column] for column in columns]
+	rowFormat = '"%s",%d,' + ','.join(columnType[4] for columnType in types) + '\n'
+
+	with open(filepath, 'w') as datfile:
+		datfile.write(quote(['TOA5', 'WeatherStation', 'CR1000', '12345', 'CR1000.Std.29', 'CPU:synthetic.CR1', '1', 'Table1']) + '\n')
+		datfile.write(quote(['TIMESTAMP', 'RECORD'] + columns) + '\n')
+		datfile.write(quote(['TS', 'RN'] + [columnType[0] for columnType in types]) + '\n')
+		datfile.write(quote(['', ''] + [columnType[1] for columnType in types]) + '\n')
+
+		step = datetime.timedelta(seconds=rate)
+		time = start
+		lines = []
+		for record in xrange(rows):
+			values = [generator.uniform(columnType[2], columnType[3]) for columnType in types]
+			lines.append(rowFormat % tuple([time.strftime('%Y-%m-%d %H:%M:%S'), record] + values))
+			time += step
+			# Write in blocks to keep memory flat for large files.
+			if len(lines) == 10000:
+				datfile.writelines(lines)
+				lines = []
+		datfile.writelines(lines)
+
+	return rows
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Write a synthetic TOA5 weather .dat file.')
+	parser.add_argument('output', help='the file to write')
+	parser.add_argument('--rows', type=int, default=3600, help='number of records (default is 3600)')
+	parser.add_argument('--rate', type=int, default=1, help='seconds between records (default is 1)')
+	parser.add_argument('--columns', nargs='+', default=DEFAULT_COLUMNS,
+						help='columns after TIMESTAMP and RECORD (default is %s)' % ' '.join(DEFAULT_COLUMNS))
+	parser.add_argument('--seed', type=int, default=0, help='seed of the random values')
+	args = parser.parse_args()
+
+	generate(args.output, args.rows, args.columns, args.rate, seed=args.seed)